@@ -0,0 +1,245 @@
+"""
+Runs check_toots() end to end against a fake Mastodon server, and reports how fast it went.
+
+    python benchmarks/benchmark.py --toots 10000 --latency 0.01
+
+Use --json to get machine readable results, so that releases can be compared. Use --startup
+to measure how long ephemetoot takes to start instead.
+"""
+
+# standard library
+from argparse import ArgumentParser, Namespace
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# allow running from a source checkout without installing ephemetoot first
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(
+    1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+# local
+import fake_mastodon
+from ephemetoot import ephemetoot
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# modules that starting ephemetoot (and --init, --version and --schedule) shouldn't import
+HEAVY_MODULES = ("mastodon", "requests", "yaml", "ephemetoot.ephemetoot")
+
+
+def default_options(**kwargs):
+    """
+    The options check_toots() would get from the command line with no flags set.
+    """
+    values = {
+        "archive_deleted": False,
+        "datestamp": False,
+        "expiry_queue": False,
+        "hide_skipped": True,
+        "instance_workers": 2,
+        "log_format": "text",
+        "pace": False,
+        "plan": None,
+        "pool_size": 10,
+        "quiet": True,
+        "resume": False,
+        "retry_mins": 1,
+        "schedule": None,
+        "state": None,
+        "test": False,
+        "time": None,
+        "verbose": False,
+        "workers": 1,
+    }
+    values.update(kwargs)
+    return Namespace(**values)
+
+
+def benchmark(
+    toots=1000,
+    latency=0.0,
+    limit=300000,
+    delete_limit=300000,
+    window=300,
+    delete_window=1800,
+    days_to_keep=30,
+    archive=None,
+    test=False,
+):
+    """
+    Runs one account against a new fake server, and returns a dict of results.
+    """
+    server = fake_mastodon.start(
+        toots=toots,
+        latency=latency,
+        limit=limit,
+        delete_limit=delete_limit,
+        window=window,
+        delete_window=delete_window,
+    )
+    config = {
+        "access_token": "benchmark",
+        "username": "bench",
+        "base_url": server.url,
+        "days_to_keep": days_to_keep,
+        "keep_pinned": True,
+        "visibility_to_keep": ["unlisted"],
+        "hashtags_to_keep": ["keepme"],
+    }
+    if archive:
+        config["archive"] = archive
+        config["archive_media"] = True
+    options = default_options(test=test)
+
+    started = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            ephemetoot.check_toots(config, options)
+            ephemetoot.finish_archiving()
+    finally:
+        seconds = time.perf_counter() - started
+        server.shutdown()
+        server.server_close()
+
+    stats = server.fake.stats()
+    removed = stats["deleted"] + stats["unboosted"]
+    return {
+        "toots": toots,
+        "latency": latency,
+        "seconds": round(seconds, 3),
+        "evaluated": stats["served"],
+        "evaluated_per_second": round(stats["served"] / seconds, 1),
+        "removed": removed,
+        "removed_per_second": round(removed / seconds, 1),
+        "api_calls": stats["api_calls"],
+        "rate_limited": stats["calls"].get("rate_limited", 0),
+        "peak_rss_mb": ephemetoot.peak_memory(),
+    }
+
+
+def import_time(module, runs=5):
+    """
+    The fastest of several cold imports of module, in seconds. Each import is done in a new interpreter, and timed with python -X importtime.
+    """
+    best = None
+    for run in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import " + module],
+            env=dict(os.environ, PYTHONPATH=SRC),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = [field.strip() for field in line.split("|")]
+            if len(fields) == 3 and fields[2] == module:
+                seconds = int(fields[1]) / 1000000
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def startup(runs=5):
+    """
+    Measures how long ephemetoot takes to start: importing the command line module, compared with importing Mastodon.py on its own, and which heavy modules the command line module imports.
+    """
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import json, sys, ephemetoot.console; "
+            + "print(json.dumps([m for m in %r if m in sys.modules]))"
+            % (HEAVY_MODULES,),
+        ],
+        env=dict(os.environ, PYTHONPATH=SRC),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return {
+        "console_import": import_time("ephemetoot.console", runs),
+        "mastodon_import": import_time("mastodon", runs),
+        "heavy_modules": json.loads(result.stdout),
+    }
+
+
+def report(results):
+    print("Toots in timeline:   ", results["toots"])
+    print("Latency per request: ", results["latency"], "s")
+    print("Run time:            ", results["seconds"], "s")
+    print("Toots evaluated:     ", results["evaluated"])
+    print("Evaluated/sec:       ", results["evaluated_per_second"])
+    print("Toots removed:       ", results["removed"])
+    print("Removed/sec:         ", results["removed_per_second"])
+    print("API calls:           ", results["api_calls"])
+    print("Rate limited (429):  ", results["rate_limited"])
+    if results["peak_rss_mb"] is not None:
+        print("Peak RSS:            ", round(results["peak_rss_mb"], 1), "MB")
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark ephemetoot against a fake server")
+    parser.add_argument(
+        "--toots", type=int, nargs="+", default=[1000], help="timeline sizes to run"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every request"
+    )
+    parser.add_argument("--limit", type=int, default=300000, help="requests per window")
+    parser.add_argument(
+        "--delete-limit", type=int, default=300000, help="deletes per delete window"
+    )
+    parser.add_argument("--window", type=int, default=300, help="seconds")
+    parser.add_argument("--delete-window", type=int, default=1800, help="seconds")
+    parser.add_argument("--days-to-keep", type=int, default=30)
+    parser.add_argument(
+        "--archive", action="store_true", help="archive toots and media to a temp dir"
+    )
+    parser.add_argument("--test", action="store_true", help="don't delete anything")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument(
+        "--startup", action="store_true", help="measure start up time instead"
+    )
+    args = parser.parse_args()
+
+    if args.startup:
+        results = startup()
+        if args.json:
+            print(json.dumps(results))
+        else:
+            print("Import console:      ", round(results["console_import"], 3), "s")
+            print("Import Mastodon.py:  ", round(results["mastodon_import"], 3), "s")
+            print(
+                "Heavy modules:       ", ", ".join(results["heavy_modules"]) or "none"
+            )
+        return
+
+    for toots in args.toots:
+        with tempfile.TemporaryDirectory() as archive:
+            results = benchmark(
+                toots=toots,
+                latency=args.latency,
+                limit=args.limit,
+                delete_limit=args.delete_limit,
+                window=args.window,
+                delete_window=args.delete_window,
+                days_to_keep=args.days_to_keep,
+                archive=archive if args.archive else None,
+                test=args.test,
+            )
+        if args.json:
+            print(json.dumps(results))
+        else:
+            report(results)
+            print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+A stand-in for the parts of the Mastodon API that ephemetoot uses, for benchmarking.
+
+Serves one account with a generated timeline of any size, with snowflake IDs, rate limit
+headers and optional latency. Only the IDs of the toots are held in memory, so timelines
+of hundreds of thousands of toots are fine.
+"""
+
+# standard library
+from argparse import ArgumentParser
+import bisect
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+ACCOUNT_ID = "1"
+
+# one pixel transparent GIF, served for every media attachment
+MEDIA = (
+    b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00"
+    b"\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;"
+)
+
+
+def snowflake(created_at):
+    return int(created_at.timestamp() * 1000) << 16
+
+
+def snowflake_datetime(status_id):
+    return datetime.fromtimestamp((status_id >> 16) / 1000, timezone.utc)
+
+
+class RateLimit:
+    """
+    A fixed window rate limit, reported with the same headers Mastodon uses.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.remaining = limit
+        self.reset = time.time() + window
+
+    def take(self):
+        now = time.time()
+        if now >= self.reset:
+            self.remaining = self.limit
+            self.reset = now + self.window
+        if self.remaining == 0:
+            return False
+        self.remaining -= 1
+        return True
+
+    def headers(self):
+        reset = datetime.fromtimestamp(self.reset, timezone.utc)
+        return {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": reset.isoformat(),
+        }
+
+
+class FakeMastodon:
+    """
+    The state of the fake server: the timeline, the rate limits, and a count of API calls.
+    """
+
+    def __init__(
+        self,
+        toots=1000,
+        hours_between=6,
+        latency=0.0,
+        limit=300,
+        delete_limit=30,
+        window=300,
+        delete_window=1800,
+        base_url="",
+    ):
+        self.latency = latency
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.general = RateLimit(limit, window)
+        self.deletes = RateLimit(delete_limit, delete_window)
+        self.calls = {}
+        self.served = 0
+        self.deleted = 0
+        self.unboosted = 0
+
+        # ascending order, so we can bisect for max_id
+        now = datetime.now(timezone.utc)
+        self.ids = sorted(
+            snowflake(now - timedelta(hours=hours_between * i)) + i % 1000
+            for i in range(toots)
+        )
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def account(self):
+        return {
+            "id": ACCOUNT_ID,
+            "username": "bench",
+            "acct": "bench",
+            "display_name": "Benchmark",
+            "created_at": "2018-01-01T00:00:00.000Z",
+            "statuses_count": len(self.ids),
+            "followers_count": 0,
+            "following_count": 0,
+        }
+
+    def status(self, status_id):
+        """
+        Builds a status from its ID: every tenth is a boost and every seventh has an attachment.
+        """
+        created_at = snowflake_datetime(status_id)
+        status = {
+            "id": str(status_id),
+            "created_at": created_at.isoformat().replace("+00:00", "Z"),
+            "visibility": "public" if status_id % 5 else "unlisted",
+            "content": "<p>benchmark toot " + str(status_id) + "</p>",
+            "pinned": False,
+            "reblog": None,
+            "tags": [{"name": "bench", "url": ""}] if status_id % 3 == 0 else [],
+            "media_attachments": [],
+            "mentions": [],
+            "emojis": [],
+            "account": self.account(),
+        }
+        if status_id % 10 == 0:
+            status["reblog"] = dict(status, id=str(status_id + 1), reblog=None)
+        if status_id % 7 == 0:
+            status["media_attachments"] = [
+                {
+                    "id": str(status_id),
+                    "type": "image",
+                    "url": self.base_url + "/media/" + str(status_id) + ".gif",
+                }
+            ]
+        return status
+
+    def statuses(self, max_id=None, limit=40, pinned=False):
+        if pinned:
+            return []
+        with self.lock:
+            end = len(self.ids)
+            if max_id is not None:
+                end = bisect.bisect_left(self.ids, int(max_id))
+            page = self.ids[max(0, end - limit) : end]
+            self.served += len(page)
+        return [self.status(status_id) for status_id in reversed(page)]
+
+    def remove(self, status_id, unboost=False):
+        with self.lock:
+            if unboost:
+                status_id -= 1  # the boost, rather than the boosted status
+            position = bisect.bisect_left(self.ids, status_id)
+            if position == len(self.ids) or self.ids[position] != status_id:
+                return None
+            del self.ids[position]
+            if unboost:
+                self.unboosted += 1
+            else:
+                self.deleted += 1
+        return self.status(status_id)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "api_calls": sum(
+                    n for endpoint, n in self.calls.items() if endpoint != "media"
+                ),
+                "served": self.served,
+                "deleted": self.deleted,
+                "unboosted": self.unboosted,
+                "remaining": len(self.ids),
+            }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # otherwise every response is delayed by ~40ms
+
+    def log_message(self, format, *args):
+        return None  # keep benchmark output clean
+
+    def send(self, code, body, headers={}, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_api(self, method):
+        fake = self.server.fake
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        if url.path.startswith("/media/"):
+            fake.count("media")
+            return self.send(200, MEDIA, content_type="image/gif")
+
+        deleting = method in ("DELETE", "POST")
+        bucket = fake.deletes if deleting else fake.general
+        with fake.lock:
+            allowed = bucket.take()
+            headers = bucket.headers()
+        if not allowed:
+            fake.count("rate_limited")
+            return self.send(429, {"error": "Too many requests"}, headers)
+
+        match = re.fullmatch(r"/api/v1/statuses/(\d+)(/unreblog)?", url.path)
+        if method == "GET" and url.path == "/api/v1/accounts/verify_credentials":
+            fake.count("verify_credentials")
+            return self.send(200, fake.account(), headers)
+        if method == "GET" and url.path == "/api/v1/accounts/" + ACCOUNT_ID:
+            fake.count("account")
+            return self.send(200, fake.account(), headers)
+        if (
+            method == "GET"
+            and url.path == "/api/v1/accounts/" + ACCOUNT_ID + "/statuses"
+        ):
+            fake.count("account_statuses")
+            statuses = fake.statuses(
+                max_id=query.get("max_id"),
+                limit=int(query.get("limit", 20)),
+                pinned=query.get("pinned") in ("1", "true", "True"),
+            )
+            return self.send(200, statuses, headers)
+        if method in ("GET", "DELETE") and match and not match.group(2):
+            fake.count("status" if method == "GET" else "delete")
+            status = fake.remove(int(match.group(1))) if method == "DELETE" else None
+            if method == "GET":
+                status = fake.status(int(match.group(1)))
+            if status is None:
+                return self.send(404, {"error": "Record not found"}, headers)
+            return self.send(200, status, headers)
+        if method == "POST" and match and match.group(2):
+            fake.count("unreblog")
+            status = fake.remove(int(match.group(1)), unboost=True)
+            if status is None:
+                return self.send(404, {"error": "Record not found"}, headers)
+            return self.send(200, status, headers)
+        if url.path in ("/api/v1/instance", "/api/v2/instance"):
+            return self.send(200, {"version": "4.2.0", "uri": "localhost"})
+        if url.path == "/_stats":
+            return self.send(200, fake.stats())
+
+        return self.send(404, {"error": "Record not found"})
+
+    def do_GET(self):
+        self.handle_api("GET")
+
+    def do_DELETE(self):
+        self.handle_api("DELETE")
+
+    def do_POST(self):
+        self.handle_api("POST")
+
+
+def start(port=0, **kwargs):
+    """
+    Starts a fake server in a background thread. Returns the server: its address is server.url, and server.fake holds its state.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.url = "http://127.0.0.1:" + str(server.server_address[1])
+    server.fake = FakeMastodon(base_url=server.url, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run a fake Mastodon server for benchmarks")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--toots", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--delete-limit", type=int, default=30)
+    args = parser.parse_args()
+
+    server = start(
+        args.port,
+        toots=args.toots,
+        latency=args.latency,
+        delete_limit=args.delete_limit,
+    )
+    print("Fake Mastodon server running at", server.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,484 @@
+# standard library
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+
+# start a new segment file once the current one reaches this size
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+INDEX_FILE = "toots.index"
+
+
+def segment_name(number):
+    return "toots-" + str(number).zfill(6) + ".jsonl"
+
+
+class SegmentArchive:
+    """
+    A packed archive for the 'jsonl' archive_format. Toots are appended as one compact JSON line each to numbered segment files, instead of one file per toot. The ID of every archived toot is kept in an index file, along with where to find it, so checking whether a toot is already archived never touches the filesystem.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.index = {}
+        self.segment = 1
+        self.load_index()
+
+        self.segment_file = open(os.path.join(path, segment_name(self.segment)), "ab")
+        self.index_file = open(os.path.join(path, INDEX_FILE), "a")
+
+    def load_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return
+
+        sizes = {}
+        with open(index_path) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) != 4:
+                    continue  # partly written when a previous run was killed
+                toot_id, segment, offset, length = fields
+                segment, offset, length = int(segment), int(offset), int(length)
+                if segment not in sizes:
+                    segment_path = os.path.join(self.path, segment_name(segment))
+                    sizes[segment] = (
+                        os.path.getsize(segment_path)
+                        if os.path.exists(segment_path)
+                        else 0
+                    )
+                # ignore records that never made it to disk
+                if offset + length <= sizes[segment]:
+                    self.index[toot_id] = (segment, offset, length)
+                    self.segment = max(self.segment, segment)
+
+    def __contains__(self, toot_id):
+        return str(toot_id) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def append(self, toot_id, record):
+        """
+        Add a toot to the archive, unless it is already there. record is the toot as a JSON string.
+        """
+        data = record.encode("utf-8") + b"\n"
+        with self.lock:
+            if str(toot_id) in self.index:
+                return
+
+            offset = self.segment_file.tell()
+            if offset > 0 and offset + len(data) > self.segment_size:
+                self.segment_file.close()
+                self.segment += 1
+                self.segment_file = open(
+                    os.path.join(self.path, segment_name(self.segment)), "ab"
+                )
+                offset = 0
+
+            # write the toot before the index, so the index never points at missing data
+            self.segment_file.write(data)
+            self.segment_file.flush()
+            self.index_file.write(
+                "\t".join(
+                    [str(toot_id), str(self.segment), str(offset), str(len(data))]
+                )
+                + "\n"
+            )
+            self.index_file.flush()
+            self.index[str(toot_id)] = (self.segment, offset, len(data))
+
+    def get(self, toot_id):
+        """
+        Returns an archived toot as a dict, or None if it is not in the archive.
+        """
+        with self.lock:
+            if str(toot_id) not in self.index:
+                return None
+            segment, offset, length = self.index[str(toot_id)]
+            self.segment_file.flush()
+
+        with open(os.path.join(self.path, segment_name(segment)), "rb") as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+
+    def close(self):
+        with self.lock:
+            self.segment_file.close()
+            self.index_file.close()
+
+
+# accounts in the same config file may share an archive directory
+archives = {}
+archives_lock = threading.Lock()
+
+
+def open_archive(path):
+    """
+    Returns the SegmentArchive for a directory, opening it the first time it is used in a run.
+    """
+    path = os.path.abspath(path)
+    with archives_lock:
+        if path not in archives:
+            archives[path] = SegmentArchive(path)
+        return archives[path]
+
+
+def close_archives():
+    with archives_lock:
+        for archive in archives.values():
+            archive.close()
+        archives.clear()
+        for store in media_stores.values():
+            store.close()
+        media_stores.clear()
+
+
+# compact_archive() writes to this directory inside the archive it is compacting
+PACKED_DIR = "packed"
+PROGRESS_FILE = "compact.json"
+PACKED_INDEX_FILE = "toots.idx"
+
+# toot id, segment number, offset, length
+INDEX_RECORD = struct.Struct("<QIQI")
+
+CODECS = ("none", "gzip", "zstd")
+
+# save progress after this many toots, so an interrupted compaction can resume
+CHECKPOINT_EVERY = 1000
+
+
+def zstd_module():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "zstd compression needs the 'zstandard' package: pip install ephemetoot[zstd]"
+        )
+    return zstandard
+
+
+def compress(data, codec):
+    """
+    Each toot is compressed on its own, so that any one of them can be read without reading the rest of the segment.
+    """
+    if codec == "gzip":
+        return gzip.compress(data, mtime=0)
+    if codec == "zstd":
+        return zstd_module().ZstdCompressor().compress(data)
+    return data
+
+
+def decompress(data, codec):
+    if codec == "gzip":
+        return gzip.decompress(data)
+    if codec == "zstd":
+        return zstd_module().ZstdDecompressor().decompress(data)
+    return data
+
+
+def packed_segment_name(number, codec):
+    name = segment_name(number)
+    if codec == "gzip":
+        return name + ".gz"
+    if codec == "zstd":
+        return name + ".zst"
+    return name
+
+
+class PackedArchive:
+    """
+    Read-only access to an archive made by compact_archive(). The index is a sorted file of fixed-size records which is memory-mapped rather than read, so finding a toot is a binary search however big the archive is.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, PROGRESS_FILE)) as f:
+            self.codec = json.load(f)["codec"]
+        self.index_file = open(os.path.join(path, PACKED_INDEX_FILE), "rb")
+        size = os.fstat(self.index_file.fileno()).st_size
+        self.count = size // INDEX_RECORD.size
+        self.index = (
+            mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if size > 0
+            else b""
+        )
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, toot_id):
+        return self.find(toot_id) is not None
+
+    def record(self, position):
+        return INDEX_RECORD.unpack_from(self.index, position * INDEX_RECORD.size)
+
+    def find(self, toot_id):
+        """
+        Returns (segment, offset, length) for a toot, or None if it is not in the archive.
+        """
+        toot_id = int(toot_id)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] < toot_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count:
+            record = self.record(low)
+            if record[0] == toot_id:
+                return record[1:]
+        return None
+
+    def get(self, toot_id):
+        """
+        Returns an archived toot as a dict, or None if it is not in the archive.
+        """
+        found = self.find(toot_id)
+        if found is None:
+            return None
+        segment, offset, length = found
+        with open(
+            os.path.join(self.path, packed_segment_name(segment, self.codec)), "rb"
+        ) as f:
+            f.seek(offset)
+            return json.loads(decompress(f.read(length), self.codec))
+
+    def close(self):
+        if self.count > 0:
+            self.index.close()
+        self.index_file.close()
+
+
+def save_progress(packed_path, progress):
+    progress_path = os.path.join(packed_path, PROGRESS_FILE)
+    with open(progress_path + ".tmp", "w") as f:
+        json.dump(progress, f, indent=2)
+    os.replace(progress_path + ".tmp", progress_path)
+
+
+def open_truncated(path, size):
+    """
+    Open a file for appending, throwing away anything written after the last saved progress.
+    """
+    f = open(path, "r+b" if os.path.exists(path) else "w+b")
+    f.truncate(size)
+    f.seek(size)
+    return f
+
+
+def compact_archive(path, codec="none", segment_size=SEGMENT_SIZE):
+    """
+    Packs an archive of one JSON file per toot into segment files in a 'packed' directory inside it, with a sorted index. The original files are left alone. If compaction is interrupted, running it again carries on where it left off. Returns True if every toot was packed.
+    """
+    if codec not in CODECS:
+        raise ValueError("compression must be one of: " + ", ".join(CODECS))
+    if codec == "zstd":
+        zstd_module()  # fail now rather than after the first toot
+
+    toot_ids = sorted(
+        int(name[:-5])
+        for name in os.listdir(path)
+        if name.endswith(".json") and name[:-5].isdigit()
+    )
+
+    packed_path = os.path.join(path, PACKED_DIR)
+    os.makedirs(packed_path, exist_ok=True)
+    try:
+        with open(os.path.join(packed_path, PROGRESS_FILE)) as f:
+            progress = json.load(f)
+    except FileNotFoundError:
+        progress = {
+            "codec": codec,
+            "done": 0,
+            "errors": [],
+            "last_id": None,
+            "segment": 1,
+            "offset": 0,
+        }
+
+    if progress["codec"] != codec:
+        raise ValueError(
+            "This archive is already being compacted with compression '"
+            + progress["codec"]
+            + "'. Use the same compression to resume."
+        )
+
+    if progress["done"] > 0:
+        print("Resuming after", progress["done"], "toots")
+
+    segment_file = open_truncated(
+        os.path.join(packed_path, packed_segment_name(progress["segment"], codec)),
+        progress["offset"],
+    )
+    index_file = open_truncated(
+        os.path.join(packed_path, PACKED_INDEX_FILE),
+        progress["done"] * INDEX_RECORD.size,
+    )
+
+    try:
+        for toot_id in toot_ids:
+            if progress["last_id"] is not None and toot_id <= progress["last_id"]:
+                continue
+
+            try:
+                with open(os.path.join(path, str(toot_id) + ".json"), "rb") as f:
+                    toot = json.load(f)
+            except ValueError as e:
+                print("🛑 ERROR reading", str(toot_id) + ".json", "-", e)
+                progress["errors"].append(toot_id)
+                progress["last_id"] = toot_id
+                continue
+
+            data = compress(
+                json.dumps(toot, separators=(",", ":")).encode("utf-8"), codec
+            )
+
+            if progress["offset"] > 0 and progress["offset"] + len(data) > segment_size:
+                segment_file.close()
+                progress["segment"] += 1
+                progress["offset"] = 0
+                segment_file = open_truncated(
+                    os.path.join(
+                        packed_path, packed_segment_name(progress["segment"], codec)
+                    ),
+                    0,
+                )
+
+            segment_file.write(data)
+            index_file.write(
+                INDEX_RECORD.pack(
+                    toot_id, progress["segment"], progress["offset"], len(data)
+                )
+            )
+            progress["offset"] += len(data)
+            progress["done"] += 1
+            progress["last_id"] = toot_id
+
+            if progress["done"] % CHECKPOINT_EVERY == 0:
+                segment_file.flush()
+                index_file.flush()
+                save_progress(packed_path, progress)
+
+    finally:
+        segment_file.close()
+        index_file.close()
+        save_progress(packed_path, progress)
+
+    # check that every toot made it into the packed archive
+    packed = PackedArchive(packed_path)
+    packed_count = len(packed)
+    packed.close()
+    expected = len(toot_ids) - len(progress["errors"])
+
+    print("Packed", packed_count, "of", len(toot_ids), "toots into", packed_path)
+    if packed_count != expected or packed_count != progress["done"]:
+        print("⚠️  Expected", expected, "toots in the packed archive")
+        return False
+    if len(progress["errors"]) > 0:
+        print("⚠️ ", len(progress["errors"]), "toots could not be read")
+        return False
+    return True
+
+
+MEDIA_INDEX_FILE = "media.index"
+
+
+def is_digest(value):
+    return len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+class MediaStore:
+    """
+    A content-addressed store for media attachments, set with media_store in the config file. Every file is saved once, named by the SHA-256 hash of its contents, however many toots or accounts it is attached to and whichever server it was downloaded from. An index of URL to hash is kept in memory and trusted when the store is opened, so a file that is already stored is never downloaded or looked for on disk again. The disk is only checked when a new file is added.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = {}
+        os.makedirs(os.path.join(path, "tmp"), exist_ok=True)
+
+        index_path = os.path.join(path, MEDIA_INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    # ignore a line partly written when a previous run was killed
+                    if len(fields) == 2 and is_digest(fields[0]):
+                        self.index[fields[1]] = fields[0]
+        self.index_file = open(index_path, "a")
+
+    def __contains__(self, url):
+        return url in self.index
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, "blobs", digest[:2], digest)
+
+    def path_for(self, url):
+        """
+        Returns where the file downloaded from url is stored, or None if it isn't.
+        """
+        digest = self.index.get(url)
+        return self.blob_path(digest) if digest else None
+
+    def temp_path(self, url):
+        """
+        Where to download url to before it is added to the store. This stays the same between runs, so an interrupted download can be resumed.
+        """
+        return os.path.join(
+            self.path, "tmp", hashlib.sha1(url.encode("utf-8")).hexdigest()
+        )
+
+    def add(self, url, file_path):
+        """
+        Move a downloaded file into the store, unless a file with the same contents is already there.
+        """
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            chunk = f.read(1024 * 1024)
+            while chunk:
+                sha.update(chunk)
+                chunk = f.read(1024 * 1024)
+        digest = sha.hexdigest()
+
+        with self.lock:
+            blob_path = self.blob_path(digest)
+            if os.path.exists(blob_path):
+                os.remove(file_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(file_path, blob_path)
+            self.index_file.write(digest + "\t" + url + "\n")
+            self.index_file.flush()
+            self.index[url] = digest
+
+    def close(self):
+        with self.lock:
+            self.index_file.close()
+
+
+# every account using the same media_store shares one MediaStore
+media_stores = {}
+
+
+def media_store_path(path):
+    """
+    The same media_store may be written differently in the config for each account, so it is always known by its absolute path.
+    """
+    return os.path.abspath(os.path.expanduser(path))
+
+
+def open_media_store(path):
+    path = media_store_path(path)
+    with archives_lock:
+        if path not in media_stores:
+            media_stores[path] = MediaStore(path)
+        return media_stores[path]
@@ -0,0 +1,321 @@
+# standard library
+import os
+import re
+import subprocess
+import sys
+
+# local
+from ephemetoot import plist
+
+# --init, --version and --schedule don't check any toots, so they are kept apart from
+# the code that needs Mastodon.py, and start quickly
+
+
+def compulsory_input(tags, name, example):
+
+    value = ""
+    while len(value) < 1:
+        if example:
+            value = input(tags[0] + name + tags[1] + example + tags[2])
+        else:
+            value = input(tags[0] + name + tags[2])
+
+        sanitised = sanitise_input(value, name, tags)
+
+        if len(value) > 0 and (sanitised == "ok" or sanitised == None):
+            return value
+        else:
+            if len(value) > 0 and sanitised != None:
+                print(sanitised)
+            value = ""
+
+
+def digit_input(tags, name, example):
+
+    value = ""
+    while value.isdigit() == False:
+        if example:
+            value = input(tags[0] + name + tags[1] + example + tags[2])
+        else:
+            value = input(tags[0] + name + tags[2])
+
+    return value
+
+
+def yes_no_input(tags, name):
+    value = ""
+    while value not in ["y", "n"]:
+        value = input(tags[0] + name + tags[1] + "(y or n):" + tags[2])
+    return_val = "true" if value == "y" else "false"
+    return return_val
+
+
+def optional_input(tags, name, example):
+
+    incomplete = True
+    while incomplete:
+        value = input(tags[0] + name + tags[1] + example + tags[2])
+        sanitised = sanitise_input(value, name, tags)
+        if len(value) > 0 and (sanitised == "ok" or sanitised == None):
+            incomplete = False
+            return value
+        elif len(value) > 0 and sanitised != None:
+            print(sanitised)
+        else:
+            return ""
+
+
+def sanitise_input(value, input_type, tags):
+    """
+    Check that data entered when running --init complies with requirements
+    """
+
+    if input_type == "Username":
+        return (
+            "Do not include '@' in username, please try again"
+            if value.startswith("@")
+            else "ok"
+        )
+
+    if input_type == "Base URL":
+        error = value.startswith("http") or value.find(".") == -1
+        return (
+            "Provide full domain without protocol prefix (e.g. "
+            + tags[1]
+            + "example.social"
+            + tags[2]
+            + ", not "
+            + tags[1]
+            + "http://example.social"
+            + tags[2]
+            + ")"
+            if error
+            else "ok"
+        )
+
+    if input_type == "Toots to keep":
+        l = value.split(",")
+
+        def check(s):
+            d = s.strip()
+            if not d.isdigit():
+                return False
+
+        allnum = map(check, l)
+        return (
+            "Toot IDs must be numeric and separated with commas"
+            if False in list(allnum)
+            else "ok"
+        )
+
+    if input_type == "Hashtags to keep":
+        l = value.split(",")
+
+        def check(s):
+            d = s.strip()
+            if d.isdigit():
+                return False
+            if not re.fullmatch(r"[\w]+", d, flags=re.IGNORECASE):
+                return False
+
+        complies = map(check, l)
+        return_string = (
+            "Hashtags must not include '#' and must match rules at "
+            + tags[0]
+            + "https://docs.joinmastodon.org/user/posting/#hashtags"
+            + tags[2]
+        )
+        return return_string if False in list(complies) else "ok"
+
+    if input_type == "Visibility to keep":
+        l = value.split(",")
+        viz_options = set(["public", "unlisted", "private", "direct"])
+
+        def check(s):
+            d = [s.strip().lower()]
+            intersects = viz_options.intersection(d)
+            if len(intersects) == 0:
+                return False
+
+        complies = map(check, l)
+        return_string = "Valid values are one or more of 'public', 'unlisted', 'private' or 'direct'"
+        return return_string if False in list(complies) else "ok"
+
+    if input_type == "Archive path":
+        path = (
+            os.path.expanduser(value)
+            if len(str(value)) > 0 and str(value)[0] == "~"
+            else value
+        )
+        response = (
+            "ok"
+            if os.path.exists(path)
+            else "That directory does not exist, please try again"
+        )
+        return response
+
+
+def init():
+    """
+    Creates a config.yaml file in the current directory, based on user input.
+    """
+    try:
+
+        # text colour markers (beginning, example, end)
+        tags = ("\033[96m", "\033[2m", "\033[0m")
+
+        print("\nCreate your config.yaml file.\n")
+        print(
+            "For help check out the docs at ",
+            tags[0],
+            "ephemetoot.hugh.run",
+            tags[2],
+            "\n",
+            sep="",
+        )
+
+        conf_token = compulsory_input(tags, "Access token: ", None)
+        conf_user = compulsory_input(
+            tags, "Username", "(without the '@' - e.g. alice):"
+        )
+        conf_url = compulsory_input(tags, "Base URL", "(e.g. example.social):")
+        conf_days = digit_input(tags, "Days to keep", "(default 365):")
+        conf_pinned = yes_no_input(tags, "Keep pinned toots?")
+        conf_boosts_only = yes_no_input(tags, "Only remove boosted toots?")
+        conf_keep_toots = optional_input(
+            tags, "Toots to keep", "(optional list of IDs separated by commas):"
+        )
+        conf_keep_hashtags = optional_input(
+            tags,
+            "Hashtags to keep",
+            "(optional list without '#' e.g. mastodon, gardening, cats):",
+        )
+        conf_keep_visibility = optional_input(
+            tags, "Visibility to keep", "(optional list e.g. 'direct'):"
+        )
+        conf_archive = optional_input(
+            tags, "Archive path", "(optional filepath for archive):"
+        )
+
+        if len(conf_archive) > 0:
+            conf_archive_media = yes_no_input(tags, "Archive media?")
+
+        # write out the config file
+        with open("config.yaml", "w") as configfile:
+
+            configfile.write("-")
+            configfile.write("\n  access_token: " + conf_token)
+            configfile.write("\n  username: " + conf_user)
+            configfile.write("\n  base_url: " + conf_url)
+            configfile.write("\n  days_to_keep: " + conf_days)
+            configfile.write("\n  keep_pinned: " + conf_pinned)
+            configfile.write("\n  boosts_only: " + conf_boosts_only)
+
+            if len(conf_keep_toots) > 0:
+                keep_list = conf_keep_toots.split(",")
+                configfile.write("\n  toots_to_keep:")
+                for toot in keep_list:
+                    configfile.write("\n    - " + toot.strip())
+
+            if len(conf_keep_hashtags) > 0:
+                tag_list = conf_keep_hashtags.split(",")
+                configfile.write("\n  hashtags_to_keep:")
+                for tag in tag_list:
+                    configfile.write("\n    - " + tag.strip())
+
+            if len(conf_keep_visibility) > 0:
+                viz_list = conf_keep_visibility.split(",")
+                configfile.write("\n  visibility_to_keep:")
+                for mode in viz_list:
+                    configfile.write("\n    - " + mode.strip())
+
+            if len(conf_archive) > 0:
+                configfile.write("\n  archive: " + conf_archive)
+                configfile.write("\n  archive_media: " + conf_archive_media)
+
+            configfile.close()
+
+    except Exception as e:
+        print(e)
+
+
+def version(vnum):
+    """
+    Prints current and latest version numbers to console.
+    """
+
+    # only needed here, so don't make every other command wait to import it
+    import requests
+
+    try:
+        latest = requests.get(
+            "https://api.github.com/repos/hughrun/ephemetoot/releases/latest"
+        )
+        res = latest.json()
+        latest_version = res["tag_name"]
+        print("\nephemetoot ==> 🥳 ==> 🧼 ==> 😇")
+        print("-------------------------------")
+        print("You are using release: \033[92mv", vnum, "\033[0m", sep="")
+        print("The latest release is: \033[92m" + latest_version + "\033[0m")
+        print(
+            "To upgrade to the most recent version run \033[92mpip install --upgrade ephemetoot\033[0m"
+        )
+
+    except Exception as e:
+        print("Something went wrong:", e)
+
+
+def schedule(options):
+    """
+    Creates and loads a plist file for scheduled running with launchd. If --time flag is used, the scheduled time is set accordingly. Note that this is designed for use on MacOS.
+    """
+    try:
+
+        if options.schedule == ".":
+            working_dir = os.getcwd()
+        else:
+            working_dir = options.schedule
+
+        lines = plist.default_file.splitlines()
+        lines[7] = "  <string>" + working_dir + "</string>"
+        lines[10] = "    <string>" + sys.argv[0] + "</string>"
+        lines[12] = "    <string>" + working_dir + "/config.yaml</string>"
+        lines[15] = "  <string>" + working_dir + "/ephemetoot.log</string>"
+        lines[17] = "  <string>" + working_dir + "/ephemetoot.error.log</string>"
+
+        if options.time:
+            lines[21] = "    <integer>" + options.time[0] + "</integer>"
+            lines[23] = "    <integer>" + options.time[1] + "</integer>"
+
+        # write out file directly to ~/Library/LaunchAgents
+        f = open(
+            os.path.join(
+                os.path.expanduser("~/Library/LaunchAgents"),
+                "ephemetoot.scheduler.plist",
+            ),
+            mode="w",
+        )
+        for line in lines:
+            if line == lines[-1]:
+                f.write(line)
+            else:
+                f.write(line + "\n")
+        f.close()
+        sys.tracebacklimit = 0  # suppress Tracebacks
+        # unload any existing file (i.e. if this is an update to the file) and suppress any errors
+        subprocess.run(
+            ["launchctl unload ~/Library/LaunchAgents/ephemetoot.scheduler.plist"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            shell=True,
+        )
+        # load the new file
+        subprocess.run(
+            ["launchctl load ~/Library/LaunchAgents/ephemetoot.scheduler.plist"],
+            shell=True,
+        )
+        print("⏰ Scheduled!")
+    except Exception as e:
+        print("🙁 Scheduling failed.", e)
+        if options.verbose:
+            print(e)
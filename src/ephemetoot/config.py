@@ -0,0 +1,238 @@
+# standard library
+from datetime import datetime, timezone
+import hashlib
+import json
+import os
+
+# change this whenever the checks below change, so that old caches are not trusted
+CACHE_VERSION = 2
+
+REQUIRED = ("access_token", "username", "base_url")
+
+# config values that are true or false
+BOOLEANS = ("keep_pinned", "boosts_only", "archive_media")
+
+# config values that are filepaths
+PATHS = ("archive", "media_store")
+
+# config values that are lists
+LISTS = ("toots_to_keep", "hashtags_to_keep", "visibility_to_keep")
+
+VISIBILITIES = ("public", "unlisted", "private", "direct")
+
+ARCHIVE_FORMATS = ("json", "jsonl")
+
+KNOWN = (
+    REQUIRED
+    + BOOLEANS
+    + PATHS
+    + LISTS
+    + ("days_to_keep", "archive_format", "interval_mins")
+)
+
+
+class ConfigError(Exception):
+    """
+    Raised by load_users() with every problem found in the config file, so that they can all be fixed at once.
+    """
+
+    def __init__(self, errors):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def account_problems(account):
+    """
+    Returns a list of problems with one account from the config file.
+    """
+    if not isinstance(account, dict):
+        return [
+            "should be a set of values like 'username: alice', not " + repr(account)
+        ]
+
+    problems = []
+    for key in REQUIRED:
+        if key not in account:
+            problems.append("there is no value for " + key)
+        elif not isinstance(account[key], str) or not account[key].strip():
+            problems.append(key + " must be some text")
+
+    if "days_to_keep" in account and not (
+        is_number(account["days_to_keep"]) and account["days_to_keep"] >= 0
+    ):
+        problems.append("days_to_keep must be a number of days")
+
+    if "interval_mins" in account and not (
+        is_number(account["interval_mins"]) and account["interval_mins"] > 0
+    ):
+        problems.append("interval_mins must be a number of minutes")
+
+    for key in BOOLEANS:
+        if key in account and not isinstance(account[key], bool):
+            problems.append(key + " must be true or false")
+
+    for key in PATHS:
+        if key in account and not isinstance(account[key], str):
+            problems.append(key + " must be a filepath")
+
+    for key in LISTS:
+        # an empty value is a mistake, but a list with one empty item is fine
+        if key in account and not isinstance(account[key], list):
+            problems.append(key + " must be a list, even if it is empty")
+
+    if isinstance(account.get("visibility_to_keep"), list):
+        for mode in account["visibility_to_keep"]:
+            if mode is not None and str(mode).lower() not in VISIBILITIES:
+                problems.append(
+                    "visibility_to_keep can only include " + ", ".join(VISIBILITIES)
+                )
+                break
+
+    if account.get("archive_format", "json") not in ARCHIVE_FORMATS:
+        problems.append("archive_format must be json or jsonl")
+
+    return problems
+
+
+def account_warnings(account):
+    """
+    Returns a list of settings in one account that ephemetoot doesn't know about. These are only warned about, so that a config file written for another version (or with a misspelt setting) still works.
+    """
+    if not isinstance(account, dict):
+        return []
+    return [
+        key + " is not a setting ephemetoot knows about, so it is ignored"
+        for key in account
+        if key not in KNOWN
+    ]
+
+
+def check_users(documents):
+    """
+    Checks every account in every YAML document from the config file, and returns a tuple of (accounts, problems, warnings).
+    """
+    users = []
+    problems = []
+    warnings = []
+    seen = set()
+    for document in documents:
+        if not isinstance(document, list):
+            problems.append(
+                "the config file should be a list of accounts, each starting with '-'"
+            )
+            continue
+        for account in document:
+            users.append(account)
+            number = "account " + str(len(users))
+            if isinstance(account, dict) and "username" in account:
+                number += " (" + str(account["username"])
+                number += "@" + str(account.get("base_url")) + ")"
+                key = (account["username"], account.get("base_url"))
+                if key in seen:
+                    problems.append(number + ": is in the config file more than once")
+                seen.add(key)
+            for problem in account_problems(account):
+                problems.append(number + ": " + problem)
+            for warning in account_warnings(account):
+                warnings.append(number + ": " + warning)
+    return users, problems, warnings
+
+
+def parse(content):
+    """
+    Returns the YAML documents in the config file, using the much faster C loader when PyYAML has been built with it.
+    """
+    # only needed when the cache can't be used
+    import yaml
+
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    try:
+        return list(yaml.load_all(content, Loader=loader))
+    except yaml.YAMLError as e:
+        raise ConfigError(["the config file is not valid YAML - " + str(e)])
+
+
+def cache_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, "." + name + ".cache")
+
+
+def read_cache(path):
+    try:
+        with open(cache_path(path)) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        return None
+    return cache
+
+
+def write_cache(path, stat, digest, users, warnings):
+    """
+    Save the checked accounts. The cache holds access tokens, so only the owner can read it. If it can't be written (e.g. the directory is read-only), the config file is simply parsed again next time.
+    """
+    cache = {
+        "version": CACHE_VERSION,
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha256": digest,
+        "users": users,
+        "warnings": warnings,
+    }
+    temp_path = cache_path(path) + ".tmp"
+    try:
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.replace(temp_path, cache_path(path))
+    except (OSError, TypeError, ValueError):
+        pass
+
+
+def load_users(path, log_format="text"):
+    """
+    Returns every account in the config file, after checking them all for mistakes. Raises ConfigError listing every problem found, and prints a warning for each setting that isn't known. Checked accounts are cached next to the config file, keyed by its modification time and a hash of its contents, so the YAML is only parsed and checked again when the file changes.
+    """
+    stat = os.stat(path)
+    cache = read_cache(path)
+    if (
+        cache
+        and cache["mtime_ns"] == stat.st_mtime_ns
+        and cache["size"] == stat.st_size
+    ):
+        users, warnings = cache["users"], cache["warnings"]
+    else:
+        with open(path, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+
+        # the file was touched or copied, but its contents are the same
+        if cache and cache["sha256"] == digest:
+            users, warnings = cache["users"], cache["warnings"]
+        else:
+            users, problems, warnings = check_users(parse(content))
+            if problems:
+                raise ConfigError(problems)
+
+        write_cache(path, stat, digest, users, warnings)
+
+    for warning in warnings:
+        print_warning(warning, log_format)
+    return users
+
+
+def print_warning(warning, log_format):
+    if log_format == "json":
+        record = {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "event": "config_warning",
+            "warning": warning,
+        }
+        print(json.dumps(record, ensure_ascii=False))
+    else:
+        print("⚠️ ", warning)
@@ -23,20 +23,19 @@
 #     or email: ephemetoot@hugh.run
 #  #####################################################################
 
-# import
-import yaml
-
 # from standard library
 from argparse import ArgumentParser
 from datetime import datetime, timezone
+import json
 import os
-from importlib.metadata import version
+import signal
 
 # import funtions
-from ephemetoot import ephemetoot as func
-
-# version number from package info
-vnum = version("ephemetoot")
+# Only the modules needed by every command are imported here. The rest (above all
+# Mastodon.py, which ephemetoot.ephemetoot imports) are imported by the commands that
+# use them, so that --init, --version and --schedule start quickly.
+from ephemetoot import commands
+from ephemetoot import config
 
 parser = ArgumentParser()
 parser.add_argument(
@@ -44,6 +43,19 @@ parser.add_argument(
     action="store_true",
     help="Only archive toots that are being deleted",
 )
+parser.add_argument(
+    "--compact",
+    action="store",
+    metavar="filepath",
+    help="Pack an existing archive directory of JSON files into a few large files, with an index. Run it again to resume if it is interrupted",
+)
+parser.add_argument(
+    "--compress",
+    action="store",
+    choices=["none", "gzip", "zstd"],
+    default="none",
+    help="Compression to use with --compact (default none). zstd needs the 'zstandard' package",
+)
 parser.add_argument(
     "--config",
     action="store",
@@ -51,33 +63,99 @@ parser.add_argument(
     default="config.yaml",
     help="Filepath of your config file, absolute or relative to the current directory. If no --config path is provided, ephemetoot will use 'config.yaml'in the current directory",
 )
+parser.add_argument(
+    "--daemon",
+    action="store",
+    metavar="minutes",
+    nargs="?",
+    const=60,
+    type=float,
+    help="Keep running, checking each account every 60 minutes or the given number of minutes. Implies --state",
+)
 parser.add_argument(
     "--datestamp",
     action="store_true",
     help="Include a datetime stamp for every action (e.g. deleting a toot)",
 )
+parser.add_argument(
+    "--execute-plan",
+    action="store",
+    metavar="filepath",
+    help="Delete the toots listed in a plan saved by --test --plan, without checking the whole timeline again",
+)
+parser.add_argument(
+    "--expiry-queue",
+    action="store_true",
+    help="Queue new toots to be removed when they expire, instead of checking the whole timeline each time. Implies --state",
+)
+parser.add_argument(
+    "--export",
+    action="store",
+    metavar="filepath",
+    help="Check toots from a Mastodon account export (zip file or extracted directory) instead of fetching them all from the server. Only the account the export belongs to is checked",
+)
 parser.add_argument(
     "--hide-skipped",
     "--hide_skipped",
     action="store_true",
     help="Do not write to log when skipping saved toots",
 )
+parser.add_argument(
+    "--instance-workers",
+    action="store",
+    metavar="number",
+    default=2,
+    type=int,
+    help="With --workers, the maximum number of accounts on the same server to check at the same time (default 2)",
+)
 parser.add_argument(
     "--init",
     action="store_true",
     help="Create a config file that is saved in the current directory",
 )
+parser.add_argument(
+    "--log-format",
+    action="store",
+    choices=["text", "json"],
+    default="text",
+    help="Log as human readable text (the default) or as one JSON object per line",
+)
+parser.add_argument(
+    "--metrics",
+    action="store",
+    metavar="filepath",
+    help="Write counters and timings for each account to this file at the end of the run: a Prometheus textfile if it ends with '.prom', otherwise JSON",
+)
 parser.add_argument(
     "--pace",
     action="store_true",
     help="Slow deletion actions to match API rate limit to avoid pausing",
 )
+parser.add_argument(
+    "--plan",
+    action="store",
+    metavar="filepath",
+    help="With --test, save the toots that would have been deleted to this file, so that --execute-plan can delete them later",
+)
+parser.add_argument(
+    "--pool-size",
+    action="store",
+    metavar="number",
+    default=10,
+    type=int,
+    help="Number of connections to keep open to each server, shared by all the accounts on it (default 10)",
+)
 parser.add_argument(
     "-q",
     "--quiet",
     action="count",
     help="Limits logging to one line per account. Use -qq to limit logging to accounts with deleted toots and -qqq to completely suppress logging.",
 )
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Carry on from where an interrupted run got to, using the checkpoints saved in the --state file",
+)
 parser.add_argument(
     "--retry-mins",
     action="store",
@@ -96,6 +174,14 @@ parser.add_argument(
     const=".",
     help="Save and load plist file on MacOS",
 )
+parser.add_argument(
+    "--state",
+    action="store",
+    metavar="filepath",
+    nargs="?",
+    const="ephemetoot.state.json",
+    help="Remember how far each account was checked, and only check newer toots next time. Saved to 'ephemetoot.state.json' in the current directory unless a filepath is provided",
+)
 parser.add_argument(
     "--test", action="store_true", help="Do a test run without deleting any toots"
 )
@@ -116,36 +202,144 @@ parser.add_argument(
     action="store_true",
     help="Display the version numbers of the installed and latest versions",
 )
+parser.add_argument(
+    "--workers",
+    action="store",
+    metavar="number",
+    default=1,
+    type=int,
+    help="Number of accounts to check at the same time. Output for each account is printed together when it finishes",
+)
+
 
-options = parser.parse_args()
-if options.config[0] == "~":
-    config_file = os.path.expanduser(options.config)
-elif options.config[0] == "/":
-    # make sure user isn't passing in something dodgy
-    if os.path.exists(options.config):
-        config_file = options.config
+def parse_options(args=None):
+    """
+    Parse the command line, and replace options.config and the other filepaths with absolute paths.
+    """
+    options = parser.parse_args(args)
+    if options.config[0] == "~":
+        options.config = os.path.expanduser(options.config)
+    elif options.config[0] == "/":
+        # make sure user isn't passing in something dodgy
+        if not os.path.exists(options.config):
+            options.config = ""
     else:
-        config_file = ""
-else:
-    config_file = os.path.join(os.getcwd(), options.config)
+        options.config = os.path.join(os.getcwd(), options.config)
+
+    if options.daemon is not None and (options.execute_plan or options.export):
+        parser.error("--daemon can't be used with --execute-plan or --export")
+
+    if options.expiry_queue and (options.execute_plan or options.export):
+        parser.error("--expiry-queue can't be used with --execute-plan or --export")
+
+    if (
+        options.resume or options.daemon is not None or options.expiry_queue
+    ) and not options.state:
+        options.state = "ephemetoot.state.json"
+
+    if options.state:
+        options.state = os.path.abspath(os.path.expanduser(options.state))
+
+    if options.metrics:
+        options.metrics = os.path.abspath(os.path.expanduser(options.metrics))
+
+    if options.plan:
+        if not options.test:
+            parser.error("--plan can only be used with --test")
+        options.plan = os.path.abspath(os.path.expanduser(options.plan))
+
+    return options
+
+
+def check_export(users, options, export_path):
+    """
+    Check the account in the config file that the export belongs to.
+    """
+    from ephemetoot import ephemetoot as func
+    from ephemetoot import export
+
+    try:
+        actor = export.read_actor(export_path)
+    except (OSError, ValueError, KeyError) as e:
+        print("🛑 Can't read the account details from the export -", e)
+        return
 
+    matching = [user for user in users if export.matches(actor, user)]
+    if not matching:
+        print(
+            "🛑 The export is for @" + actor[0] + "@" + actor[1],
+            "but that account isn't in your config file",
+        )
+    for user in matching:
+        func.check_export(user, options, export_path)
 
-def main():
+
+def execute_plan(users, options, plan_path):
+    """
+    Carry out the saved plan for each account in the config file.
+    """
+    from ephemetoot import ephemetoot as func
+    from ephemetoot import plan
+    from ephemetoot import state
+
+    try:
+        with open(plan_path) as f:
+            saved = json.load(f)
+    except (OSError, ValueError) as e:
+        print("🛑 Can't read the plan -", e)
+        return
+
+    for user in users:
+        if state.account_key(user) in saved:
+            func.execute_plan(user, options, plan.toots(saved, user))
+        elif not options.quiet:
+            print("No plan for @" + state.account_key(user) + ", skipping\n")
+
+
+def package_version():
+    from importlib.metadata import version
+
+    return version("ephemetoot")
+
+
+def main(args=None):
     """
     Call ephemetoot.check_toots() on each user in the config file, with options set via flags from command line.
     """
+    options = parse_options(args)
+
     try:
 
         if options.init:
-            func.init()
+            commands.init()
         elif options.version:
-            func.version(vnum)
+            commands.version(package_version())
         elif options.schedule:
-            func.schedule(options)
+            commands.schedule(options)
+        elif options.compact:
+            from ephemetoot import archive
+
+            try:
+                archive.compact_archive(
+                    os.path.expanduser(options.compact), codec=options.compress
+                )
+            except (ImportError, ValueError) as e:
+                print("🛑", e)
         else:
-            if not options.quiet:
+            from ephemetoot import daemon
+            from ephemetoot import ephemetoot as func
+            from ephemetoot import metrics
+
+            # stop cleanly, saving checkpoints, if the process is terminated
+            signal.signal(signal.SIGTERM, func.handle_sigterm)
+
+            if not options.quiet and options.log_format == "text":
                 print("")
-                print("============= EPHEMETOOT v" + vnum + " ================")
+                print(
+                    "============= EPHEMETOOT v"
+                    + package_version()
+                    + " ================"
+                )
                 print(
                     "Running at "
                     + str(
@@ -154,16 +348,41 @@ def main():
                 )
                 print("================================================")
                 print("")
-            if options.test:
+            if options.test and options.log_format == "text":
                 print("This is a test run...\n")
-            with open(config_file) as config:
-                for accounts in yaml.safe_load_all(config):
-                    for user in accounts:
-                        func.check_toots(user, options)
+            users = config.load_users(options.config, options.log_format)
+            try:
+                if options.daemon is not None:
+                    daemon.run(options.config, options)
+                elif options.execute_plan:
+                    execute_plan(
+                        users, options, os.path.expanduser(options.execute_plan)
+                    )
+                elif options.export:
+                    check_export(users, options, os.path.expanduser(options.export))
+                elif options.workers > 1:
+                    func.check_accounts(users, options)
+                else:
+                    for user in users:
+                        if func.abort.is_set():
+                            break  # stopped by SIGTERM
+                        func.check_account(user, options)
+            finally:
+                # media is archived in the background, so wait for it to finish
+                func.finish_archiving(options)
+                func.close_sessions()
+                if options.metrics:
+                    metrics.write(options.metrics)
+
+    except config.ConfigError as err:
+        print("\n⚠️  There are problems with your config file:")
+        for problem in err.errors:
+            print("  -", problem)
+        print("Nothing has been checked. Fix these and try again\n")
 
     except FileNotFoundError as err:
 
-        if err.filename == config_file:
+        if err.filename == options.config:
             print("🕵️  Missing config file")
             print("Run \033[92mephemetoot --init\033[0m to create a new one\n")
 
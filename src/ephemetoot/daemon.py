@@ -0,0 +1,155 @@
+# standard library
+import os
+import signal
+import time
+
+# local
+from ephemetoot import ephemetoot as func
+from ephemetoot import expiry
+from ephemetoot import metrics
+from ephemetoot import state
+from ephemetoot.config import ConfigError, load_users
+
+# how often to look for changes to the config file while waiting for the next account
+CONFIG_POLL_SECONDS = 30
+
+# with --expiry-queue, the soonest an account is checked again, even if its queue is overdue
+# (e.g. because the server is down)
+QUEUE_RETRY_SECONDS = 60
+
+
+def interval(config, options):
+    """
+    Seconds between checks of this account: interval_mins from its config if there is one, otherwise the value given with --daemon.
+    """
+    return 60 * float(config.get("interval_mins", options.daemon))
+
+
+class Schedule:
+    """
+    When each account in the config file is next due to be checked. Accounts are known by username@base_url, so when the config file is reloaded, accounts that are still in it keep their place, and new accounts are checked straight away.
+    """
+
+    def __init__(self):
+        self.accounts = {}  # key -> config, in config file order
+        self.due = {}  # key -> time.monotonic() when it is next due
+
+    def load(self, users, now):
+        self.accounts = {state.account_key(config): config for config in users}
+        for key in list(self.due):
+            if key not in self.accounts:
+                del self.due[key]
+        for key in self.accounts:
+            self.due.setdefault(key, now)
+
+    def next_due(self):
+        return min(self.due.values(), default=None)
+
+    def pop_due(self, now):
+        """
+        Returns the configs of every account that is due, in config file order.
+        """
+        due = [key for key in self.accounts if self.due[key] <= now]
+        for key in due:
+            del self.due[key]
+        return [self.accounts[key] for key in due]
+
+    def done(self, config, options, now, wait=None):
+        """
+        Schedule the next check of an account after its interval, or after wait seconds if that is sooner (e.g. when the next toot in its expiry queue is due).
+        """
+        key = state.account_key(config)
+        if key in self.accounts:
+            seconds = interval(self.accounts[key], options)
+            if wait is not None:
+                seconds = min(seconds, max(0, wait))
+            self.due[key] = now + seconds
+
+
+def config_mtime(config_file):
+    try:
+        return os.stat(config_file).st_mtime_ns
+    except OSError:
+        return None
+
+
+def next_wait(config, options):
+    """
+    With --expiry-queue, the seconds until the next toot in the account's queue expires, so it is removed on time rather than at the next interval.
+    """
+    if not options.expiry_queue:
+        return None
+    expires = expiry.next_expiry(options.state, config)
+    if expires is None:
+        return None
+    return max(QUEUE_RETRY_SECONDS, expires - time.time())
+
+
+def run(config_file, options):
+    """
+    Keep running, checking each account whenever its interval has passed. The config file is only read again when it changes, and connections to each server stay open between checks.
+    """
+    schedule = Schedule()
+    schedule.load(load_users(config_file, options.log_format), time.monotonic())
+    loaded = config_mtime(config_file)
+
+    # stop the whole daemon on Ctrl-C, not just the account being checked
+    interrupt_handler = signal.signal(signal.SIGINT, func.handle_sigterm)
+    try:
+        while not func.abort.is_set():
+            modified = config_mtime(config_file)
+            if modified != loaded:
+                loaded = modified
+                try:
+                    schedule.load(
+                        load_users(config_file, options.log_format), time.monotonic()
+                    )
+                    if options.log_format == "json" and not options.quiet:
+                        func.json_event("config_reloaded")
+                    elif not options.quiet:
+                        print("🔄 Reloaded the config file\n")
+                except (OSError, ConfigError) as e:
+                    if options.log_format == "json":
+                        func.json_event(
+                            "error",
+                            error="cannot reload the config file",
+                            detail=str(e),
+                        )
+                    else:
+                        print("⚠️  Can't reload the config file, keeping the old one -")
+                        print(e, "\n")
+
+            due = schedule.pop_due(time.monotonic())
+            if due:
+                if options.workers > 1 and len(due) > 1:
+                    func.check_accounts(due, options)
+                else:
+                    for config in due:
+                        if func.abort.is_set():
+                            break
+                        func.check_account(config, options)
+                for config in due:
+                    schedule.done(
+                        config, options, time.monotonic(), next_wait(config, options)
+                    )
+                func.report_archiving(options)
+                if options.metrics:
+                    metrics.write(options.metrics)
+                continue
+
+            wait = CONFIG_POLL_SECONDS
+            next_due = schedule.next_due()
+            if next_due is not None:
+                wait = min(wait, next_due - time.monotonic())
+            func.abort.wait(max(0, wait))
+
+    except KeyboardInterrupt:
+        func.abort.set()
+
+    finally:
+        signal.signal(signal.SIGINT, interrupt_handler)
+
+    if options.log_format == "json" and not options.quiet:
+        func.json_event("stopped")
+    elif not options.quiet:
+        print("Stopped.")
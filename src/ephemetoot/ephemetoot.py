@@ -1,11 +1,14 @@
 # standard library
-from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import copy
+from datetime import date, datetime, timezone
+import http.cookiejar
+import io
 import json
 import os
-import re
 import urllib.parse
-import subprocess
 import sys
+import threading
 import time
 
 # third party
@@ -14,332 +17,224 @@ from mastodon import (
     MastodonError,
     MastodonAPIError,
     MastodonNetworkError,
-    MastodonRatelimitError,
+    MastodonNotFoundError,
 )
 import requests
+import requests.adapters
 
 # local
-from ephemetoot import plist
-
-
-def compulsory_input(tags, name, example):
-
-    value = ""
-    while len(value) < 1:
-        if example:
-            value = input(tags[0] + name + tags[1] + example + tags[2])
-        else:
-            value = input(tags[0] + name + tags[2])
-
-        sanitised = sanitise_input(value, name, tags)
-
-        if len(value) > 0 and (sanitised == "ok" or sanitised == None):
-            return value
-        else:
-            if len(value) > 0 and sanitised != None:
-                print(sanitised)
-            value = ""
-
-
-def digit_input(tags, name, example):
-
-    value = ""
-    while value.isdigit() == False:
-        if example:
-            value = input(tags[0] + name + tags[1] + example + tags[2])
-        else:
-            value = input(tags[0] + name + tags[2])
-
-    return value
-
-
-def yes_no_input(tags, name):
-    value = ""
-    while value not in ["y", "n"]:
-        value = input(tags[0] + name + tags[1] + "(y or n):" + tags[2])
-    return_val = "true" if value == "y" else "false"
-    return return_val
-
-
-def optional_input(tags, name, example):
-
-    incomplete = True
-    while incomplete:
-        value = input(tags[0] + name + tags[1] + example + tags[2])
-        sanitised = sanitise_input(value, name, tags)
-        if len(value) > 0 and (sanitised == "ok" or sanitised == None):
-            incomplete = False
-            return value
-        elif len(value) > 0 and sanitised != None:
-            print(sanitised)
-        else:
-            return ""
+from ephemetoot import archive
+from ephemetoot import expiry
+from ephemetoot import export
+from ephemetoot import metrics
+from ephemetoot import plan
+from ephemetoot import retry
+from ephemetoot import state
+from ephemetoot.policy import DELETE, KEEP, KEEP_REASONS, UNBOOST, compile_policy
+
+# set when a concurrent run is interrupted, so that worker threads stop between toots
+abort = threading.Event()
+
+# number of media attachments to download at the same time when archiving
+MEDIA_WORKERS = 4
+
+# media files are downloaded in pieces of this many bytes, so large videos don't fill memory
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+# log messages for each event, only filled in when the message is actually printed
+MESSAGES = {
+    "skip_pinned": "📌 skipping pinned toot - {id}",
+    "skip_saved": "💾 skipping saved toot - {id}",
+    "skip_visibility": "👀 skipping {visibility} toot - {id}",
+    "skip_hashtag": "#️⃣  skipping toot with hashtag - {id}",
+    "unboost": "👎 unboosting toot {id} boosted {date}",
+    "delete": "❌ deleting toot {id} tooted {date}",
+    "gone": "👻 toot {id} was already deleted",
+    "retry": "Attempt {attempt} at {now}",
+    "retry_wait": "Waiting {seconds} seconds before re-trying",
+}
+
+
+def archive_toot_media(archive_path, full_url, session=None):
+    url = urllib.parse.urlparse(full_url)
+    (dir_name, file_name) = os.path.split(url.path)
+    media_archive_path = os.path.join(archive_path, url.netloc, dir_name[1:])
+    media_archive_file_path = os.path.join(media_archive_path, file_name)
+    if os.path.isfile(media_archive_file_path):
+        return
+    os.makedirs(media_archive_path, exist_ok=True)
+    download_media(full_url, media_archive_file_path, session)
 
 
-def sanitise_input(value, input_type, tags):
+def store_toot_media(store_path, full_url, session=None):
     """
-    Check that data entered when running --init complies with requirements
+    Download a media attachment into the content-addressed media_store.
     """
-
-    if input_type == "Username":
-        return (
-            "Do not include '@' in username, please try again"
-            if value.startswith("@")
-            else "ok"
-        )
-
-    if input_type == "Base URL":
-        error = value.startswith("http") or value.find(".") == -1
-        return (
-            "Provide full domain without protocol prefix (e.g. "
-            + tags[1]
-            + "example.social"
-            + tags[2]
-            + ", not "
-            + tags[1]
-            + "http://example.social"
-            + tags[2]
-            + ")"
-            if error
-            else "ok"
-        )
-
-    if input_type == "Toots to keep":
-        l = value.split(",")
-
-        def check(s):
-            d = s.strip()
-            if not d.isdigit():
-                return False
-
-        allnum = map(check, l)
-        return (
-            "Toot IDs must be numeric and separated with commas"
-            if False in list(allnum)
-            else "ok"
-        )
-
-    if input_type == "Hashtags to keep":
-        l = value.split(",")
-
-        def check(s):
-            d = s.strip()
-            if d.isdigit():
-                return False
-            if not re.fullmatch(r"[\w]+", d, flags=re.IGNORECASE):
-                return False
-
-        complies = map(check, l)
-        return_string = (
-            "Hashtags must not include '#' and must match rules at "
-            + tags[0]
-            + "https://docs.joinmastodon.org/user/posting/#hashtags"
-            + tags[2]
-        )
-        return return_string if False in list(complies) else "ok"
-
-    if input_type == "Visibility to keep":
-        l = value.split(",")
-        viz_options = set(["public", "unlisted", "private", "direct"])
-
-        def check(s):
-            d = [s.strip().lower()]
-            intersects = viz_options.intersection(d)
-            if len(intersects) == 0:
-                return False
-
-        complies = map(check, l)
-        return_string = "Valid values are one or more of 'public', 'unlisted', 'private' or 'direct'"
-        return return_string if False in list(complies) else "ok"
-
-    if input_type == "Archive path":
-        path = (
-            os.path.expanduser(value)
-            if len(str(value)) > 0 and str(value)[0] == "~"
-            else value
-        )
-        response = (
-            "ok"
-            if os.path.exists(path)
-            else "That directory does not exist, please try again"
-        )
-        return response
+    store = archive.open_media_store(store_path)
+    if full_url in store:
+        return
+    temp_path = store.temp_path(full_url)
+    download_media(full_url, temp_path, session)
+    store.add(full_url, temp_path)
 
 
-def init():
+def download_media(full_url, file_path, session=None):
     """
-    Creates a config.yaml file in the current directory, based on user input.
+    The file is streamed to a temporary '.part' file and only renamed to file_path once it is complete, so a crash never leaves a truncated file that looks finished. If a '.part' file is left over from an earlier run, only the rest of the file is requested.
     """
-    try:
-
-        # text colour markers (beginning, example, end)
-        tags = ("\033[96m", "\033[2m", "\033[0m")
-
-        print("\nCreate your config.yaml file.\n")
-        print(
-            "For help check out the docs at ",
-            tags[0],
-            "ephemetoot.hugh.run",
-            tags[2],
-            "\n",
-            sep="",
+    partial_path = file_path + ".part"
+    offset = os.path.getsize(partial_path) if os.path.isfile(partial_path) else 0
+    headers = {"Range": "bytes=" + str(offset) + "-"} if offset else {}
+
+    getter = session if session else requests
+    with getter.get(full_url, headers=headers, stream=True, timeout=60) as r:
+        if r.status_code == 416:
+            # the partial file doesn't match what the server has, so start again
+            os.remove(partial_path)
+            return download_media(full_url, file_path, session)
+        r.raise_for_status()
+
+        if r.status_code != 206:
+            offset = 0  # the server sent the whole file
+
+        # we can only check the size if the server isn't compressing the download
+        expected_size = None
+        if "Content-Length" in r.headers and r.headers.get(
+            "Content-Encoding", "identity"
+        ) in ("identity", ""):
+            expected_size = offset + int(r.headers["Content-Length"])
+
+        with open(partial_path, "ab" if offset else "wb") as f:
+            for chunk in r.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                f.write(chunk)
+
+    size = os.path.getsize(partial_path)
+    if expected_size is not None and size != expected_size:
+        raise IOError(
+            "Download incomplete ("
+            + str(size)
+            + " of "
+            + str(expected_size)
+            + " bytes), will resume next time"
         )
 
-        conf_token = compulsory_input(tags, "Access token: ", None)
-        conf_user = compulsory_input(
-            tags, "Username", "(without the '@' - e.g. alice):"
-        )
-        conf_url = compulsory_input(tags, "Base URL", "(e.g. example.social):")
-        conf_days = digit_input(tags, "Days to keep", "(default 365):")
-        conf_pinned = yes_no_input(tags, "Keep pinned toots?")
-        conf_boosts_only = yes_no_input(tags, "Only remove boosted toots?")
-        conf_keep_toots = optional_input(
-            tags, "Toots to keep", "(optional list of IDs separated by commas):"
-        )
-        conf_keep_hashtags = optional_input(
-            tags,
-            "Hashtags to keep",
-            "(optional list without '#' e.g. mastodon, gardening, cats):",
-        )
-        conf_keep_visibility = optional_input(
-            tags, "Visibility to keep", "(optional list e.g. 'direct'):"
-        )
-        conf_archive = optional_input(
-            tags, "Archive path", "(optional filepath for archive):"
-        )
+    os.replace(partial_path, file_path)
 
-        if len(conf_archive) > 0:
-            conf_archive_media = yes_no_input(tags, "Archive media?")
 
-        # write out the config file
-        with open("config.yaml", "w") as configfile:
+class MediaArchiver:
+    """
+    Downloads media attachments in the background, so that toots can keep being checked while files download. A small pool of threads shares one keep-alive session for each media host, rather than opening a new connection for every file.
+    """
 
-            configfile.write("-")
-            configfile.write("\n  access_token: " + conf_token)
-            configfile.write("\n  username: " + conf_user)
-            configfile.write("\n  base_url: " + conf_url)
-            configfile.write("\n  days_to_keep: " + conf_days)
-            configfile.write("\n  keep_pinned: " + conf_pinned)
-            configfile.write("\n  boosts_only: " + conf_boosts_only)
+    def __init__(self, workers=MEDIA_WORKERS):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.sessions = {}
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def session(self, host):
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.workers)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def submit(self, archive_path, full_url, media_store=None):
+        """
+        Queue a file to be downloaded into archive_path, or into the media_store if one is provided.
+        """
+        if media_store:
+            media_store = archive.media_store_path(media_store)
+        key = (media_store or archive_path, full_url)
+        with self.lock:
+            # the same file may be attached to more than one toot
+            if key in self.futures:
+                return
+            self.futures[key] = None
+        session = self.session(urllib.parse.urlparse(full_url).netloc)
+        if media_store:
+            future = self.pool.submit(store_toot_media, media_store, full_url, session)
+        else:
+            future = self.pool.submit(
+                archive_toot_media, archive_path, full_url, session
+            )
+        with self.lock:
+            self.futures[key] = future
+
+    def report(self, options=None):
+        """
+        Report any downloads that failed, and forget the ones that have finished, so that a long-running --daemon doesn't hold on to every download it has made.
+        """
+        with self.lock:
+            finished = [
+                (key, future)
+                for key, future in self.futures.items()
+                if future and future.done()
+            ]
+            for key, future in finished:
+                del self.futures[key]
+        for (target, full_url), future in finished:
+            error = future.exception()
+            if not error:
+                continue
+            if options is not None and options.log_format == "json":
+                json_event(
+                    "error",
+                    error="cannot archive media",
+                    url=full_url,
+                    detail=str(error),
+                )
+            else:
+                print("🛑 ERROR archiving media -", full_url, "-", error)
 
-            if len(conf_keep_toots) > 0:
-                keep_list = conf_keep_toots.split(",")
-                configfile.write("\n  toots_to_keep:")
-                for toot in keep_list:
-                    configfile.write("\n    - " + toot.strip())
+    def finish(self, options=None):
+        """
+        Wait for all downloads to finish, and report any that failed.
+        """
+        self.pool.shutdown(wait=True)
+        self.report(options)
+        for session in self.sessions.values():
+            session.close()
 
-            if len(conf_keep_hashtags) > 0:
-                tag_list = conf_keep_hashtags.split(",")
-                configfile.write("\n  hashtags_to_keep:")
-                for tag in tag_list:
-                    configfile.write("\n    - " + tag.strip())
 
-            if len(conf_keep_visibility) > 0:
-                viz_list = conf_keep_visibility.split(",")
-                configfile.write("\n  visibility_to_keep:")
-                for mode in viz_list:
-                    configfile.write("\n    - " + mode.strip())
+# shared by every account in a run, and created when the first file is archived
+media_archiver = None
+media_archiver_lock = threading.Lock()
 
-            if len(conf_archive) > 0:
-                configfile.write("\n  archive: " + conf_archive)
-                configfile.write("\n  archive_media: " + conf_archive_media)
 
-            configfile.close()
+def get_media_archiver():
+    global media_archiver
+    with media_archiver_lock:
+        if media_archiver is None:
+            media_archiver = MediaArchiver()
+        return media_archiver
 
-    except Exception as e:
-        print(e)
 
-
-def version(vnum):
+def finish_archiving(options=None):
     """
-    Prints current and latest version numbers to console.
+    Wait for any media downloads still running in the background, and close packed archives. Call this before exiting.
     """
-
-    try:
-        latest = requests.get(
-            "https://api.github.com/repos/hughrun/ephemetoot/releases/latest"
-        )
-        res = latest.json()
-        latest_version = res["tag_name"]
-        print("\nephemetoot ==> 🥳 ==> 🧼 ==> 😇")
-        print("-------------------------------")
-        print("You are using release: \033[92mv", vnum, "\033[0m", sep="")
-        print("The latest release is: \033[92m" + latest_version + "\033[0m")
-        print(
-            "To upgrade to the most recent version run \033[92mpip install --upgrade ephemetoot\033[0m"
-        )
-
-    except Exception as e:
-        print("Something went wrong:", e)
+    global media_archiver
+    with media_archiver_lock:
+        archiver = media_archiver
+        media_archiver = None
+    if archiver:
+        archiver.finish(options)
+    archive.close_archives()
 
 
-def schedule(options):
+def report_archiving(options=None):
     """
-    Creates and loads a plist file for scheduled running with launchd. If --time flag is used, the scheduled time is set accordingly. Note that this is designed for use on MacOS.
+    Report media downloads that have finished since the last call, without waiting for the rest. --daemon calls this after each round of checks.
     """
-    try:
-
-        if options.schedule == ".":
-            working_dir = os.getcwd()
-        else:
-            working_dir = options.schedule
-
-        lines = plist.default_file.splitlines()
-        lines[7] = "  <string>" + working_dir + "</string>"
-        lines[10] = "    <string>" + sys.argv[0] + "</string>"
-        lines[12] = "    <string>" + working_dir + "/config.yaml</string>"
-        lines[15] = "  <string>" + working_dir + "/ephemetoot.log</string>"
-        lines[17] = "  <string>" + working_dir + "/ephemetoot.error.log</string>"
-
-        if options.time:
-            lines[21] = "    <integer>" + options.time[0] + "</integer>"
-            lines[23] = "    <integer>" + options.time[1] + "</integer>"
-
-        # write out file directly to ~/Library/LaunchAgents
-        f = open(
-            os.path.join(
-                os.path.expanduser("~/Library/LaunchAgents"),
-                "ephemetoot.scheduler.plist",
-            ),
-            mode="w",
-        )
-        for line in lines:
-            if line == lines[-1]:
-                f.write(line)
-            else:
-                f.write(line + "\n")
-        f.close()
-        sys.tracebacklimit = 0  # suppress Tracebacks
-        # unload any existing file (i.e. if this is an update to the file) and suppress any errors
-        subprocess.run(
-            ["launchctl unload ~/Library/LaunchAgents/ephemetoot.scheduler.plist"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            shell=True,
-        )
-        # load the new file
-        subprocess.run(
-            ["launchctl load ~/Library/LaunchAgents/ephemetoot.scheduler.plist"],
-            shell=True,
-        )
-        print("⏰ Scheduled!")
-    except Exception as e:
-        print("🙁 Scheduling failed.", e)
-        if options.verbose:
-            print(e)
-
-
-def archive_toot_media(archive_path, full_url):
-    url = urllib.parse.urlparse(full_url)
-    (dir_name, file_name) = os.path.split(url.path)
-    media_archive_path = os.path.join(archive_path, url.netloc, dir_name[1:])
-    media_archive_file_path = os.path.join(media_archive_path, file_name)
-    if os.path.isfile(media_archive_file_path):
-        return
-    os.makedirs(media_archive_path, exist_ok=True)
-    r = requests.get(full_url)
-    with open(media_archive_file_path, "wb") as f:
-        f.write(r.content)
+    with media_archiver_lock:
+        archiver = media_archiver
+    if archiver:
+        archiver.report(options)
 
 
 def archive_toot(config, toot):
@@ -355,17 +250,34 @@ def archive_toot(config, toot):
     if archive_path[-1] != "/":
         archive_path += "/"
 
-    filename = os.path.join(archive_path, str(toot.id) + ".json")
+    archive_format = config["archive_format"] if "archive_format" in config else "json"
+
+    if archive_format == "jsonl":
+        # append to a packed archive, skipping toots that are already in it
+        packed = archive.open_archive(archive_path)
+        if toot.id not in packed:
+            packed.append(
+                toot.id, json.dumps(toot, separators=(",", ":"), default=jsondefault)
+            )
+
+    elif archive_format == "json":
+        filename = os.path.join(archive_path, str(toot.id) + ".json")
+
+        # write to file
+        with open(filename, "w") as f:
+            f.write(json.dumps(toot, indent=4, default=jsondefault))
+            f.close()
 
-    # write to file
-    with open(filename, "w") as f:
-        f.write(json.dumps(toot, indent=4, default=jsondefault))
-        f.close()
+    else:
+        raise ValueError("archive_format must be either 'json' or 'jsonl'")
 
     if archive_media and "media_attachments" in toot:
+        media_store = config["media_store"] if "media_store" in config else None
         for media_attachment in toot["media_attachments"]:
             if "url" in media_attachment:
-                archive_toot_media(archive_path, media_attachment["url"])
+                get_media_archiver().submit(
+                    archive_path, media_attachment["url"], media_store
+                )
 
 
 def jsondefault(obj):
@@ -381,21 +293,57 @@ def datestamp_now():
     return str(datetime.now(timezone.utc).strftime("%a %d %b %Y %H:%M:%S %z"))
 
 
-def console_print(msg, options, skip):
+def log_event(options, event, toot=None, skip=False, **fields):
+    """
+    Log something that happened, as a line of text (the default) or as JSON with --log-format json. Nothing is formatted unless it is going to be printed, so skipped toots cost almost nothing with --quiet or --hide-skipped.
+    """
+    if options.quiet or (skip and options.hide_skipped):
+        return
 
-    skip_announcement = True if (options.hide_skipped and skip) else False
-    if not (skip_announcement or options.quiet):
+    if options.log_format == "json":
+        json_event(event, toot, **fields)
+        return
 
-        if options.datestamp:
-            msg = datestamp_now() + " : " + msg
+    template = MESSAGES[event]
+    if toot is not None:
+        fields["id"] = toot.id
+        if "{visibility}" in template:
+            fields["visibility"] = toot.visibility
+        if "{date}" in template:
+            fields["date"] = tooted_date(toot)
+    if "{now}" in template:
+        fields["now"] = datestamp_now()
+    msg = template.format(**fields)
+
+    if options.datestamp:
+        msg = datestamp_now() + " : " + msg
+
+    print(msg)
+
+
+def json_event(event, toot=None, **fields):
+    """
+    Print one event as a line of JSON, for --log-format json.
+    """
+    record = {"time": datetime.now(timezone.utc).isoformat(), "event": event}
+    account = metrics.current().account
+    if account:
+        record["account"] = account
+    if toot is not None:
+        record["id"] = str(toot.id)
+        record["created_at"] = toot.created_at.isoformat()
+    record.update(fields)
+    print(json.dumps(record, ensure_ascii=False, default=jsondefault))
 
-        print(msg)
 
+def print_rate_limit_message(reset, options=None):
 
-def print_rate_limit_message(mastodon):
+    if options is not None and options.log_format == "json":
+        json_event("rate_limit", reset=datetime.fromtimestamp(reset, timezone.utc))
+        return
 
     now = time.time()
-    diff = mastodon.ratelimit_reset - now
+    diff = reset - now
 
     print(
         "\nRate limit reached at",
@@ -406,213 +354,387 @@ def print_rate_limit_message(mastodon):
     )
 
 
-def retry_on_error(options, mastodon, toot, attempts=0):
+class DeleteScheduler:
+    """
+    Paces delete and unboost calls using the rate limit the server reports for them. Mastodon counts deletes separately from other API calls, so the limit is read from the client straight after each delete, in the same thread. The next page of the timeline is fetched at the same time in another thread, but with its own copy of the client (see paging_client()), so it can't overwrite the delete limit. Deletes go out as fast as the remaining budget allows, and when it runs out we wait until exactly when the server says it will reset.
+    """
 
-    if attempts < 6:
+    def __init__(self, mastodon, options):
+        self.mastodon = mastodon
+        self.options = options
+        self.remaining = None
+        self.reset = None
+
+    def record(self):
+        """
+        Call after each delete or unboost, to note the budget left for the next one. Only call this from the thread that made the delete.
+        """
+        remaining = getattr(self.mastodon, "ratelimit_remaining", None)
+        reset = getattr(self.mastodon, "ratelimit_reset", None)
+        if isinstance(remaining, (int, float)) and isinstance(reset, (int, float)):
+            self.remaining = remaining
+            self.reset = reset
+
+    def wait(self):
+        """
+        Call before each delete or unboost. Sleeps only if the budget is used up.
+        """
+        if self.remaining is None or self.remaining > 0:
+            return
+
+        wait_secs = self.reset - time.time()
+        if wait_secs > 0:
+            if not self.options.quiet:
+                print_rate_limit_message(self.reset, self.options)
+            metrics.current().count("rate_limit_waits")
+            with metrics.current().timer("rate_limit_wait"):
+                time.sleep(wait_secs)
+
+        # the server has given us a new budget, but we don't know its size until the next call
+        self.remaining = None
+
+
+def wait_to_retry(options, mastodon, error, attempt):
+    """
+    Sleep before retry number attempt after error. Each wait is longer than the last (see retry.py), and the server's Retry-After header or rate limit reset time is honoured. Raises CircuitOpenError instead if the server has stopped responding to every account on it.
+    """
+    server = retry.server_of(getattr(mastodon, "api_base_url", None))
+    if not retry.breaker(server).allow():
+        raise retry.CircuitOpenError(server)
+
+    account_metrics = metrics.current()
+    seconds = retry.wait_time(
+        error,
+        attempt,
+        options.retry_mins,
+        server,
+        getattr(mastodon, "ratelimit_reset", None),
+    )
+    if retry.is_rate_limit(error):
+        if not options.quiet:
+            print_rate_limit_message(time.time() + seconds, options)
+        account_metrics.count("rate_limit_waits")
+        with account_metrics.timer("rate_limit_wait"):
+            time.sleep(seconds)
+    else:
+        log_event(options, "retry_wait", seconds=round(seconds))
+        account_metrics.count("retries")
+        with account_metrics.timer("retry_wait"):
+            time.sleep(seconds)
+
+
+def call_with_retry(options, mastodon, method, *args, **kwargs):
+    """
+    Call a Mastodon API method, and if it fails with an error that trying again might fix, try the same call again (e.g. for the same page of the timeline) rather than starting the whole account again. Raises the last error after retry.MAX_ATTEMPTS attempts.
+    """
+    breaker = retry.breaker(retry.server_of(getattr(mastodon, "api_base_url", None)))
+    attempts = 1
+    while True:
         try:
-            console_print(
-                "Attempt " + str(attempts) + " at " + datestamp_now(), options, False
-            )
-            mastodon.status_delete(toot)
-        except:
+            result = method(*args, **kwargs)
+        except MastodonError as e:
+            if retry.policy_for(e) is None or attempts >= retry.MAX_ATTEMPTS:
+                raise
+            # a rate limit means the server is working
+            if not retry.is_rate_limit(e):
+                breaker.failure()
+            wait_to_retry(options, mastodon, e, attempts)
             attempts += 1
-            time.sleep(60 * options.retry_mins)
-            retry_on_error(options, mastodon, toot, attempts)
-    else:
-        raise TimeoutError("Gave up after 5 attempts")
+        else:
+            if attempts > 1:
+                breaker.success()
+            return result
 
 
-def process_toot(config, options, mastodon, toot, deleted_count=0):
+def retry_on_error(options, mastodon, toot, attempts=0, error=None):
+    """
+    Try again to delete or unboost a toot, after attempts that failed with error. Gives up with TimeoutError once there have been retry.MAX_ATTEMPTS attempts, or with CircuitOpenError as soon as the server stops responding to every account on it. Errors that won't be fixed by trying again are not retried, and are returned instead. Returns None once the toot is gone.
+    """
+    breaker = retry.breaker(retry.server_of(getattr(mastodon, "api_base_url", None)))
 
-    keep_pinned = "keep_pinned" in config and config["keep_pinned"]
-    boosts_only = "boosts_only" in config and config["boosts_only"]
-    toots_to_keep = config["toots_to_keep"] if "toots_to_keep" in config else []
-    visibility_to_keep = (
-        config["visibility_to_keep"] if "visibility_to_keep" in config else []
-    )
-    hashtags_to_keep = (
-        set(config["hashtags_to_keep"]) if "hashtags_to_keep" in config else set()
-    )
-    days_to_keep = config["days_to_keep"] if "days_to_keep" in config else 365
-    cutoff_date = datetime.now(timezone.utc) - timedelta(days=days_to_keep)
+    while attempts < retry.MAX_ATTEMPTS:
+        if error is not None:
+            if retry.policy_for(error) is None:
+                return error
+            wait_to_retry(options, mastodon, error, attempts)
 
-    if toot.id and "archive" in config:
+        try:
+            log_event(options, "retry", attempt=attempts)
+            if getattr(toot, "reblog", None):
+                mastodon.status_unreblog(toot.reblog)
+            else:
+                mastodon.status_delete(toot)
+        except MastodonNotFoundError:
+            return  # the last attempt worked after all, or it was deleted some other way
+        except MastodonError as e:
+            error = e
+            attempts += 1
+            # a rate limit means the server is working
+            if not retry.is_rate_limit(e):
+                breaker.failure()
+        else:
+            breaker.success()
+            return
 
-        if not options.archive_deleted:
-            # write toot to archive
-            archive_toot(config, toot)
+    raise TimeoutError("Gave up after " + str(retry.MAX_ATTEMPTS) + " attempts")
 
-    toot_tags = set()
-    for tag in toot.tags:
-        toot_tags.add(tag.name)
 
-    try:
-        if keep_pinned and hasattr(toot, "pinned") and toot.pinned:
-            console_print("📌 skipping pinned toot - " + str(toot.id), options, True)
+def process_toot(
+    config,
+    options,
+    mastodon,
+    toot,
+    deleted_count=0,
+    kept=None,
+    scheduler=None,
+    policy=None,
+    planned=None,
+):
 
-        elif toot.id in toots_to_keep:
-            console_print("💾 skipping saved toot - " + str(toot.id), options, True)
+    # check_toots() compiles the policy once per account, but allow for calling this directly
+    if policy is None:
+        policy = compile_policy(config)
 
-        elif toot.visibility in visibility_to_keep:
-            console_print(
-                "👀 skipping " + toot.visibility + " toot - " + str(toot.id),
-                options,
-                True,
-            )
+    account_metrics = metrics.current()
+    account_metrics.count("toots_checked")
 
-        elif len(hashtags_to_keep.intersection(toot_tags)) > 0:
-            console_print(
-                "#️⃣  skipping toot with hashtag - " + str(toot.id), options, True
-            )
+    if toot.id and "archive" in config:
 
-        elif cutoff_date > toot.created_at:
-            if hasattr(toot, "reblog") and toot.reblog:
-                console_print(
-                    "👎 unboosting toot "
-                    + str(toot.id)
-                    + " boosted "
-                    + tooted_date(toot),
-                    options,
-                    False,
-                )
+        if not options.archive_deleted:
+            # write toot to archive
+            with account_metrics.timer("archiving"):
+                archive_toot(config, toot)
+
+    with account_metrics.timer("evaluating"):
+        action, reason = policy.decide(toot)
+    if action == KEEP:
+        account_metrics.count("toots_kept")
+
+    # with --test and --plan, remember what would be done so it can be done later
+    elif planned is not None:
+        planned.append(plan.entry(toot, action, reason))
+        # the plan only has the toot's ID, so --archive-deleted has to archive it now
+        if options.archive_deleted and "archive" in config:
+            with account_metrics.timer("archiving"):
+                archive_toot(config, toot)
 
-                deleted_count += 1
-                # unreblog the original toot (their toot), not the toot created by boosting (your toot)
-                if not options.test:
-                    if mastodon.ratelimit_remaining == 0:
-                        console_print(
-                            "Rate limit reached. Waiting for a rate limit reset",
-                            options,
-                            False,
-                        )
+    try:
+        if reason in KEEP_REASONS:
+            log_event(options, "skip_" + reason, toot, skip=True)
+
+        elif action == UNBOOST:
+            log_event(options, "unboost", toot)
 
-                    # check for --archive-deleted
-                    if options.archive_deleted and "id" in toot and "archive" in config:
-                        # write toot to archive
+            deleted_count += 1
+            account_metrics.count("toots_unboosted")
+            # unreblog the original toot (their toot), not the toot created by boosting (your toot)
+            if not options.test:
+                # check for --archive-deleted
+                if options.archive_deleted and "id" in toot and "archive" in config:
+                    # write toot to archive
+                    with account_metrics.timer("archiving"):
                         archive_toot(config, toot)
 
+                # deal with rate limits
+                if scheduler:
+                    scheduler.wait()
+
+                with account_metrics.timer("deleting"):
                     mastodon.status_unreblog(toot.reblog)
 
-            elif not boosts_only:
-                console_print(
-                    "❌ deleting toot " + str(toot.id) + " tooted " + tooted_date(toot),
-                    options,
-                    False,
-                )
+                if scheduler:
+                    scheduler.record()
 
-                deleted_count += 1
-                time.sleep(
-                    2
-                )  # wait 2 secs between deletes to be a bit nicer to the server
+        elif action == DELETE:
+            log_event(options, "delete", toot)
 
-                if not options.test:
-                    # deal with rate limits
-                    if mastodon.ratelimit_remaining == 0 and not options.quiet:
-                        print_rate_limit_message(mastodon)
+            deleted_count += 1
+            account_metrics.count("toots_deleted")
 
-                    # check for --archive-deleted
-                    if options.archive_deleted and "id" in toot and "archive" in config:
+            if not options.test:
+                # check for --archive-deleted
+                if options.archive_deleted and "id" in toot and "archive" in config:
+                    with account_metrics.timer("archiving"):
                         archive_toot(config, toot)
 
-                    # finally we actually delete the toot
+                # deal with rate limits
+                if scheduler:
+                    scheduler.wait()
+
+                # finally we actually delete the toot
+                with account_metrics.timer("deleting"):
                     mastodon.status_delete(toot)
 
-        # return the deleted_count back so that it can be tallied within check_batch()
-        return deleted_count
+                if scheduler:
+                    scheduler.record()
 
-    except MastodonRatelimitError:
+        # remember old toots that were kept, so that --state can skip them next time
+        if (
+            kept is not None
+            and reason in KEEP_REASONS
+            and policy.cutoff > toot.created_at
+        ):
+            kept[str(toot.id)] = reason
 
-        print_rate_limit_message(mastodon)
-        time.sleep(diff + 1)  # wait for rate limit to reset
+    except MastodonNotFoundError:
+        # e.g. deleted from the web interface after the timeline or export was read
+        log_event(options, "gone", toot)
+        deleted_count -= 1
 
     # If a server goes offline for maintenance etc halfway through a run, we don't necessarily
     # want to just error out. Handling it here allows us to give it time to sort itself out.
     except MastodonError as e:
 
-        if options.verbose:
-            print("🛑 ERROR deleting toot -", str(toot.id), "\n", e)
-        else:
-            print(
-                "🛑 ERROR deleting toot -",
-                str(toot.id),
-                "-",
-                str(e.args[0]),
-                "-",
-                str(e.args[3]),
-            )
+        # a rate limit isn't an error, just a reason to wait
+        if not retry.is_rate_limit(e):
+            account_metrics.count("errors")
+            server = retry.server_of(getattr(mastodon, "api_base_url", None))
+            retry.breaker(server).failure()
+            # network errors only have a message
+            detail = str(e.args[3]) if len(e.args) > 3 else ""
+            if options.log_format == "json":
+                json_event("error", toot, error=str(e.args[0]), detail=detail)
+            elif options.verbose:
+                print("🛑 ERROR deleting toot -", str(toot.id), "\n", e)
+            else:
+                print(
+                    "🛑 ERROR deleting toot -",
+                    str(toot.id),
+                    "-",
+                    str(e.args[0]),
+                    "-",
+                    detail,
+                )
 
-        console_print(
-            "Waiting " + str(options.retry_mins) + " minutes before re-trying",
-            options,
-            False,
-        )
-        time.sleep(60 * options.retry_mins)
-        retry_on_error(options, mastodon, toot, attempts=2)
+        if retry_on_error(options, mastodon, toot, attempts=1, error=e):
+            deleted_count -= 1
+            # with --state, try it again next time rather than leaving it behind the cutoff
+            if kept is not None:
+                kept[str(toot.id)] = "failed"
+
+    # return the deleted_count back so that it can be tallied within check_batch()
+    return deleted_count
+
+
+def is_snowflake(toot):
+    """
+    Mastodon status IDs are "snowflakes": the time the status was created, in milliseconds, shifted left by 16 bits. Older servers and other server software may use plain sequential IDs instead, so check that the ID really matches the toot's date.
+    """
+    try:
+        id_time = (int(toot.id) >> 16) / 1000
+    except (TypeError, ValueError):
+        return False
+    return abs(id_time - toot.created_at.timestamp()) < 3600
 
 
-def check_batch(config, options, mastodon, user_id, timeline, deleted_count=0):
+def snowflake_max_id(cutoff_date):
     """
-    Check a batch of up to 40 toots. This is usually triggered by check_toots, and then recursively calls itself until all toots within the time period specified have been checked.
+    The lowest possible snowflake ID for a toot created at cutoff_date. Using it as max_id returns only toots older than the cutoff.
     """
+    return int(cutoff_date.timestamp() * 1000) << 16
 
+
+def paging_client(mastodon):
+    """
+    A copy of the client for fetching pages in the background. It shares the HTTP session, but Mastodon.py keeps the rate limit from each response on the client that made the call, so pages fetched ahead don't overwrite the delete rate limit that DeleteScheduler reads.
+    """
+    return copy.copy(mastodon)
+
+
+def next_page(prefetched, mastodon, user_id, max_id):
+    """
+    Used with call_with_retry() by fetch_pages(). The first call returns the page fetched in the background, and if that failed, later calls fetch it again in this thread, so retry waits are shown and counted with this account.
+    """
+    if prefetched:
+        return prefetched.pop().result()
+    return mastodon.account_statuses(user_id, limit=40, max_id=max_id)
+
+
+def fetch_pages(options, mastodon, user_id, timeline, skip_to=None):
+    """
+    Yields the timeline one page at a time, starting with the page passed in and then fetching older pages of up to 40 toots until there are none left.
+    Each page is fetched in the background while the page before it is being checked, so the wait for the server overlaps with archiving and deleting. Each page depends on the last toot of the one before, so only one page is fetched ahead, and no more than two pages are held in memory.
+    If skip_to is provided, the next fetch jumps straight to toots with IDs lower than that. If fetching a page fails, it is fetched again from the same place.
+    """
+    account_metrics = metrics.current()
+    pager = paging_client(mastodon)
+    pool = ThreadPoolExecutor(max_workers=1)
+    prefetched = []
     try:
-        for toot in timeline:
-            # process_toot returns the value of the deleted_count so we can keep track here
-            deleted_count = process_toot(config, options, mastodon, toot, deleted_count)
-
-        # the account_statuses call is paginated with a 40-toot limit
-        # get the id of the last toot to include as 'max_id' in the next API call.
-        # then keep triggering new rounds of check_toots() until there are no more toots to check
-        max_id = timeline[-1:][0].id
-        next_batch = mastodon.account_statuses(user_id, limit=40, max_id=max_id)
-        if len(next_batch) > 0:
-            check_batch(config, options, mastodon, user_id, next_batch, deleted_count)
-        else:
-            if not options.test:
-                if options.datestamp:
-                    print("\n", datestamp_now(), end=" : ")
-
-                # options.quiet can be None
-                if (
-                    (not options.quiet)
-                    or options.quiet <= 1
-                    or (options.quiet == 2 and deleted_count)
-                ):
-                    print(
-                        "Removed "
-                        + str(deleted_count)
-                        + " toots for "
-                        + config["username"]
-                        + "@"
-                        + config["base_url"]
-                        + ".\n"
-                    )
-
-                if not options.quiet:
-                    print("---------------------------------------")
-                    print("🥳 ==> 🧼 ==> 😇 User cleanup complete!")
-                    print("---------------------------------------\n")
+        while len(timeline) > 0:
+            # the account_statuses call is paginated with a 40-toot limit
+            # get the id of the last toot to include as 'max_id' in the next API call.
+            max_id = timeline[-1].id
+            if skip_to is not None and int(max_id) > skip_to:
+                max_id = skip_to
+            prefetched.append(
+                pool.submit(pager.account_statuses, user_id, limit=40, max_id=max_id)
+            )
 
-            else:
+            yield timeline
+            with account_metrics.timer("paging"):
+                timeline = call_with_retry(
+                    options, pager, next_page, prefetched, pager, user_id, max_id
+                )
+            account_metrics.count("pages_fetched")
+    finally:
+        # if the caller stops early, don't wait for a page it won't use
+        for future in prefetched:
+            future.cancel()
+        pool.shutdown(wait=False)
 
-                if options.quiet:
-                    if options.datestamp:
-                        print("\n", datestamp_now(), sep="", end=" : ")
 
-                    print(
-                        "Test run completed. This would have removed",
-                        str(deleted_count),
-                        "toots.\n",
-                    )
+def stream_toots(pages, stop_before=None):
+    """
+    Yields each toot from a stream of pages. If stop_before is provided (with --state), stops at the first toot older than that date, because older toots were already checked by the previous run. No more pages are fetched after that.
+    """
+    for page in pages:
+        for toot in page:
+            if stop_before and stop_before > toot.created_at:
+                return
+            yield toot
+
 
-                else:
-                    print("---------------------------------------")
-                    print("🥳 ==> 🧪 ==> 📋 Test run complete!")
-                    print("This would have removed", str(deleted_count), "toots.")
-                    print("---------------------------------------\n")
+def peak_memory():
+    """
+    Returns the peak memory use of this process in MB, or None if the platform can't tell us.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, MacOS reports bytes
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def check_batch(
+    config,
+    options,
+    mastodon,
+    user_id,
+    timeline,
+    deleted_count=0,
+    stop_before=None,
+    kept=None,
+    scheduler=None,
+    policy=None,
+    planned=None,
+    checkpoint=None,
+):
+    """
+    Check every toot in the user timeline, starting with a batch of up to 40 toots from check_toots and then fetching older batches until all toots within the time period specified have been checked.
+    Batches are streamed one at a time, so memory use stays the same no matter how many toots there are.
+    """
 
-    except IndexError:
-        if not options.quiet or options.quiet <= 1:
+    if len(timeline) == 0:
+        if options.log_format == "json":
+            if not options.quiet or options.quiet <= 1:
+                json_event("finished", removed=0, test=bool(options.test))
+        elif not options.quiet or options.quiet <= 1:
             print(
                 "No toots found for "
                 + config["username"]
@@ -620,14 +742,232 @@ def check_batch(config, options, mastodon, user_id, timeline, deleted_count=0):
                 + config["base_url"]
                 + ".\n"
             )
+        return
+
+    # Toots newer than the cutoff can never be deleted, so there's no need to fetch them.
+    # We can only skip them if we aren't archiving every toot, and the server uses snowflake IDs.
+    skip_to = None
+    if policy and ("archive" not in config or options.archive_deleted):
+        if is_snowflake(timeline[0]):
+            skip_to = snowflake_max_id(policy.cutoff)
+
+    pages = fetch_pages(options, mastodon, user_id, timeline, skip_to)
+    del timeline  # don't keep the first page alive for the whole run
+
+    for toot in stream_toots(pages, stop_before):
+        if abort.is_set():
+            raise KeyboardInterrupt
+        # process_toot returns the value of the deleted_count so we can keep track here
+        deleted_count = process_toot(
+            config,
+            options,
+            mastodon,
+            toot,
+            deleted_count,
+            kept=kept,
+            scheduler=scheduler,
+            policy=policy,
+            planned=planned,
+        )
+        if checkpoint:
+            checkpoint.update(toot.id, deleted_count, kept)
+
+    print_summary(config, options, deleted_count)
 
 
-def check_toots(config, options, retry_count=0):
+def print_summary(config, options, deleted_count):
     """
-    The main function, uses the Mastodon API to check all toots in the user timeline, and delete any that do not meet any of the exclusion criteria from the config file.
+    Print how many toots were removed (or would have been removed, with --test) for an account.
     """
-    try:
+    if options.log_format == "json":
+        # one line for the account, unless using -qq with nothing removed, or -qqq
+        if (
+            (not options.quiet)
+            or options.quiet == 1
+            or (options.quiet == 2 and deleted_count)
+        ):
+            json_event(
+                "finished",
+                removed=deleted_count,
+                test=bool(options.test),
+                peak_memory_mb=peak_memory() if options.verbose else None,
+            )
+        return
+
+    if not options.test:
+        if options.datestamp:
+            print("\n", datestamp_now(), end=" : ")
+
+        # options.quiet can be None
+        if (
+            (not options.quiet)
+            or options.quiet <= 1
+            or (options.quiet == 2 and deleted_count)
+        ):
+            print(
+                "Removed "
+                + str(deleted_count)
+                + " toots for "
+                + config["username"]
+                + "@"
+                + config["base_url"]
+                + ".\n"
+            )
+
         if not options.quiet:
+            print("---------------------------------------")
+            print("🥳 ==> 🧼 ==> 😇 User cleanup complete!")
+            print("---------------------------------------\n")
+
+    else:
+
+        if options.quiet:
+            if options.datestamp:
+                print("\n", datestamp_now(), sep="", end=" : ")
+
+            print(
+                "Test run completed. This would have removed",
+                str(deleted_count),
+                "toots.\n",
+            )
+
+        else:
+            print("---------------------------------------")
+            print("🥳 ==> 🧪 ==> 📋 Test run complete!")
+            print("This would have removed", str(deleted_count), "toots.")
+            print("---------------------------------------\n")
+
+    if options.verbose and not options.quiet:
+        memory = peak_memory()
+        if memory:
+            print("Peak memory use:", format(memory, ".1f"), "MB\n")
+
+
+def recheck_kept(
+    config,
+    options,
+    mastodon,
+    user_id,
+    kept,
+    deleted_count=0,
+    scheduler=None,
+    policy=None,
+    planned=None,
+):
+    """
+    With --state, old toots that were kept last time are not fetched again with the rest of the timeline. Toots kept because they were pinned may have been unpinned since then, and toots that couldn't be removed last time may be removable now, so check those again.
+    """
+    pinned_ids = [toot_id for toot_id in kept if kept[toot_id] == "pinned"]
+    failed_ids = [toot_id for toot_id in kept if kept[toot_id] == "failed"]
+    if len(pinned_ids) == 0 and len(failed_ids) == 0:
+        return deleted_count
+
+    still_pinned = set()
+    if pinned_ids:
+        still_pinned = set(
+            str(toot.id)
+            for toot in call_with_retry(
+                options, mastodon, mastodon.account_statuses, user_id, pinned=True
+            )
+        )
+    for toot_id in pinned_ids + failed_ids:
+        if toot_id not in still_pinned:
+            del kept[toot_id]
+            try:
+                toot = call_with_retry(options, mastodon, mastodon.status, toot_id)
+            except MastodonNotFoundError:
+                continue  # already deleted some other way
+            deleted_count = process_toot(
+                config,
+                options,
+                mastodon,
+                toot,
+                deleted_count,
+                kept=kept,
+                scheduler=scheduler,
+                policy=policy,
+                planned=planned,
+            )
+
+    return deleted_count
+
+
+# one HTTP session for each server, created when the first account on it is checked
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def get_session(api_base_url, pool_size):
+    """
+    Returns the HTTP session for a server, so that every account on the same server reuses the same pool of up to pool_size connections (set with --pool-size) instead of each opening its own. The access token is sent with each request, so sharing is safe, but cookies are turned off so that nothing from one account's requests is sent with another's.
+    """
+    with sessions_lock:
+        if api_base_url not in sessions:
+            session = requests.Session()
+            session.cookies.set_policy(
+                http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+            )
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_size
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            # Mastodon.py doesn't tell us about Retry-After headers, so look for them here
+            session.hooks["response"].append(retry.record_response)
+            sessions[api_base_url] = session
+        return sessions[api_base_url]
+
+
+def close_sessions():
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
+
+def api_base_url(config):
+    # base_url is normally just a domain, but a scheme is allowed (e.g. for a local test server)
+    if "://" in config["base_url"]:
+        return config["base_url"]
+    return "https://" + config["base_url"]
+
+
+def connect(config, options):
+    """
+    Returns a Mastodon API client for the account in config.
+    """
+    base_url = api_base_url(config)
+
+    # don't start on an account if its server has stopped responding to the others
+    retry.check_server(retry.server_of(base_url))
+    session = get_session(base_url, options.pool_size)
+
+    if options.pace:
+        return Mastodon(
+            access_token=config["access_token"],
+            api_base_url=base_url,
+            ratelimit_method="pace",
+            session=session,
+        )
+    else:
+        return Mastodon(
+            access_token=config["access_token"],
+            api_base_url=base_url,
+            ratelimit_method="wait",
+            session=session,
+        )
+
+
+def check_toots(config, options, record_total=True):
+    """
+    The main function, uses the Mastodon API to check all toots in the user timeline, and delete any that do not meet any of the exclusion criteria from the config file. Returns True if every toot was checked.
+    Set record_total to False when the caller records the total time for the account itself.
+    """
+    started = time.perf_counter()
+    account_metrics = None
+    completed = False
+    try:
+        if not options.quiet and options.log_format != "json":
             print(
                 "Fetching account details for @",
                 config["username"],
@@ -636,66 +976,627 @@ def check_toots(config, options, retry_count=0):
                 sep="",
             )
 
-        if options.pace:
-            mastodon = Mastodon(
-                access_token=config["access_token"],
-                api_base_url="https://" + config["base_url"],
-                ratelimit_method="pace",
-            )
-        else:
-            mastodon = Mastodon(
-                access_token=config["access_token"],
-                api_base_url="https://" + config["base_url"],
-                ratelimit_method="wait",
-            )
+        account_metrics = metrics.start(config)
+        mastodon = connect(config, options)
 
-        user_id = mastodon.account_verify_credentials().id  # verify user and get ID
-        account = mastodon.account(user_id)  # get the account
-        timeline = mastodon.account_statuses(user_id, limit=40)  # initial batch
+        # compile the keep rules once, rather than for every toot
+        policy = compile_policy(config)
 
-        if not options.quiet:
+        # with --state, only check toots that have crossed the cutoff since the last run
+        previous = state.get_account(options.state, config) if options.state else {}
+        if "cutoff" in previous and previous.get("policy") == state.policy_hash(config):
+            stop_before = datetime.fromisoformat(previous["cutoff"])
+            kept = previous.get("kept", {})
+        else:
+            stop_before = None
+            kept = {}
+
+        # with --resume, carry on from where an interrupted run got to
+        resume = state.get_checkpoint(options.state, config) if options.resume else None
+        cutoff = policy.cutoff
+        if resume:
+            kept = resume["kept"]
+            # toots before the checkpoint were checked against the older cutoff
+            cutoff = min(cutoff, datetime.fromisoformat(resume["cutoff"]))
+
+        # verify user and get ID
+        user_id = call_with_retry(
+            options, mastodon, mastodon.account_verify_credentials
+        ).id
+        account = call_with_retry(options, mastodon, mastodon.account, user_id)
+        with account_metrics.timer("paging"):
+            if resume:
+                timeline = call_with_retry(
+                    options,
+                    mastodon,
+                    mastodon.account_statuses,
+                    user_id,
+                    limit=40,
+                    max_id=resume["max_id"],
+                )
+            else:
+                # initial batch
+                timeline = call_with_retry(
+                    options, mastodon, mastodon.account_statuses, user_id, limit=40
+                )
+        account_metrics.count("pages_fetched")
+
+        if options.log_format == "json":
+            if not options.quiet:
+                json_event("started", statuses_count=account.statuses_count)
+        elif not options.quiet:
             print("Checking", str(account.statuses_count), "toots")
 
+        scheduler = DeleteScheduler(mastodon, options)
+        planned = [] if options.test and options.plan else None
+        deleted_count = resume["deleted"] if resume else 0
+
+        # a test run has not deleted anything, so there is nothing to remember
+        checkpoint = None
+        if options.state and not options.test:
+            checkpoint = state.Checkpoint(options.state, config, cutoff)
+
+        if stop_before:
+            deleted_count = recheck_kept(
+                config,
+                options,
+                mastodon,
+                user_id,
+                kept,
+                deleted_count=deleted_count,
+                scheduler=scheduler,
+                policy=policy,
+                planned=planned,
+            )
+
         # check first batch
-        # check_batch() then recursively keeps looping until all toots have been checked
-        check_batch(config, options, mastodon, user_id, timeline)
+        # check_batch() then keeps fetching older batches until all toots have been checked
+        try:
+            check_batch(
+                config,
+                options,
+                mastodon,
+                user_id,
+                timeline,
+                deleted_count,
+                stop_before=stop_before,
+                kept=kept,
+                scheduler=scheduler,
+                policy=policy,
+                planned=planned,
+                checkpoint=checkpoint,
+            )
+        except BaseException:
+            # save where we got to, including on Ctrl-C or SIGTERM, so --resume can carry on
+            if checkpoint:
+                checkpoint.save()
+            raise
+
+        if planned is not None:
+            plan.save_account(options.plan, config, policy.cutoff, planned)
+
+        # the run is finished, so replace the checkpoint with the new state
+        if checkpoint:
+            state.update_account(
+                options.state,
+                config,
+                cutoff=cutoff.isoformat(),
+                policy=state.policy_hash(config),
+                kept=kept,
+                checkpoint=None,
+            )
+        completed = True
 
     except KeyboardInterrupt:
-        print("Operation aborted.")
+        print_aborted(options)
 
     except KeyError as val:
+        print_config_error(val, options)
+
+    except MastodonAPIError as e:
+        account_metrics.count("errors")
+        print_api_error(e, options)
+
+    except retry.CircuitOpenError as e:
+        print_circuit_open(e, config, options)
+
+    except MastodonNetworkError as e:
+        account_metrics.count("errors")
+        print_network_error(e, options)
+
+    except Exception as e:
+        print_error(e, options)
+
+    if account_metrics and record_total:
+        record_total_time(account_metrics, started)
+    return completed
+
+
+def print_error(e, options):
+    """
+    Report an error nobody expected, so that one account going wrong doesn't stop the others.
+    """
+    if options.log_format == "json":
+        json_event("error", error=str(e.args[0]) if e.args else repr(e), detail=repr(e))
+    elif options.verbose or not e.args:
+        print("ERROR:", repr(e) if not e.args else e)
+    else:
+        print("ERROR:", str(e.args[0]), "\n")
+
+
+def record_total_time(account_metrics, started):
+    account_metrics.observe("total", time.perf_counter() - started)
+    account_metrics.finished = time.time()
+
+
+def print_aborted(options):
+    if options.log_format == "json":
+        json_event("aborted")
+    else:
+        print("Operation aborted.")
+
+
+def print_config_error(val, options):
+    if options.log_format == "json":
+        json_event("error", error="no value in the config file for " + str(val))
+    else:
         print("\n⚠️  error with in your config.yaml file!")
         print("Please ensure there is a value for " + str(val) + "\n")
 
+
+def print_network_error(e, options):
+    if options.log_format == "json":
+        json_event("error", error="cannot connect to the server", detail=str(e))
+        return
+
+    print("\n📡  ephemetoot cannot connect to the server - are you online?")
+    if options.verbose:
+        print(e)
+
+
+def print_api_error(e, options):
+    if e.args[1] == 401:
+        emoji = "🙅"
+        message = "User and/or access token does not exist or has been deleted (401)"
+    elif e.args[1] == 404:
+        emoji, message = "🔭", "Can't find that server (404)"
+    else:
+        emoji, message = "😕", "Server has returned an error (5xx)"
+
+    if options.log_format == "json":
+        json_event("error", error=message, detail=str(e))
+        return
+
+    print("\n" + emoji + "  " + message + "\n")
+    if options.verbose:
+        print(e, "\n")
+
+
+def print_circuit_open(e, config, options):
+    if options.log_format == "json":
+        json_event("error", error="skipped because " + str(e))
+        return
+
+    print(
+        "\n🔌  Skipping @",
+        config["username"],
+        "@",
+        config["base_url"],
+        " because ",
+        e,
+        " - it will be tried again later\n",
+        sep="",
+    )
+
+
+def fetch_new(options, mastodon, user_id, min_id):
+    """
+    Yields the toots posted after min_id, oldest first, fetching pages of up to 40 toots until there are none left.
+    """
+    while True:
+        with metrics.current().timer("paging"):
+            page = call_with_retry(
+                options,
+                mastodon,
+                mastodon.account_statuses,
+                user_id,
+                limit=40,
+                min_id=min_id,
+            )
+        metrics.current().count("pages_fetched")
+        if not page:
+            return
+        page = sorted(page, key=lambda toot: int(toot.id))
+        yield from page
+        min_id = page[-1].id
+
+
+def check_queue(config, options):
+    """
+    Used instead of check_toots() with --expiry-queue. Toots are added to the account's expiry queue when they are first seen, and each toot is only fetched again once it has expired, so the timeline is not walked at all. The first time, a normal check is done to remove toots that are already old enough, and the queue is filled with the toots that are not.
+    """
+    account_metrics = metrics.start(config)
+    started = time.perf_counter()
+    queue = expiry.load(options.state, config)
+    if queue is None:
+        if not check_toots(config, options, record_total=False):
+            record_total_time(account_metrics, started)
+            return
+        queue = expiry.ExpiryQueue(config)
+
+    try:
+        if not options.quiet and options.log_format != "json":
+            print(
+                "Checking the expiry queue for @",
+                config["username"],
+                "@",
+                config["base_url"],
+                sep="",
+            )
+
+        mastodon = connect(config, options)
+        now = datetime.now(timezone.utc)
+        policy = compile_policy(config, now)
+        user_id = call_with_retry(
+            options, mastodon, mastodon.account_verify_credentials
+        ).id
+
+        if queue.min_id is None:
+            # only toots newer than the cutoff are still waiting to expire
+            newest = call_with_retry(
+                options, mastodon, mastodon.account_statuses, user_id, limit=1
+            )
+            if newest and not is_snowflake(newest[0]):
+                print(
+                    "⚠️  This server's toot IDs don't include the date, so --expiry-queue can't be used"
+                )
+                return
+            queue.min_id = snowflake_max_id(policy.cutoff)
+
+        for toot in fetch_new(options, mastodon, user_id, queue.min_id):
+            if queue.add(toot, policy):
+                account_metrics.count("toots_queued")
+            queue.min_id = str(toot.id)
+
+        scheduler = DeleteScheduler(mastodon, options)
+        deleted_count = 0
+        try:
+            for toot_id in queue.pop_due(now):
+                if abort.is_set():
+                    raise KeyboardInterrupt
+                # the toot may have been edited or pinned since it was queued, so check it again
+                try:
+                    toot = call_with_retry(options, mastodon, mastodon.status, toot_id)
+                except MastodonNotFoundError:
+                    continue  # already deleted
+                failed = {}
+                deleted_count = process_toot(
+                    config,
+                    options,
+                    mastodon,
+                    toot,
+                    deleted_count,
+                    kept=failed,
+                    scheduler=scheduler,
+                    policy=policy,
+                )
+                # the toot won't be seen again unless it stays queued
+                if failed.get(str(toot.id)) == "failed":
+                    queue.push(now + expiry.REFUSED_RETRY, toot.id)
+                elif policy.decide(toot)[1] == "pinned":
+                    queue.push(now + expiry.PINNED_RECHECK, toot.id)
+        finally:
+            # a test run has not deleted anything, so there is nothing to remember
+            if not options.test:
+                queue.save(options.state)
+
+        print_summary(config, options, deleted_count)
+
+    except KeyboardInterrupt:
+        print_aborted(options)
+
+    except KeyError as val:
+        print_config_error(val, options)
+
     except MastodonAPIError as e:
-        if e.args[1] == 401:
+        account_metrics.count("errors")
+        print_api_error(e, options)
+
+    except retry.CircuitOpenError as e:
+        print_circuit_open(e, config, options)
+
+    except MastodonNetworkError as e:
+        account_metrics.count("errors")
+        print_network_error(e, options)
+
+    except Exception as e:
+        print_error(e, options)
+
+    record_total_time(account_metrics, started)
+
+
+def check_account(config, options):
+    """
+    Check one account, using its expiry queue with --expiry-queue.
+    """
+    if options.expiry_queue:
+        check_queue(config, options)
+    else:
+        check_toots(config, options)
+
+
+def check_export(config, options, export_path):
+    """
+    Like check_toots(), but reads the account's toots from a Mastodon account export (the zip file from "Request your archive", or the directory it was extracted to) instead of fetching the whole timeline from the server. The same keep rules are used, and only pinned toots, deletes and unboosts touch the API.
+    """
+    account_metrics = metrics.start(config)
+    started = time.perf_counter()
+    try:
+        if not options.quiet and options.log_format != "json":
             print(
-                "\n🙅  User and/or access token does not exist or has been deleted (401)\n"
+                "Checking exported toots for @",
+                config["username"],
+                "@",
+                config["base_url"],
+                sep="",
             )
-        elif e.args[1] == 404:
-            print("\n🔭  Can't find that server (404)\n")
-        else:
-            print("\n😕  Server has returned an error (5xx)\n")
 
-        if options.verbose:
-            print(e, "\n")
+        mastodon = connect(config, options)
+        policy = compile_policy(config)
+
+        # pinned toots aren't marked in the export
+        pinned = set()
+        if policy.keep_pinned:
+            user_id = call_with_retry(
+                options, mastodon, mastodon.account_verify_credentials
+            ).id
+            for toot in call_with_retry(
+                options, mastodon, mastodon.account_statuses, user_id, pinned=True
+            ):
+                pinned.add(str(toot.id))
+
+        scheduler = DeleteScheduler(mastodon, options)
+        planned = [] if options.test and options.plan else None
+        deleted_count = 0
+        for toot in export.iter_toots(export_path):
+            if abort.is_set():
+                raise KeyboardInterrupt
+            toot["pinned"] = toot.id in pinned
+
+            # The export only has the URI of a boosted toot, but unboosting needs its
+            # ID on our server. That means fetching the boost, but only if it is expired.
+            if toot.reblog and not options.test:
+                action, reason = policy.decide(toot)
+                if action == UNBOOST:
+                    try:
+                        toot = call_with_retry(
+                            options, mastodon, mastodon.status, toot.id
+                        )
+                    except MastodonNotFoundError:
+                        continue  # already removed
+
+            deleted_count = process_toot(
+                config,
+                options,
+                mastodon,
+                toot,
+                deleted_count,
+                scheduler=scheduler,
+                policy=policy,
+                planned=planned,
+            )
+
+        if planned is not None:
+            plan.save_account(options.plan, config, policy.cutoff, planned)
+
+        print_summary(config, options, deleted_count)
+
+    except KeyboardInterrupt:
+        print_aborted(options)
+
+    except KeyError as val:
+        print_config_error(val, options)
+
+    except retry.CircuitOpenError as e:
+        print_circuit_open(e, config, options)
+
+    except MastodonAPIError as e:
+        account_metrics.count("errors")
+        print_api_error(e, options)
 
     except MastodonNetworkError as e:
-        if retry_count == 0:
-            print("\n📡  ephemetoot cannot connect to the server - are you online?")
-            if options.verbose:
-                print(e)
-        if retry_count < 4:
-            print("Waiting " + str(options.retry_mins) + " minutes before trying again")
-            time.sleep(60 * options.retry_mins)
-            retry_count += 1
-            print("Attempt " + str(retry_count + 1))
-            check_toots(config, options, retry_count)
+        account_metrics.count("errors")
+        print_network_error(e, options)
+
+    # Mastodon.py errors can also be OSErrors or ValueErrors, so they are handled first
+    except MastodonError as e:
+        account_metrics.count("errors")
+        print_error(e, options)
+
+    # retry_on_error() gives up with a TimeoutError, which is also an OSError
+    except TimeoutError as e:
+        print_error(e, options)
+
+    except (OSError, ValueError) as e:
+        if options.log_format == "json":
+            json_event("error", error="cannot read the export", detail=str(e))
         else:
-            print("Gave up waiting for network\n")
+            print("🛑 ERROR reading the export -", e)
 
     except Exception as e:
-        if options.verbose:
-            print("ERROR:", e)
-        else:
-            print("ERROR:", str(e.args[0]), "\n")
+        print_error(e, options)
+
+    record_total_time(account_metrics, started)
+
+
+def execute_plan(config, options, planned_toots):
+    """
+    Delete and unboost the toots in a plan saved by an earlier --test run, without fetching the timeline again. Toots that are no longer older than days_to_keep are kept, and toots that are already gone are skipped.
+    """
+    account_metrics = metrics.start(config)
+    started = time.perf_counter()
+    try:
+        if not options.quiet and options.log_format != "json":
+            print(
+                "Carrying out the plan for @",
+                config["username"],
+                "@",
+                config["base_url"],
+                sep="",
+            )
+
+        mastodon = connect(config, options)
+        policy = plan.PlanPolicy(cutoff=compile_policy(config).cutoff)
+        scheduler = DeleteScheduler(mastodon, options)
+
+        # toots were archived when the plan was made
+        config = {key: value for key, value in config.items() if key != "archive"}
+
+        deleted_count = 0
+        for toot in planned_toots:
+            if abort.is_set():
+                raise KeyboardInterrupt
+
+            # plans made from an --export don't have the ID of boosted toots
+            if toot.action == UNBOOST and toot.reblog is None and not options.test:
+                try:
+                    toot["reblog"] = call_with_retry(
+                        options, mastodon, mastodon.status, toot.id
+                    ).reblog
+                except MastodonNotFoundError:
+                    log_event(options, "gone", toot)
+                    continue
+
+            deleted_count = process_toot(
+                config,
+                options,
+                mastodon,
+                toot,
+                deleted_count,
+                scheduler=scheduler,
+                policy=policy,
+            )
+
+        print_summary(config, options, deleted_count)
+
+    except KeyboardInterrupt:
+        print_aborted(options)
+
+    except KeyError as val:
+        print_config_error(val, options)
+
+    except MastodonAPIError as e:
+        account_metrics.count("errors")
+        print_api_error(e, options)
+
+    except retry.CircuitOpenError as e:
+        print_circuit_open(e, config, options)
+
+    except MastodonNetworkError as e:
+        account_metrics.count("errors")
+        print_network_error(e, options)
+
+    # report anything else and carry on with the next account in the plan
+    except Exception as e:
+        print_error(e, options)
+
+    record_total_time(account_metrics, started)
+
+
+def handle_sigterm(signum, frame):
+    """
+    Stop the run in the same way as Ctrl-C when the process is asked to terminate (e.g. by launchd or systemd), so that checkpoints are saved for --resume.
+    """
+    abort.set()
+    raise KeyboardInterrupt
+
+
+class GroupedOutput:
+    """
+    Stands in for sys.stdout while accounts are checked concurrently. Anything printed by a worker thread is held in a buffer for that thread, and written out in one piece when the account is finished, so that output from different accounts is never interleaved.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            with self.lock:
+                return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+    def start(self):
+        self.local.buffer = io.StringIO()
+
+    def finish(self):
+        text = self.local.buffer.getvalue()
+        self.local.buffer = None
+        with self.lock:
+            self.stream.write(text)
+            self.stream.flush()
+
+
+def check_grouped(config, options, output):
+    """
+    Run check_toots() for one account, holding back its output until it is complete.
+    """
+    output.start()
+    try:
+        check_account(config, options)
+    finally:
+        output.finish()
+
+
+def check_accounts(accounts, options):
+    """
+    Check several accounts at the same time. Up to options.workers accounts run in parallel, but never more than options.instance_workers accounts on the same base_url at once, so that no single server is hammered.
+    """
+    workers = max(1, options.workers)
+    per_instance = max(1, options.instance_workers)
+
+    pending = list(accounts)
+    running = {}  # future -> base_url
+    active = {}  # base_url -> number of accounts currently running
+
+    output = GroupedOutput(sys.stdout)
+    sys.stdout = output
+    abort.clear()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                while pending or running:
+                    # start as many waiting accounts as the limits allow, in config order
+                    for config in list(pending):
+                        if len(running) >= workers:
+                            break
+                        base_url = config.get("base_url")
+                        if active.get(base_url, 0) < per_instance:
+                            pending.remove(config)
+                            active[base_url] = active.get(base_url, 0) + 1
+                            future = pool.submit(check_grouped, config, options, output)
+                            running[future] = base_url
+
+                    done, not_done = wait(list(running), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        base_url = running.pop(future)
+                        active[base_url] -= 1
+                        future.result()
+
+            except KeyboardInterrupt:
+                # running accounts stop at their next toot, and no more are started
+                abort.set()
+                print_aborted(options)
+
+    finally:
+        sys.stdout = output.stream
@@ -0,0 +1,86 @@
+# standard library
+from datetime import datetime, timedelta, timezone
+import heapq
+
+# local
+from ephemetoot import state
+from ephemetoot.policy import KEEP, days_to_keep
+
+# pinned toots that come due are looked at again this often, in case they have been unpinned
+PINNED_RECHECK = timedelta(days=1)
+
+# toots the server refused to delete (e.g. with a 422 error) are tried again after this long
+REFUSED_RETRY = timedelta(days=1)
+
+# a cutoff that no toot is older than, so that decide() only applies the keep rules
+NEVER = datetime.max.replace(tzinfo=timezone.utc)
+
+
+class ExpiryQueue:
+    """
+    The toots of one account that are waiting to be old enough to delete, as a heap of [expiry timestamp, toot ID] with the soonest first. It is saved in the state file, so once it has been filled, each run only needs to fetch the toots posted since min_id and remove the ones that have come due.
+    """
+
+    def __init__(self, config, min_id=None, toots=None):
+        self.config = config
+        self.min_id = min_id
+        self.toots = toots if toots is not None else []
+
+    def add(self, toot, policy):
+        """
+        Queue a new toot, unless the keep rules mean it will never be removed. Pinned toots are queued anyway, because they may be unpinned by the time they expire.
+        """
+        action, reason = policy._replace(cutoff=NEVER).decide(toot)
+        if action == KEEP and reason != "pinned":
+            return False
+        expires = toot.created_at + timedelta(days=days_to_keep(self.config))
+        self.push(expires, toot.id)
+        return True
+
+    def push(self, expires, toot_id):
+        heapq.heappush(self.toots, [expires.timestamp(), str(toot_id)])
+
+    def pop_due(self, now):
+        """
+        Yields the ID of each toot that expired before now, soonest first. Each toot is only taken off the queue when the next one is asked for, so if an error stops the run, the toot being removed stays queued.
+        """
+        while self.toots and self.toots[0][0] < now.timestamp():
+            yield self.toots[0][1]
+            heapq.heappop(self.toots)
+
+    def next_expiry(self):
+        return self.toots[0][0] if self.toots else None
+
+    def save(self, path):
+        state.update_account(
+            path,
+            self.config,
+            queue={
+                "days_to_keep": days_to_keep(self.config),
+                "min_id": self.min_id,
+                "policy": state.policy_hash(self.config),
+                "toots": self.toots,
+            },
+        )
+
+
+def load(path, config):
+    """
+    Returns the saved queue for this account, or None if there isn't one or if it was filled using different keep rules or days_to_keep.
+    """
+    saved = state.get_account(path, config).get("queue")
+    if (
+        not saved
+        or saved.get("policy") != state.policy_hash(config)
+        or saved.get("days_to_keep") != days_to_keep(config)
+    ):
+        return None
+    return ExpiryQueue(config, saved["min_id"], saved["toots"])
+
+
+def next_expiry(path, config):
+    """
+    The time (as a timestamp) when the next toot in this account's saved queue expires, or None.
+    """
+    queue = load(path, config)
+    return queue.next_expiry() if queue else None
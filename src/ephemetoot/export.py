@@ -0,0 +1,188 @@
+# standard library
+from datetime import datetime
+import io
+import json
+import os
+import re
+import urllib.parse
+import zipfile
+
+# addressed to this, a status is public (in "to") or unlisted (in "cc")
+PUBLIC = (
+    "https://www.w3.org/ns/activitystreams#Public",
+    "as:Public",
+    "Public",
+)
+
+# outbox.json can be hundreds of megabytes, so it is read this many characters at a time
+CHUNK_SIZE = 64 * 1024
+
+# whitespace and commas between the items of a JSON array
+SEPARATORS = re.compile(r"[\s,]*")
+
+
+class ExportToot(dict):
+    """
+    A status read from an account export, in the same shape as a status from the Mastodon API, so that it can be checked with the same keep rules.
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def open_file(path, name):
+    """
+    Opens a file from an export, which may be the zip file downloaded from Mastodon or a directory it was extracted to.
+    """
+    if os.path.isdir(path):
+        return open(os.path.join(path, name), encoding="utf-8")
+    export = zipfile.ZipFile(path)
+    try:
+        return io.TextIOWrapper(export.open(name), encoding="utf-8")
+    except KeyError:
+        export.close()
+        raise FileNotFoundError("No " + name + " in " + path)
+
+
+def read_actor(path):
+    """
+    Returns the (username, domain) of the account the export belongs to.
+    """
+    with open_file(path, "actor.json") as f:
+        actor = json.load(f)
+    return actor["preferredUsername"], urllib.parse.urlparse(actor["id"]).netloc
+
+
+def matches(actor, config):
+    username, domain = actor
+    base_url = config["base_url"]
+    if "://" in base_url:
+        base_url = urllib.parse.urlparse(base_url).netloc
+    return config["username"].lower() == username.lower() and base_url == domain
+
+
+def iter_array(f, key):
+    """
+    Yields the items of the array called key from a JSON file, one at a time, without reading the whole file into memory. The array must be in the top level object, as orderedItems is in outbox.json.
+    """
+    decoder = json.JSONDecoder()
+    marker = '"' + key + '"'
+    buffer = ""
+
+    # find the start of the array
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        buffer += chunk
+        found = buffer.find(marker)
+        if found < 0:
+            buffer = buffer[-len(marker) :]  # the key may be split across chunks
+            continue
+        start = buffer.find("[", found + len(marker))
+        if start >= 0:
+            buffer = buffer[start + 1 :]
+            break
+        buffer = buffer[found:]
+
+    # decode each item, reading more of the file whenever an item is incomplete
+    position = 0
+    while True:
+        position = SEPARATORS.match(buffer, position).end()
+        if buffer.startswith("]", position):
+            return
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                raise ValueError("The export ended in the middle of " + key)
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield item
+
+
+def status_id(url):
+    """
+    The local status ID is the last part of a status URL, e.g. https://example.social/users/alice/statuses/104136090490756999
+    """
+    parts = urllib.parse.urlparse(url).path.rstrip("/").split("/")
+    if parts[-1] == "activity":
+        parts.pop()  # boosts are identified by their activity
+    return parts[-1]
+
+
+def visibility(addressed, actor_id):
+    to = addressed.get("to") or []
+    cc = addressed.get("cc") or []
+    if any(audience in PUBLIC for audience in to):
+        return "public"
+    if any(audience in PUBLIC for audience in cc):
+        return "unlisted"
+    if actor_id + "/followers" in to + cc:
+        return "private"
+    return "direct"
+
+
+def published(value):
+    # Python before 3.11 doesn't understand a trailing 'Z'
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def to_toot(activity):
+    """
+    Converts an activity from outbox.json into a status, or returns None for activities that aren't statuses. Boosts have a placeholder reblog with the URI of the boosted status, because the export doesn't include its local ID.
+    """
+    actor_id = activity.get("actor", "")
+    if activity.get("type") == "Announce":
+        boosted = activity.get("object")
+        return ExportToot(
+            id=status_id(activity["id"]),
+            uri=activity["id"],
+            created_at=published(activity["published"]),
+            visibility=visibility(activity, actor_id),
+            tags=[],
+            pinned=False,
+            reblog=ExportToot(uri=boosted if isinstance(boosted, str) else None),
+            media_attachments=[],
+        )
+
+    note = activity.get("object")
+    if activity.get("type") != "Create" or not isinstance(note, dict):
+        return None
+
+    return ExportToot(
+        id=status_id(note["id"]),
+        uri=note["id"],
+        url=note.get("url"),
+        created_at=published(note["published"]),
+        visibility=visibility(note, actor_id),
+        content=note.get("content", ""),
+        spoiler_text=note.get("summary") or "",
+        sensitive=bool(note.get("sensitive")),
+        in_reply_to_id=note.get("inReplyTo"),
+        tags=[
+            ExportToot(name=tag["name"].lstrip("#"))
+            for tag in note.get("tag") or []
+            if tag.get("type") == "Hashtag"
+        ],
+        pinned=False,
+        reblog=None,
+        # attachments are files inside the export, not URLs that can be downloaded
+        media_attachments=[],
+    )
+
+
+def iter_toots(path):
+    """
+    Yields every status in the export at path, one at a time.
+    """
+    with open_file(path, "outbox.json") as f:
+        for activity in iter_array(f, "orderedItems"):
+            toot = to_toot(activity)
+            if toot is not None:
+                yield toot
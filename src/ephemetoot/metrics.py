@@ -0,0 +1,217 @@
+# standard library
+from contextlib import contextmanager
+import json
+import math
+import os
+import threading
+import time
+
+# local
+from ephemetoot import state
+
+# the parts of a run that are timed separately
+PHASES = (
+    "total",
+    "paging",
+    "evaluating",
+    "archiving",
+    "deleting",
+    "rate_limit_wait",
+    "retry_wait",
+)
+
+# upper bounds of the timing histogram buckets, in seconds
+BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1,
+    5,
+    10,
+    60,
+    300,
+    1800,
+    3600,
+    math.inf,
+)
+
+# descriptions of the counters, for the Prometheus textfile
+COUNTERS = {
+    "toots_checked": "Toots checked against the keep rules.",
+    "toots_deleted": "Toots deleted (or that would be deleted with --test).",
+    "toots_unboosted": "Boosts removed (or that would be removed with --test).",
+    "toots_kept": "Toots kept by the keep rules.",
+    "toots_queued": "New toots added to the expiry queue (--expiry-queue).",
+    "pages_fetched": "Pages of the timeline fetched from the server.",
+    "rate_limit_waits": "Times the run paused until a rate limit reset.",
+    "retries": "Times a delete was retried after an error.",
+    "errors": "Errors returned by the server.",
+}
+
+
+class Histogram:
+    """
+    Counts how many timings fell into each bucket, in the same way as a Prometheus histogram.
+    """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            total += count
+            yield bound, total
+
+
+class AccountMetrics:
+    """
+    Counters and phase timings for one account. Each account runs in a single thread, so these don't need a lock.
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self.counters = {name: 0 for name in COUNTERS}
+        self.timings = {phase: Histogram() for phase in PHASES}
+        self.finished = None
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def observe(self, phase, seconds):
+        self.timings[phase].observe(seconds)
+
+    @contextmanager
+    def timer(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - started)
+
+    def summary(self):
+        return {
+            "counters": dict(self.counters),
+            "seconds": {
+                phase: round(histogram.sum, 6)
+                for phase, histogram in self.timings.items()
+            },
+            "timings": {
+                phase: {
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 6),
+                    "buckets": {
+                        bucket_label(bound): count
+                        for bound, count in histogram.cumulative()
+                    },
+                }
+                for phase, histogram in self.timings.items()
+            },
+            "finished": self.finished,
+        }
+
+
+# every account seen in this run, and the account each thread is working on
+accounts = {}
+accounts_lock = threading.Lock()
+local = threading.local()
+
+
+def start(config):
+    """
+    Use the metrics for this config's account for everything that happens in this thread, until start() is called again.
+    """
+    key = state.account_key(config)
+    with accounts_lock:
+        if key not in accounts:
+            accounts[key] = AccountMetrics(key)
+        local.account = accounts[key]
+    return local.account
+
+
+def current():
+    """
+    The metrics for the account being checked in this thread. Functions called outside check_toots() (e.g. in tests) get a throwaway set of metrics that is never written.
+    """
+    account = getattr(local, "account", None)
+    if account is None:
+        account = AccountMetrics(None)
+        local.account = account
+    return account
+
+
+def bucket_label(bound):
+    return "+Inf" if bound == math.inf else repr(float(bound))
+
+
+def label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_lines(snapshot):
+    for name, description in COUNTERS.items():
+        metric = "ephemetoot_" + name + "_total"
+        yield "# HELP " + metric + " " + description
+        yield "# TYPE " + metric + " counter"
+        for key, account in snapshot:
+            labels = '{account="' + label(key) + '"}'
+            yield metric + labels + " " + str(account.counters[name])
+
+    metric = "ephemetoot_phase_seconds"
+    yield "# HELP " + metric + " Time spent in each phase of a run."
+    yield "# TYPE " + metric + " histogram"
+    for key, account in snapshot:
+        for phase, histogram in account.timings.items():
+            labels = 'account="' + label(key) + '",phase="' + phase + '"'
+            for bound, count in histogram.cumulative():
+                yield (
+                    metric
+                    + "_bucket{"
+                    + labels
+                    + ',le="'
+                    + bucket_label(bound)
+                    + '"} '
+                    + str(count)
+                )
+            yield metric + "_sum{" + labels + "} " + repr(histogram.sum)
+            yield metric + "_count{" + labels + "} " + str(histogram.count)
+
+    metric = "ephemetoot_last_run_timestamp_seconds"
+    yield "# HELP " + metric + " When the last run for each account finished."
+    yield "# TYPE " + metric + " gauge"
+    for key, account in snapshot:
+        if account.finished:
+            labels = '{account="' + label(key) + '"}'
+            yield metric + labels + " " + repr(account.finished)
+
+
+def write(path):
+    """
+    Write the metrics for every account to path: a Prometheus textfile if the file name ends with '.prom', or JSON otherwise. The file is replaced in one step, so node_exporter never reads a half-written file.
+    """
+    with accounts_lock:
+        snapshot = sorted(accounts.items())
+
+    if path.endswith(".prom"):
+        content = "\n".join(prometheus_lines(snapshot)) + "\n"
+    else:
+        summary = {key: account.summary() for key, account in snapshot}
+        content = json.dumps(summary, indent=2, sort_keys=True)
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(content)
+    os.replace(temp_path, path)
@@ -0,0 +1,93 @@
+# standard library
+from datetime import datetime
+import json
+import os
+import threading
+from typing import NamedTuple
+
+# local
+from ephemetoot import state
+from ephemetoot.policy import KEEP
+
+# accounts may finish at the same time when using --workers
+lock = threading.Lock()
+
+
+class PlannedToot(dict):
+    """
+    A toot from a plan file. Only has the fields needed to delete or unboost it.
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class PlanPolicy(NamedTuple):
+    """
+    Used instead of a RetentionPolicy when carrying out a plan: the action was already decided when the plan was made, but toots that are no longer old enough to delete (e.g. because days_to_keep was increased) are kept.
+    """
+
+    cutoff: datetime
+
+    def decide(self, toot):
+        if toot.created_at >= self.cutoff:
+            return KEEP, "recent"
+        return toot.action, toot.reason
+
+
+def entry(toot, action, reason):
+    """
+    One toot in a plan: [id, action, reason, created_at, id of the boosted toot or None]
+    """
+    reblog = getattr(toot, "reblog", None)
+    return [
+        str(toot.id),
+        action,
+        reason,
+        toot.created_at.isoformat(),
+        str(reblog.id) if getattr(reblog, "id", None) else None,
+    ]
+
+
+def load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_account(path, config, cutoff, entries):
+    """
+    Replace the plan for one account, leaving other accounts as they are.
+    """
+    with lock:
+        plan = load(path)
+        plan[state.account_key(config)] = {
+            "created": datetime.now(cutoff.tzinfo).isoformat(),
+            "cutoff": cutoff.isoformat(),
+            "toots": entries,
+        }
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(plan, f, separators=(",", ":"))
+        os.replace(temp_path, path)
+
+
+def toots(plan, config):
+    """
+    Yields the planned toots for this account, or nothing if it isn't in the plan.
+    """
+    for status_id, action, reason, created_at, reblog_id in plan.get(
+        state.account_key(config), {}
+    ).get("toots", []):
+        yield PlannedToot(
+            id=status_id,
+            action=action,
+            reason=reason,
+            created_at=datetime.fromisoformat(created_at),
+            reblog=reblog_id,
+        )
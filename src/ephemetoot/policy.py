@@ -0,0 +1,85 @@
+# standard library
+from datetime import datetime, timedelta, timezone
+from typing import FrozenSet, NamedTuple
+
+# actions returned by RetentionPolicy.decide()
+KEEP = "keep"
+DELETE = "delete"
+UNBOOST = "unboost"
+
+# reasons for keeping a toot that would otherwise be old enough to remove
+KEEP_REASONS = ("pinned", "saved", "visibility", "hashtag")
+
+
+class RetentionPolicy(NamedTuple):
+    """
+    The keep rules for one account, compiled once from the config file so that checking each toot is only a few set lookups. Create one with compile_policy().
+    """
+
+    keep_pinned: bool
+    boosts_only: bool
+    toots_to_keep: FrozenSet
+    visibility_to_keep: FrozenSet[str]
+    hashtags_to_keep: FrozenSet[str]
+    cutoff: datetime
+
+    def decide(self, toot):
+        """
+        Returns a tuple of (action, reason) for a toot, where action is KEEP, DELETE or UNBOOST.
+        """
+        if self.keep_pinned and getattr(toot, "pinned", False):
+            return KEEP, "pinned"
+
+        if toot.id in self.toots_to_keep:
+            return KEEP, "saved"
+
+        if toot.visibility in self.visibility_to_keep:
+            return KEEP, "visibility"
+
+        if self.hashtags_to_keep:
+            for tag in toot.tags:
+                if tag.name.lower() in self.hashtags_to_keep:
+                    return KEEP, "hashtag"
+
+        if toot.created_at >= self.cutoff:
+            return KEEP, "recent"
+
+        if getattr(toot, "reblog", None):
+            return UNBOOST, "expired"
+
+        if self.boosts_only:
+            return KEEP, "boosts_only"
+
+        return DELETE, "expired"
+
+
+def days_to_keep(config):
+    return config["days_to_keep"] if "days_to_keep" in config else 365
+
+
+def compile_policy(config, now=None):
+    """
+    Builds a RetentionPolicy from an account's config. The cutoff date is fixed at the time this is called (or at now, if provided).
+    """
+    if now is None:
+        now = datetime.now(timezone.utc)
+
+    # toot IDs may be written as numbers or strings in config.yaml, so match either
+    toots_to_keep = set()
+    for toot_id in config.get("toots_to_keep") or []:
+        toots_to_keep.add(str(toot_id))
+        if str(toot_id).isdigit():
+            toots_to_keep.add(int(toot_id))
+
+    return RetentionPolicy(
+        keep_pinned=bool(config.get("keep_pinned")),
+        boosts_only=bool(config.get("boosts_only")),
+        toots_to_keep=frozenset(toots_to_keep),
+        visibility_to_keep=frozenset(
+            str(mode).lower() for mode in config.get("visibility_to_keep") or []
+        ),
+        hashtags_to_keep=frozenset(
+            str(tag).lower() for tag in config.get("hashtags_to_keep") or []
+        ),
+        cutoff=now - timedelta(days=days_to_keep(config)),
+    )
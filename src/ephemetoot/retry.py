@@ -0,0 +1,183 @@
+# standard library
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+from typing import NamedTuple
+import urllib.parse
+
+# third party
+from mastodon import (
+    MastodonAPIError,
+    MastodonNetworkError,
+    MastodonRatelimitError,
+    MastodonServerError,
+)
+
+# attempts at one action (e.g. deleting a toot), including the first
+MAX_ATTEMPTS = 6
+
+# failures in a row, across every account on a server, before its circuit breaker opens
+FAILURE_THRESHOLD = 5
+
+# how long an open circuit breaker waits before letting one request through to try again
+COOLDOWN_SECONDS = 10 * 60
+
+
+class RetryPolicy(NamedTuple):
+    """
+    How to wait between attempts after one kind of error. Waits are in units of --retry-mins: the first retry waits first * retry_mins minutes, and each wait after that is twice as long as the last, up to longest * retry_mins.
+    """
+
+    first: float
+    longest: float
+
+
+# a 5xx error is often a single failed request, so try again soon
+SERVER_ERRORS = RetryPolicy(first=0.25, longest=4)
+
+# the server can't be reached at all (e.g. it is down for maintenance, or we are offline)
+NETWORK_ERRORS = RetryPolicy(first=1, longest=8)
+
+# a rate limit says when it resets, so this is only used if it doesn't
+RATE_LIMITS = RetryPolicy(first=1, longest=5)
+
+
+def is_rate_limit(error):
+    # Mastodon.py raises a plain MastodonAPIError for a 429 if it can't tell when the limit resets
+    return isinstance(error, MastodonRatelimitError) or (
+        isinstance(error, MastodonAPIError) and error.args[1:2] == (429,)
+    )
+
+
+def policy_for(error):
+    """
+    Returns the RetryPolicy for an error, or None if trying again won't help (e.g. 401 Unauthorized or 422 Unprocessable Entity).
+    """
+    if is_rate_limit(error):
+        return RATE_LIMITS
+    if isinstance(error, MastodonServerError):
+        return SERVER_ERRORS
+    if isinstance(error, MastodonNetworkError):
+        return NETWORK_ERRORS
+    return None
+
+
+def backoff(policy, attempt, retry_mins):
+    """
+    Seconds to wait before retry number attempt (counting from 1). Half of the wait is fixed and half is random ("jitter"), so that accounts which failed together don't all retry at the same moment.
+    """
+    longest = min(policy.first * 2 ** (attempt - 1), policy.longest)
+    seconds = 60 * retry_mins * longest
+    return seconds / 2 + random.uniform(0, seconds / 2)
+
+
+def server_of(url):
+    return urllib.parse.urlsplit(url).netloc if url else None
+
+
+# seconds since the epoch until which each server asked us to wait, with a Retry-After header
+retry_after = {}
+retry_after_lock = threading.Lock()
+
+
+def record_response(response, *args, **kwargs):
+    """
+    A requests response hook for every request to a server. Any response that isn't a server error closes the server's circuit breaker. Mastodon.py doesn't pass response headers on with its errors, so this also notes any Retry-After header (in seconds or as a date) sent with a 429 or 503 response.
+    """
+    server = server_of(response.url)
+    if response.status_code < 500:
+        breaker(server).success()
+
+    value = response.headers.get("Retry-After")
+    if response.status_code not in (429, 503) or not value:
+        return
+    try:
+        until = time.time() + float(value)
+    except ValueError:
+        try:
+            until = parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError):
+            return
+    with retry_after_lock:
+        retry_after[server] = until
+
+
+def wait_time(error, attempt, retry_mins, server=None, ratelimit_reset=None):
+    """
+    Seconds to wait before trying again after error. A Retry-After header from the server is always honoured, and so is the time a rate limit resets. Otherwise the wait comes from the error's RetryPolicy.
+    """
+    with retry_after_lock:
+        until = retry_after.pop(server, None)
+    if until is not None:
+        return max(until - time.time(), 0) + 1
+    if is_rate_limit(error) and ratelimit_reset:
+        return max(ratelimit_reset - time.time(), 0) + 1
+    return backoff(policy_for(error), attempt, retry_mins)
+
+
+class CircuitOpenError(TimeoutError):
+    """
+    Raised instead of retrying when a server's circuit breaker is open.
+    """
+
+    def __init__(self, server):
+        super().__init__(str(server) + " is not responding")
+        self.server = server
+
+
+class CircuitBreaker:
+    """
+    Counts failures in a row for one server, shared by every account on it. After FAILURE_THRESHOLD failures the circuit "opens", and callers give up straight away rather than waiting to retry every toot against a server that is down. After COOLDOWN_SECONDS, one caller is let through to see if the server has recovered: if it has, the circuit closes again, and if not it stays open for another cooldown.
+    """
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN_SECONDS):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                # let this caller try, and keep everyone else waiting until it reports back
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def breaker(server):
+    with breakers_lock:
+        if server not in breakers:
+            breakers[server] = CircuitBreaker()
+        return breakers[server]
+
+
+def check_server(server):
+    """
+    Raises CircuitOpenError if the server's circuit breaker is open, so that an account on a server that is down can be skipped before any work starts.
+    """
+    if not breaker(server).allow():
+        raise CircuitOpenError(server)
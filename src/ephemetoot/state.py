@@ -0,0 +1,111 @@
+# standard library
+import hashlib
+import json
+import os
+import threading
+import time
+
+# accounts may finish at the same time when using --workers
+lock = threading.Lock()
+
+# config values that change which old toots are kept
+POLICY_KEYS = (
+    "keep_pinned",
+    "boosts_only",
+    "toots_to_keep",
+    "hashtags_to_keep",
+    "visibility_to_keep",
+    "archive",
+)
+
+# how often to save the position of a run that is still going, for --resume
+CHECKPOINT_SECONDS = 30
+
+
+def account_key(config):
+    return config["username"] + "@" + config["base_url"]
+
+
+def policy_hash(config):
+    """
+    Fingerprint of the config values that decide whether an old toot is kept. If any of these change, toots that were already checked have to be checked again.
+    """
+    values = {key: config.get(key) for key in POLICY_KEYS}
+    encoded = json.dumps(values, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def get_account(path, config):
+    """
+    Returns the saved state for this account, or an empty dict if there is none.
+    """
+    with lock:
+        return load(path).get(account_key(config), {})
+
+
+def update_account(path, config, **values):
+    """
+    Update the saved state for one account, leaving other accounts as they are. The file is replaced in one step so that an interrupted write never leaves it half-written.
+    """
+    with lock:
+        state = load(path)
+        state.setdefault(account_key(config), {}).update(values)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(temp_path, path)
+
+
+class Checkpoint:
+    """
+    Periodically saves how far through its timeline an account has got, so that a run that is interrupted or killed can carry on from there with --resume.
+    """
+
+    def __init__(self, path, config, cutoff, every=CHECKPOINT_SECONDS):
+        self.path = path
+        self.config = config
+        self.cutoff = cutoff
+        self.every = every
+        self.values = None
+        self.saved_at = time.monotonic()
+
+    def update(self, toot_id, deleted_count, kept):
+        """
+        Call after each toot is finished with. Saves to the state file if it has been long enough since the last save.
+        """
+        self.values = {
+            "max_id": str(toot_id),
+            "deleted": deleted_count,
+            "kept": kept,
+        }
+        if time.monotonic() - self.saved_at >= self.every:
+            self.save()
+
+    def save(self):
+        if self.values is None:
+            return
+        checkpoint = dict(
+            self.values,
+            cutoff=self.cutoff.isoformat(),
+            policy=policy_hash(self.config),
+        )
+        update_account(self.path, self.config, checkpoint=checkpoint)
+        self.saved_at = time.monotonic()
+
+
+def get_checkpoint(path, config):
+    """
+    Returns the checkpoint saved for this account by an unfinished run, or None if there isn't one or the keep rules have changed since.
+    """
+    checkpoint = get_account(path, config).get("checkpoint")
+    if checkpoint and checkpoint.get("policy") == policy_hash(config):
+        return checkpoint
+    return None
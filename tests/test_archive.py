@@ -0,0 +1,125 @@
+import json
+import os
+
+from ephemetoot import archive
+
+
+def test_segment_archive(tmpdir):
+    packed = archive.SegmentArchive(str(tmpdir))
+    packed.append(104136090490756999, json.dumps({"id": 104136090490756999}))
+    packed.append("5", json.dumps({"id": "5", "content": "hello"}))
+    # toots already in the archive are not appended again
+    packed.append(5, json.dumps({"id": "5", "content": "changed"}))
+
+    assert 104136090490756999 in packed
+    assert "104136090490756999" in packed
+    assert 6 not in packed
+    assert len(packed) == 2
+    assert packed.get(5) == {"id": "5", "content": "hello"}
+    assert packed.get(6) is None
+    packed.close()
+
+    # one file for all the toots, plus the index
+    assert sorted(os.listdir(tmpdir)) == ["toots-000001.jsonl", "toots.index"]
+
+
+def test_segment_archive_reopen(tmpdir):
+    packed = archive.SegmentArchive(str(tmpdir))
+    packed.append(1, json.dumps({"id": 1}))
+    packed.close()
+
+    # simulate a run killed while writing the index
+    with open(os.path.join(tmpdir, "toots.index"), "a") as f:
+        f.write("2\t1\t999\t10\n3\t1")
+
+    packed = archive.SegmentArchive(str(tmpdir))
+    assert len(packed) == 1
+    assert packed.get(1) == {"id": 1}
+    packed.append(2, json.dumps({"id": 2}))
+    assert packed.get(2) == {"id": 2}
+    packed.close()
+
+
+def test_segment_archive_rotation(tmpdir):
+    packed = archive.SegmentArchive(str(tmpdir), segment_size=30)
+    for toot_id in range(5):
+        packed.append(toot_id, json.dumps({"id": toot_id, "content": "0123456789"}))
+
+    assert len(os.listdir(tmpdir)) == 6
+    assert packed.get(4) == {"id": 4, "content": "0123456789"}
+    packed.close()
+
+
+def make_json_archive(path, count):
+    for toot_id in range(1, count + 1):
+        with open(os.path.join(path, str(toot_id) + ".json"), "w") as f:
+            f.write(json.dumps({"id": toot_id, "content": "toot"}, indent=4))
+
+
+def test_compact_archive(tmpdir):
+    make_json_archive(tmpdir, 5)
+    assert archive.compact_archive(str(tmpdir), codec="gzip", segment_size=100)
+
+    packed = archive.PackedArchive(os.path.join(tmpdir, "packed"))
+    assert len(packed) == 5
+    assert 3 in packed
+    assert 6 not in packed
+    assert packed.get(5) == {"id": 5, "content": "toot"}
+    packed.close()
+    # the original files are left alone
+    assert os.path.exists(os.path.join(tmpdir, "5.json"))
+
+
+def test_compact_archive_resume(tmpdir, monkeypatch):
+    make_json_archive(tmpdir, 5)
+    monkeypatch.setattr(archive, "CHECKPOINT_EVERY", 2)
+    compress = archive.compress
+    calls = []
+
+    def interrupted_compress(data, codec):
+        calls.append(data)
+        if len(calls) == 4:
+            raise KeyboardInterrupt
+        return compress(data, codec)
+
+    monkeypatch.setattr(archive, "compress", interrupted_compress)
+    try:
+        archive.compact_archive(str(tmpdir))
+    except KeyboardInterrupt:
+        pass
+
+    # the second run only packs the toots after the last checkpoint
+    assert archive.compact_archive(str(tmpdir))
+    assert len(calls) == 6
+
+    packed = archive.PackedArchive(os.path.join(tmpdir, "packed"))
+    assert len(packed) == 5
+    assert [packed.get(toot_id)["id"] for toot_id in range(1, 6)] == [1, 2, 3, 4, 5]
+    packed.close()
+
+
+def test_media_store(tmpdir):
+    store = archive.MediaStore(str(tmpdir))
+    for url in ["https://one.social/a.jpg", "https://cdn.two.social/b.jpg"]:
+        temp_path = store.temp_path(url)
+        with open(temp_path, "wb") as f:
+            f.write(b"the same image")
+        store.add(url, temp_path)
+
+    # both URLs point to the one stored file
+    assert "https://one.social/a.jpg" in store
+    assert store.path_for("https://one.social/a.jpg") == store.path_for(
+        "https://cdn.two.social/b.jpg"
+    )
+    assert len(os.listdir(os.path.join(tmpdir, "blobs"))) == 1
+    assert os.listdir(os.path.join(tmpdir, "tmp")) == []
+    store.close()
+
+    # a line partly written when a run was killed is ignored
+    with open(os.path.join(tmpdir, archive.MEDIA_INDEX_FILE), "a") as f:
+        f.write("9f86d0\thttps://three.social/c.jpg")
+
+    store = archive.MediaStore(str(tmpdir))
+    assert "https://cdn.two.social/b.jpg" in store
+    assert "https://three.social/c.jpg" not in store
+    store.close()
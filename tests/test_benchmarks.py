@@ -0,0 +1,52 @@
+import os
+import sys
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+import fake_mastodon
+import benchmark
+
+
+def test_fake_mastodon_paging():
+    server = fake_mastodon.start(toots=30, delete_limit=1)
+    try:
+        url = server.url + "/api/v1/accounts/1/statuses"
+        first = requests.get(url, params={"limit": 20}).json()
+        rest = requests.get(url, params={"limit": 20, "max_id": first[-1]["id"]}).json()
+        ids = [int(toot["id"]) for toot in first + rest]
+        assert len(ids) == 30
+        assert ids == sorted(ids, reverse=True)
+
+        deleted = requests.delete(server.url + "/api/v1/statuses/" + str(ids[1]))
+        assert deleted.status_code == 200
+        assert deleted.headers["X-RateLimit-Remaining"] == "0"
+        # only one delete is allowed in this window
+        limited = requests.delete(server.url + "/api/v1/statuses/" + str(ids[2]))
+        assert limited.status_code == 429
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    stats = server.fake.stats()
+    assert stats["deleted"] == 1
+    assert stats["remaining"] == 29
+    assert stats["calls"]["rate_limited"] == 1
+
+
+def test_startup():
+    results = benchmark.startup(runs=3)
+    # nothing that is only needed to check toots is imported at start up
+    assert results["heavy_modules"] == []
+    assert results["console_import"] < results["mastodon_import"] / 4
+
+
+def test_benchmark():
+    # 20 toots, six hours apart: 12 are newer than 3 days
+    results = benchmark.benchmark(toots=20, days_to_keep=3)
+    assert results["evaluated"] == 20
+    # unlisted toots are kept
+    assert 0 < results["removed"] <= 8
+    assert results["api_calls"] == 4 + results["removed"]
+    assert results["evaluated_per_second"] > 0
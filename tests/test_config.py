@@ -0,0 +1,124 @@
+import json
+import os
+
+import pytest
+
+from ephemetoot import config
+
+GOOD = """
+- access_token: abcd_1234
+  username: alice
+  base_url: test.social
+  days_to_keep: 14
+  keep_pinned: true
+  hashtags_to_keep:
+    -
+  visibility_to_keep: [direct]
+"""
+
+BAD = """
+- access_token: abcd_1234
+  username: alice
+  base_url: test.social
+  days_to_keep: two weeks
+  keep_pined: true
+- username: bob
+  base_url: test.social
+  toots_to_keep:
+  visibility_to_keep: [secret]
+- access_token: efgh_5678
+  username: alice
+  base_url: test.social
+"""
+
+
+def write(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+    return path
+
+
+def test_check_users():
+    users, problems, warnings = config.check_users(config.parse(BAD))
+    assert len(users) == 3
+    # every problem is reported, not just the first
+    assert problems == [
+        "account 1 (alice@test.social): days_to_keep must be a number of days",
+        "account 2 (bob@test.social): there is no value for access_token",
+        "account 2 (bob@test.social): toots_to_keep must be a list, even if it is empty",
+        "account 2 (bob@test.social): visibility_to_keep can only include public, unlisted, private, direct",
+        "account 3 (alice@test.social): is in the config file more than once",
+    ]
+    # settings that aren't known are only warned about
+    assert warnings == [
+        "account 1 (alice@test.social): keep_pined is not a setting ephemetoot knows about, so it is ignored"
+    ]
+
+
+def test_check_users_not_a_list():
+    users, problems, warnings = config.check_users(config.parse("username: alice\n"))
+    assert problems == [
+        "the config file should be a list of accounts, each starting with '-'"
+    ]
+
+
+def test_load_users(tmpdir):
+    path = write(str(tmpdir.join("config.yaml")), GOOD)
+    users = config.load_users(path)
+    assert users[0]["username"] == "alice"
+    assert users[0]["hashtags_to_keep"] == [None]
+
+    cache_path = config.cache_path(path)
+    assert os.path.basename(cache_path) == ".config.yaml.cache"
+    assert os.stat(cache_path).st_mode & 0o777 == 0o600
+
+    # the cache is used while the file is unchanged
+    with open(cache_path) as f:
+        cache = json.load(f)
+    cache["users"][0]["username"] = "cached"
+    with open(cache_path, "w") as f:
+        json.dump(cache, f)
+    assert config.load_users(path)[0]["username"] == "cached"
+
+    # touching the file changes its modification time, but not its hash
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert config.load_users(path)[0]["username"] == "cached"
+
+    write(path, GOOD.replace("alice", "bob"))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+    assert config.load_users(path)[0]["username"] == "bob"
+
+
+def test_load_users_errors(tmpdir):
+    path = write(str(tmpdir.join("config.yaml")), BAD)
+    with pytest.raises(config.ConfigError) as e:
+        config.load_users(path)
+    assert len(e.value.errors) == 5
+    # only a good config is cached
+    assert not os.path.exists(config.cache_path(path))
+
+    write(path, "- username: [alice\n")
+    with pytest.raises(config.ConfigError) as e:
+        config.load_users(path)
+    assert e.value.errors[0].startswith("the config file is not valid YAML")
+
+    with pytest.raises(FileNotFoundError):
+        config.load_users(str(tmpdir.join("missing.yaml")))
+
+
+def test_load_users_warnings(capfd, tmpdir):
+    path = write(str(tmpdir.join("config.yaml")), GOOD + "  old_setting: true\n")
+    users = config.load_users(path)
+    assert users[0]["old_setting"] is True
+    warning = "⚠️  account 1 (alice@test.social): old_setting is not a setting ephemetoot knows about, so it is ignored\n"
+    assert capfd.readouterr().out == warning
+
+    # the warning is repeated when the cache is used
+    config.load_users(path)
+    assert capfd.readouterr().out == warning
+
+    config.load_users(path, log_format="json")
+    record = json.loads(capfd.readouterr().out)
+    assert record["event"] == "config_warning"
+    assert record["warning"] == warning[4:-1]
@@ -0,0 +1,110 @@
+import os
+import threading
+
+import pytest
+
+from ephemetoot import daemon
+from ephemetoot import ephemetoot
+
+from test_ephemetoot import Namespace
+
+alice = {"access_token": "abcd_1234", "username": "alice", "base_url": "test.social"}
+bob = {"access_token": "efgh_5678", "username": "bob", "base_url": "test.social"}
+
+
+@pytest.fixture(autouse=True)
+def clear_abort():
+    yield
+    ephemetoot.abort.clear()
+
+
+def options(minutes=60):
+    options = Namespace()
+    options.daemon = minutes
+    options.metrics = None
+    return options
+
+
+def test_interval():
+    assert daemon.interval(alice, options(60)) == 3600
+    assert daemon.interval(dict(alice, interval_mins=5), options(60)) == 300
+
+
+def test_schedule():
+    schedule = daemon.Schedule()
+    bob_often = dict(bob, interval_mins=1)
+    schedule.load([alice, bob_often], now=100)
+    assert schedule.pop_due(100) == [alice, bob_often]
+    assert schedule.next_due() is None
+
+    schedule.done(alice, options(), now=110)
+    schedule.done(bob_often, options(), now=110)
+    assert schedule.next_due() == 110 + 60
+    assert schedule.pop_due(150) == []
+    assert schedule.pop_due(3710) == [alice, bob_often]
+    schedule.done(bob_often, options(), now=3720)
+
+    # bob keeps his place when the config is reloaded, and carol is due straight away
+    carol = dict(alice, username="carol")
+    schedule.load([bob, carol], now=4000)
+    assert schedule.due == {"bob@test.social": 3720 + 60, "carol@test.social": 4000}
+    # alice was removed from the config while being checked
+    schedule.done(alice, options(), now=4010)
+    assert "alice@test.social" not in schedule.due
+
+
+def test_next_wait(monkeypatch):
+    queued = options()
+    queued.expiry_queue = True
+    monkeypatch.setattr(daemon.time, "time", lambda: 1000)
+    monkeypatch.setattr(daemon.expiry, "next_expiry", lambda path, config: 1300)
+    assert daemon.next_wait(alice, options()) is None
+    assert daemon.next_wait(alice, queued) == 300
+
+    # the next toot expires before the next interval, so check again then
+    schedule = daemon.Schedule()
+    schedule.load([alice], now=0)
+    schedule.done(alice, queued, now=10, wait=daemon.next_wait(alice, queued))
+    assert schedule.due == {"alice@test.social": 310}
+
+    # an overdue queue (e.g. because the server is down) isn't retried straight away
+    monkeypatch.setattr(daemon.expiry, "next_expiry", lambda path, config: 900)
+    assert daemon.next_wait(alice, queued) == daemon.QUEUE_RETRY_SECONDS
+
+
+def test_run(tmpdir, monkeypatch):
+    config_file = str(tmpdir.join("config.yaml"))
+    with open(config_file, "w") as f:
+        f.write("- username: alice\n  base_url: test.social\n  access_token: a\n")
+        f.write("  interval_mins: 0.000000001\n")
+
+    checked = []
+
+    def check_account(config, options):
+        checked.append(config["username"])
+        if len(checked) == 2:
+            # add an account, making sure the modification time changes
+            with open(config_file, "a") as f:
+                f.write("- username: bob\n  base_url: test.social\n  access_token: b\n")
+            stat = os.stat(config_file)
+            os.utime(config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        if len(checked) == 4:
+            ephemetoot.abort.set()
+
+    reported = []
+    monkeypatch.setattr(ephemetoot, "check_account", check_account)
+    monkeypatch.setattr(
+        ephemetoot, "report_archiving", lambda options: reported.append(1)
+    )
+    monkeypatch.setattr(daemon, "CONFIG_POLL_SECONDS", 0.01)
+    thread = threading.Timer(5, ephemetoot.abort.set)  # in case it never stops
+    thread.start()
+    try:
+        daemon.run(config_file, options())
+    finally:
+        thread.cancel()
+
+    # alice is checked every time round, and bob as soon as he is added
+    assert checked == ["alice", "alice", "alice", "bob"]
+    # media downloads are reported after every round of checks, not just at exit
+    assert len(reported) >= 3
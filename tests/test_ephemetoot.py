@@ -1,15 +1,24 @@
+from concurrent.futures import wait
 import datetime
 from datetime import timezone
 from dateutil.tz import tzutc
+import http.client
 import json
 import os
 import subprocess
 import sys
+import threading
+import time
 
 import pytest
 import requests
 
+from mastodon import MastodonAPIError, MastodonNetworkError, MastodonRatelimitError
+
+from ephemetoot import commands
 from ephemetoot import ephemetoot
+from ephemetoot import metrics
+from ephemetoot import state
 
 
 ########################
@@ -111,6 +120,12 @@ def dict2obj(d):
     return obj
 
 
+# dict with attribute access, like the objects Mastodon.py returns
+class AttribDict(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
 # here is our toot object - use this in tests
 toot = dict2obj(toot_dict)
 
@@ -142,6 +157,27 @@ class MockMedia:
     content = f.read()
     f.close()
 
+    def __init__(self, start=0, length=None):
+        self.status_code = 206 if start else 200
+        self.body = self.content[start:]
+        self.headers = {"Content-Length": str(len(self.body))}
+        # simulate the connection dropping part way through
+        if length is not None:
+            self.body = self.body[:length]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return None
+
+    def raise_for_status(self):
+        return None
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i : i + chunk_size]
+
 
 # mock Mastodon
 class Mocktodon:
@@ -187,27 +223,160 @@ class Mocktodon:
         return this_batch
 
 
+# mock process_toot, simulating a toot being deleted
+def mock_process_toot(config, options, mastodon, toot, deleted_count, **kwargs):
+    return deleted_count + 1
+
+
+# mock Mastodon that has hit the rate limit for deletes once
+class RateLimitedMocktodon(Mocktodon):
+    def __init__(self):
+        self.ratelimit_remaining = 0
+        self.ratelimit_reset = 1000
+        self.deleted = []
+        self.limited = True
+
+    def status_delete(self, t=toot):
+        if self.limited:
+            self.limited = False
+            raise MastodonRatelimitError("Hit rate limit.")
+        self.deleted.append(t.id)
+
+
+# mock Mastodon with a long timeline, returned one toot per page
+class LongMocktodon(Mocktodon):
+    def account_statuses(self, user_id=None, limit=None, max_id=3000):
+        if max_id <= 1:
+            return []
+        return [dict2obj({"id": max_id - 1})]
+
+
+# mock Mastodon with snowflake IDs, one toot per hour for 100 days, newest first
+class SnowflakeMocktodon(Mocktodon):
+    def __init__(self):
+        now = datetime.datetime(2020, 6, 1, tzinfo=timezone.utc)
+        self.toots = []
+        for hours in range(2400):
+            created_at = now - datetime.timedelta(hours=hours)
+            status_id = int(created_at.timestamp() * 1000) << 16
+            self.toots.append(dict2obj({"id": status_id, "created_at": created_at}))
+        self.max_ids = []
+
+    def account_statuses(self, user_id=None, limit=None, max_id=None):
+        self.max_ids.append(max_id)
+        if max_id is None:
+            return self.toots[:limit]
+        return [t for t in self.toots if t.id < max_id][:limit]
+
+
+# mock Mastodon with snowflake IDs, which reports the rate limit for fetching pages
+class PagingMocktodon(SnowflakeMocktodon):
+    def account_statuses(self, user_id=None, limit=None, max_id=None):
+        self.ratelimit_remaining = 299
+        return super().account_statuses(user_id, limit, max_id)
+
+
+# mock Mastodon with snowflake IDs, which can't be reached for one fetch partway through
+class FlakyMocktodon(SnowflakeMocktodon):
+    def account_statuses(self, user_id=None, limit=None, max_id=None):
+        if len(self.max_ids) == 2:
+            self.max_ids.append(max_id)
+            raise MastodonNetworkError("Could not complete request")
+        return super().account_statuses(user_id, limit, max_id)
+
+
+# mock Mastodon for a whole run, which is interrupted after a number of deletes
+class InterruptedMocktodon(SnowflakeMocktodon):
+    def __init__(self, interrupt_after=None):
+        now = datetime.datetime.now(timezone.utc)
+        self.toots = []
+        for hours in range(100):
+            created_at = now - datetime.timedelta(hours=hours)
+            status_id = int(created_at.timestamp() * 1000) << 16
+            self.toots.append(
+                AttribDict(
+                    id=status_id,
+                    created_at=created_at,
+                    visibility="public",
+                    tags=[],
+                    reblog=None,
+                )
+            )
+        self.max_ids = []
+        self.deleted = []
+        self.interrupt_after = interrupt_after
+
+    def account_verify_credentials(self):
+        return AttribDict(id=1)
+
+    def account(self, user_id):
+        return AttribDict(statuses_count=len(self.toots))
+
+    def account_statuses(self, user_id=None, limit=None, max_id=None):
+        if max_id is not None:
+            max_id = int(max_id)
+        return super().account_statuses(user_id, limit, max_id)
+
+    def status_delete(self, toot):
+        if len(self.deleted) == self.interrupt_after:
+            raise KeyboardInterrupt
+        self.deleted.append(toot.id)
+
+
+# mock Mastodon for a whole run, which refuses to delete one toot
+class RefusingMocktodon(InterruptedMocktodon):
+    refuse = None
+
+    def status(self, status_id):
+        return [t for t in self.toots if str(t.id) == str(status_id)][0]
+
+    def status_delete(self, toot):
+        if toot.id == self.refuse:
+            raise MastodonAPIError("Mastodon API returned error", 422, "", "Nope")
+        super().status_delete(toot)
+
+
 # mock argparse objects (options)
 class Namespace:
     def __init__(
         self,
         archive_deleted=False,
         datestamp=False,
+        expiry_queue=False,
         hide_skipped=False,
+        instance_workers=2,
+        log_format="text",
+        pace=False,
+        plan=None,
+        pool_size=10,
         retry_mins=1,
         schedule=False,
+        state=None,
         test=False,
         time=False,
         quiet=False,
+        resume=False,
+        verbose=False,
+        workers=1,
     ):
         self.archive_deleted = archive_deleted
         self.datestamp = datestamp
+        self.expiry_queue = expiry_queue
         self.schedule = schedule
+        self.state = state
         self.time = time
         self.test = test
         self.hide_skipped = hide_skipped
+        self.instance_workers = instance_workers
+        self.log_format = log_format
+        self.pace = pace
+        self.plan = plan
+        self.pool_size = pool_size
         self.quiet = quiet
+        self.resume = resume
         self.retry_mins = retry_mins
+        self.verbose = verbose
+        self.workers = workers
 
 
 @pytest.fixture
@@ -245,6 +414,20 @@ def test_archive_toot(tmpdir):
     assert file_exists
 
 
+def test_archive_toot_jsonl(tmpdir):
+    p = tmpdir.mkdir("archive")
+    config_file["archive"] = str(p)
+    config_file["archive_format"] = "jsonl"
+    ephemetoot.archive_toot(config_file, AttribDict(toot_dict))
+    ephemetoot.finish_archiving()
+    del config_file["archive_format"]
+
+    # no file per toot, just a segment and its index
+    assert not os.path.exists(p + "/104136090490756999.json")
+    with open(p + "/toots-000001.jsonl") as f:
+        assert json.loads(f.readline())["id"] == 104136090490756999
+
+
 def test_archive_toot_media(mock_archive_response, tmpdir):
     p = tmpdir.mkdir("archive")
     config_file["archive"] = str(p)  # make archive directory a temp test dir
@@ -255,6 +438,159 @@ def test_archive_toot_media(mock_archive_response, tmpdir):
     assert image_exists
 
 
+def test_archive_toot_media_incomplete(tmpdir, monkeypatch):
+    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: MockMedia(length=100))
+    p = tmpdir.mkdir("archive")
+    with pytest.raises(IOError):
+        ephemetoot.archive_toot_media(p, toot.media_attachments[0].url)
+    # the partial download is kept to resume next time, but not treated as complete
+    assert not os.path.exists(p + "/hugh.run/success/accomplished.jpg")
+    assert os.path.getsize(p + "/hugh.run/success/accomplished.jpg.part") == 100
+
+
+def test_archive_toot_media_resume(tmpdir, monkeypatch):
+    requested = []
+
+    def mock_get(url, headers={}, **kwargs):
+        requested.append(headers)
+        return MockMedia(start=100)
+
+    monkeypatch.setattr(requests, "get", mock_get)
+    p = tmpdir.mkdir("archive")
+    os.makedirs(p + "/hugh.run/success")
+    with open(p + "/hugh.run/success/accomplished.jpg.part", "wb") as f:
+        f.write(MockMedia.content[:100])
+
+    ephemetoot.archive_toot_media(p, toot.media_attachments[0].url)
+    assert requested == [{"Range": "bytes=100-"}]
+    with open(p + "/hugh.run/success/accomplished.jpg", "rb") as f:
+        assert f.read() == MockMedia.content
+    assert not os.path.exists(p + "/hugh.run/success/accomplished.jpg.part")
+
+
+def test_archive_toot_media_background(tmpdir, monkeypatch):
+    urls = []
+
+    def mock_session_get(self, url, **kwargs):
+        urls.append(url)
+        return MockMedia()
+
+    monkeypatch.setattr(requests.Session, "get", mock_session_get)
+    p = tmpdir.mkdir("archive")
+    config_file["archive"] = str(p)
+    config_file["archive_media"] = True
+    # toots from Mastodon.py are dicts with attribute access
+    toot = AttribDict(toot_dict)
+    ephemetoot.archive_toot(config_file, toot)
+    # the same attachment on a second toot is only downloaded once
+    ephemetoot.archive_toot(config_file, toot)
+    ephemetoot.finish_archiving()
+    config_file["archive_media"] = False
+
+    assert urls == ["https://hugh.run/success/accomplished.jpg"]
+    assert os.path.exists(p + "/hugh.run/success/accomplished.jpg")
+
+
+def test_media_archiver_report(capfd, tmpdir, monkeypatch):
+    def broken_download(archive_path, full_url, session=None):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(ephemetoot, "archive_toot_media", broken_download)
+    archiver = ephemetoot.MediaArchiver()
+    archiver.submit(str(tmpdir), "https://hugh.run/success/accomplished.jpg")
+    wait(list(archiver.futures.values()))
+    archiver.report()
+
+    # failures are reported as they finish, and finished downloads are forgotten
+    assert capfd.readouterr().out == (
+        "🛑 ERROR archiving media - https://hugh.run/success/accomplished.jpg"
+        " - No space left on device\n"
+    )
+    assert archiver.futures == {}
+    archiver.finish()
+
+
+def test_media_archiver_report_json(capfd, tmpdir, monkeypatch):
+    def broken_download(archive_path, full_url, session=None):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(ephemetoot, "archive_toot_media", broken_download)
+    archiver = ephemetoot.MediaArchiver()
+    archiver.submit(str(tmpdir), "https://hugh.run/success/accomplished.jpg")
+    archiver.finish(Namespace(log_format="json"))
+    record = json.loads(capfd.readouterr().out)
+    assert record["event"] == "error"
+    assert record["url"] == "https://hugh.run/success/accomplished.jpg"
+    assert record["detail"] == "No space left on device"
+
+
+def test_archive_toot_media_store(tmpdir, monkeypatch):
+    urls = []
+
+    def mock_session_get(self, url, **kwargs):
+        urls.append(url)
+        return MockMedia()
+
+    monkeypatch.setattr(requests.Session, "get", mock_session_get)
+    config_file["archive"] = str(tmpdir.mkdir("archive"))
+    config_file["archive_media"] = True
+    config_file["media_store"] = str(tmpdir.mkdir("media"))
+    ephemetoot.archive_toot(config_file, AttribDict(toot_dict))
+    # the same image from another server
+    other = AttribDict(toot_dict)
+    other["media_attachments"] = [{"url": "https://cdn.hugh.run/accomplished.jpg"}]
+    ephemetoot.archive_toot(config_file, other)
+    # another account may write the same media_store differently
+    config_file["media_store"] = os.path.join(tmpdir, "media", "..", "media")
+    ephemetoot.archive_toot(config_file, other)
+    assert len(ephemetoot.get_media_archiver().futures) == 2
+    ephemetoot.finish_archiving()
+    config_file["archive_media"] = False
+    del config_file["media_store"]
+
+    assert len(urls) == 2
+    blobs = os.listdir(os.path.join(tmpdir, "media", "blobs"))
+    assert len(blobs) == 1
+    assert len(os.listdir(os.path.join(tmpdir, "media", "blobs", blobs[0]))) == 1
+
+
+def test_check_accounts(capfd, monkeypatch):
+    accounts = [
+        {
+            "username": "user" + str(i),
+            "base_url": "one.social" if i < 4 else "two.social",
+        }
+        for i in range(6)
+    ]
+    options = Namespace(workers=4, instance_workers=2)
+    lock = threading.Lock()
+    active = {}
+    most = {}
+
+    def mock_check_toots(config, options):
+        base_url = config["base_url"]
+        with lock:
+            active[base_url] = active.get(base_url, 0) + 1
+            most[base_url] = max(most.get(base_url, 0), active[base_url])
+        print("start", config["username"])
+        time.sleep(0.05)
+        print("end", config["username"])
+        with lock:
+            active[base_url] -= 1
+
+    monkeypatch.setattr("ephemetoot.ephemetoot.check_toots", mock_check_toots)
+    ephemetoot.check_accounts(accounts, options)
+    output = capfd.readouterr().out.split("\n")
+
+    # every account ran, and no server had more than two accounts running at once
+    assert len(output) == 13
+    assert most == {"one.social": 2, "two.social": 2}
+    # each account's lines are printed together
+    for i in range(0, 12, 2):
+        assert output[i].startswith("start ")
+        assert output[i + 1] == "end " + output[i][6:]
+
+
 def test_check_batch(capfd, monkeypatch):
     config = config_file
     options = Namespace(archive_deleted=False)
@@ -264,10 +600,7 @@ def test_check_batch(capfd, monkeypatch):
     timeline = mastodon.account_statuses(user_id=user_id, limit=2, max_id=0)
     # monkeypatch process_toot to add 1 to deleted_count and return
     # this simulates what would happen if the toot was being deleted
-    monkeypatch.setattr(
-        "ephemetoot.ephemetoot.process_toot",
-        lambda config, options, mastodon, toot, deleted_count: deleted_count + 1,
-    )
+    monkeypatch.setattr("ephemetoot.ephemetoot.process_toot", mock_process_toot)
     # run check_batch
     ephemetoot.check_batch(config, options, mastodon, user_id, timeline, 0)
     # deleted_count should be 10
@@ -275,16 +608,25 @@ def test_check_batch(capfd, monkeypatch):
     assert output[0] == "Removed 10 toots for alice@test.social."
 
 
+def test_check_batch_many_pages(capfd, monkeypatch):
+    # more pages than the recursion limit would allow if each page was a stack frame
+    config = config_file
+    options = Namespace(archive_deleted=False)
+    mastodon = LongMocktodon()
+    timeline = mastodon.account_statuses()
+    monkeypatch.setattr("ephemetoot.ephemetoot.process_toot", mock_process_toot)
+    ephemetoot.check_batch(config, options, mastodon, "test_user_id", timeline, 0)
+    output = capfd.readouterr().out.split("\n")
+    assert output[0] == "Removed 2999 toots for alice@test.social."
+
+
 def test_check_batch_quiet(capfd, monkeypatch):
     config = config_file
     options = Namespace(archive_deleted=False, quiet=1)
     mastodon = Mocktodon()
     user_id = "test_user_id"
     timeline = mastodon.account_statuses(user_id=user_id, limit=2, max_id=0)
-    monkeypatch.setattr(
-        "ephemetoot.ephemetoot.process_toot",
-        lambda config, options, mastodon, toot, deleted_count: deleted_count + 1,
-    )
+    monkeypatch.setattr("ephemetoot.ephemetoot.process_toot", mock_process_toot)
     ephemetoot.check_batch(config, options, mastodon, user_id, timeline, 0)
     # deleted_count should be 10
     output = capfd.readouterr().out.split("\n")
@@ -298,10 +640,7 @@ def test_check_batch_quiet_no_toots(capfd, monkeypatch):
     user_id = "test_user_id"
     # max_id is the last toot in our batch so this returns no toots
     timeline = mastodon.account_statuses(user_id=user_id, limit=2, max_id=10)
-    monkeypatch.setattr(
-        "ephemetoot.ephemetoot.process_toot",
-        lambda config, options, mastodon, toot, deleted_count: deleted_count + 1,
-    )
+    monkeypatch.setattr("ephemetoot.ephemetoot.process_toot", mock_process_toot)
     # run check_batch
     ephemetoot.check_batch(config, options, mastodon, user_id, timeline, 0)
     # deleted_count should be 0 but with quiet=2 there should be not output
@@ -315,10 +654,7 @@ def test_check_batch_qq(capfd, monkeypatch):
     mastodon = Mocktodon()
     user_id = "test_user_id"
     timeline = mastodon.account_statuses(user_id=user_id, limit=2, max_id=0)
-    monkeypatch.setattr(
-        "ephemetoot.ephemetoot.process_toot",
-        lambda config, options, mastodon, toot, deleted_count: deleted_count + 1,
-    )
+    monkeypatch.setattr("ephemetoot.ephemetoot.process_toot", mock_process_toot)
     ephemetoot.check_batch(config, options, mastodon, user_id, timeline, 0)
     # deleted_count should be 10 and message printed since there was a delete
     output = capfd.readouterr().out.split("\n")
@@ -334,7 +670,7 @@ def test_check_batch_qq_no_deletes(capfd, monkeypatch):
     # simulate no deletes occuring
     monkeypatch.setattr(
         "ephemetoot.ephemetoot.process_toot",
-        lambda config, options, mastodon, toot, deleted_count: 0,
+        lambda config, options, mastodon, toot, deleted_count, **kwargs: 0,
     )
     # run check_batch
     ephemetoot.check_batch(config, options, mastodon, user_id, timeline, 0)
@@ -349,10 +685,7 @@ def test_check_batch_qqq(capfd, monkeypatch):
     mastodon = Mocktodon()
     user_id = "test_user_id"
     timeline = mastodon.account_statuses(user_id=user_id, limit=2, max_id=0)
-    monkeypatch.setattr(
-        "ephemetoot.ephemetoot.process_toot",
-        lambda config, options, mastodon, toot, deleted_count: deleted_count + 1,
-    )
+    monkeypatch.setattr("ephemetoot.ephemetoot.process_toot", mock_process_toot)
     # run check_batch
     ephemetoot.check_batch(config, options, mastodon, user_id, timeline, 0)
     # deleted_count should be 10 and no message should be printed since quiet=3
@@ -360,25 +693,161 @@ def test_check_batch_qqq(capfd, monkeypatch):
     assert output == ""
 
 
-def test_console_print(capfd):
-    ephemetoot.console_print(
-        "test123", Namespace(test=False, hide_skipped=False, quiet=False), False
+def test_check_batch_stop_before(capfd, monkeypatch):
+    config = config_file
+    options = Namespace(archive_deleted=False)
+    mastodon = Mocktodon()
+    user_id = "test_user_id"
+    # newest toot first, as the API returns them
+    timeline = list(reversed(mastodon.account_statuses(limit=10, max_id=0)))
+    monkeypatch.setattr("ephemetoot.ephemetoot.process_toot", mock_process_toot)
+    # toots 1 to 4 are older than this, so were checked by the last run
+    stop_before = datetime.datetime(2018, 11, 5, tzinfo=tzutc())
+    ephemetoot.check_batch(
+        config, options, mastodon, user_id, timeline, 0, stop_before=stop_before
     )
-    assert capfd.readouterr().out == "test123\n"
+    output = capfd.readouterr().out.split("\n")
+    assert output[0] == "Removed 6 toots for alice@test.social."
 
 
-def test_console_print_quiet():
-    result = ephemetoot.console_print(
-        "test123", Namespace(test=False, hide_skipped=False, quiet=True), False
+def test_check_batch_verbose(capfd, monkeypatch):
+    config = config_file
+    options = Namespace(archive_deleted=False, verbose=True)
+    mastodon = Mocktodon()
+    timeline = mastodon.account_statuses(limit=2, max_id=0)
+    monkeypatch.setattr("ephemetoot.ephemetoot.process_toot", mock_process_toot)
+    ephemetoot.check_batch(config, options, mastodon, "test_user_id", timeline, 0)
+    output = capfd.readouterr().out.split("\n")
+    assert output[0] == "Removed 10 toots for alice@test.social."
+    if sys.platform != "win32":
+        assert output[6].startswith("Peak memory use: ")
+
+
+def test_check_toots_resume(capfd, tmpdir, monkeypatch):
+    config = {
+        "access_token": "abcd_1234",
+        "username": "alice",
+        "base_url": "test.social",
+        "days_to_keep": 1,
+    }
+    path = str(tmpdir.join("state.json"))
+    monkeypatch.setattr(time, "sleep", lambda secs: None)
+
+    # the first run is stopped part way through
+    first = InterruptedMocktodon(interrupt_after=30)
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: first)
+    ephemetoot.check_toots(config, Namespace(state=path))
+    assert len(first.deleted) == 30
+    checkpoint = state.get_checkpoint(path, config)
+    assert checkpoint["max_id"] == str(first.deleted[-1])
+    assert checkpoint["deleted"] == 30
+
+    # the next run carries on from the checkpoint
+    second = InterruptedMocktodon()
+    second.toots = [t for t in first.toots if t.id < first.deleted[-1]]
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: second)
+    ephemetoot.check_toots(config, Namespace(state=path, resume=True))
+    assert second.max_ids[0] == first.deleted[-1]
+    assert len(first.deleted + second.deleted) == 100 - 24
+    assert "Removed 76 toots for alice@test.social." in capfd.readouterr().out
+    # the run finished, so there's nothing to resume
+    assert state.get_checkpoint(path, config) is None
+    assert "cutoff" in state.get_account(path, config)
+
+
+def test_check_toots_resume_with_state(capfd, tmpdir, monkeypatch):
+    config = {
+        "access_token": "abcd_1234",
+        "username": "alice",
+        "base_url": "test.social",
+        "days_to_keep": 1,
+    }
+    path = str(tmpdir.join("state.json"))
+    mastodon = InterruptedMocktodon()
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: mastodon)
+    now = datetime.datetime.now(timezone.utc)
+
+    # the last full run checked toots older than 33 and a half hours, and the run after it
+    # removed 50 toots before it was interrupted at the toot from 27 hours ago
+    state.update_account(
+        path,
+        config,
+        cutoff=(now - datetime.timedelta(hours=33.5)).isoformat(),
+        policy=state.policy_hash(config),
+        kept={},
     )
-    assert result == None
-
-
-def test_console_print_skip():
-    result = ephemetoot.console_print(
-        "test123", Namespace(test=False, hide_skipped=True, quiet=False), True
+    state.update_account(
+        path,
+        config,
+        checkpoint={
+            "max_id": str(mastodon.toots[27].id),
+            "deleted": 50,
+            "kept": {},
+            "cutoff": (now - datetime.timedelta(days=1)).isoformat(),
+            "policy": state.policy_hash(config),
+        },
     )
-    assert result == None
+    ephemetoot.check_toots(config, Namespace(state=path, resume=True))
+    # the toots from 28 to 33 hours ago are removed, and added to the earlier 50
+    assert len(mastodon.deleted) == 6
+    assert "Removed 56 toots for alice@test.social." in capfd.readouterr().out
+
+
+def test_check_toots_state_failed(capfd, tmpdir, monkeypatch):
+    config = {
+        "access_token": "abcd_1234",
+        "username": "alice",
+        "base_url": "test.social",
+        "days_to_keep": 1,
+    }
+    path = str(tmpdir.join("state.json"))
+    first = RefusingMocktodon()
+    first.refuse = first.toots[50].id
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: first)
+    ephemetoot.check_toots(config, Namespace(state=path))
+    assert len(first.deleted) == 75
+    assert "Removed 75 toots for alice@test.social." in capfd.readouterr().out
+    kept = state.get_account(path, config)["kept"]
+    assert kept == {str(first.refuse): "failed"}
+
+    # the toot is older than the saved cutoff, but is tried again
+    second = RefusingMocktodon()
+    second.toots = [t for t in first.toots if t.id not in first.deleted]
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: second)
+    ephemetoot.check_toots(config, Namespace(state=path))
+    assert second.deleted == [first.refuse]
+    assert state.get_account(path, config)["kept"] == {}
+
+
+def test_connect(monkeypatch):
+    clients = []
+    monkeypatch.setattr(ephemetoot, "Mastodon", lambda **kwargs: clients.append(kwargs))
+    monkeypatch.setattr(ephemetoot, "sessions", {})
+    options = Namespace()
+    ephemetoot.connect(config_file, options)
+    ephemetoot.connect(dict(config_file, access_token="efgh_5678"), options)
+    ephemetoot.connect(dict(config_file, base_url="other.social"), options)
+
+    # accounts on the same server share a session, but not their access token
+    assert clients[0]["api_base_url"] == "https://test.social"
+    assert clients[0]["session"] is clients[1]["session"]
+    assert clients[1]["access_token"] == "efgh_5678"
+    assert clients[2]["session"] is not clients[0]["session"]
+    adapter = clients[0]["session"].get_adapter("https://test.social")
+    assert adapter._pool_maxsize == 10
+
+    # cookies set by the server are not kept
+    session = clients[0]["session"]
+    headers = http.client.HTTPMessage()
+    headers["Set-Cookie"] = "session=secret; Path=/"
+    request = requests.Request("GET", "https://test.social/api/v1/statuses").prepare()
+    session.cookies.extract_cookies(
+        requests.cookies.MockResponse(headers), requests.cookies.MockRequest(request)
+    )
+    assert len(session.cookies) == 0
+
+    ephemetoot.close_sessions()
+    assert ephemetoot.sessions == {}
 
 
 def test_datestamp_now():
@@ -388,6 +857,102 @@ def test_datestamp_now():
     assert datetime.datetime.now(timezone.utc).timetuple() == date_object.timetuple()
 
 
+def test_delete_scheduler(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "time", lambda: 1000.0)
+    monkeypatch.setattr(time, "sleep", lambda secs: sleeps.append(secs))
+    mastodon = RateLimitedMocktodon()
+    scheduler = ephemetoot.DeleteScheduler(mastodon, Namespace(quiet=True))
+
+    # nothing is known about the budget before the first delete
+    scheduler.wait()
+    assert sleeps == []
+
+    # budget left: no need to wait
+    mastodon.ratelimit_remaining = 12
+    mastodon.ratelimit_reset = 1300
+    scheduler.record()
+    scheduler.wait()
+    assert sleeps == []
+
+    # budget used up: wait until exactly when it resets
+    mastodon.ratelimit_remaining = 0
+    scheduler.record()
+    scheduler.wait()
+    assert sleeps == [300.0]
+
+
+def test_delete_scheduler_no_rate_limit_info():
+    # Mocktodon does not provide numeric rate limit values
+    scheduler = ephemetoot.DeleteScheduler(Mocktodon(), Namespace())
+    scheduler.record()
+    assert scheduler.remaining == None
+
+
+def test_fetch_pages_prefetch():
+    mastodon = SnowflakeMocktodon()
+    timeline = mastodon.account_statuses(limit=40)
+    fetched = threading.Event()
+    account_statuses = mastodon.account_statuses
+
+    def mock_account_statuses(*args, **kwargs):
+        page = account_statuses(*args, **kwargs)
+        fetched.set()
+        return page
+
+    mastodon.account_statuses = mock_account_statuses
+    pages = ephemetoot.fetch_pages(Namespace(), mastodon, "test_user_id", timeline)
+    first = next(pages)
+    # the second page is fetched while the first is still being checked
+    assert fetched.wait(5)
+    assert mastodon.max_ids == [None, first[-1].id]
+    # and no further ahead than that
+    pages.close()
+    assert len(mastodon.max_ids) == 2
+
+
+def test_fetch_pages_rate_limit():
+    mastodon = PagingMocktodon()
+    timeline = mastodon.account_statuses(limit=40)
+    # the limit left after the last delete
+    mastodon.ratelimit_remaining = 5
+    pages = list(
+        ephemetoot.fetch_pages(Namespace(), mastodon, "test_user_id", timeline)
+    )
+    # pages are fetched ahead with a copy of the client, which keeps its own limit
+    assert len(pages) == 60
+    assert mastodon.ratelimit_remaining == 5
+
+
+def test_fetch_pages_retry(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda secs: None)
+    mastodon = FlakyMocktodon()
+    timeline = mastodon.account_statuses(limit=40)
+    pages = list(
+        ephemetoot.fetch_pages(Namespace(), mastodon, "test_user_id", timeline)
+    )
+    # only the page that failed is fetched again, from the same place
+    assert mastodon.max_ids[2] == mastodon.max_ids[3]
+    assert len(set(mastodon.max_ids)) == len(mastodon.max_ids) - 1
+    assert sum(len(page) for page in pages) == 2400
+
+
+def test_fetch_pages_skip_to():
+    mastodon = SnowflakeMocktodon()
+    cutoff = datetime.datetime(2020, 5, 18, tzinfo=timezone.utc)
+    skip_to = ephemetoot.snowflake_max_id(cutoff)
+    timeline = mastodon.account_statuses(limit=40)
+    pages = list(
+        ephemetoot.fetch_pages(Namespace(), mastodon, "test_user_id", timeline, skip_to)
+    )
+
+    # the first fetch after the first page jumps straight to the cutoff
+    assert mastodon.max_ids[1] == skip_to
+    assert pages[1][0].created_at == cutoff - datetime.timedelta(hours=1)
+    # the first page, then only toots older than the cutoff
+    assert sum(len(page) for page in pages) == 40 + 2400 - (14 * 24 + 1)
+
+
 def test_init(monkeypatch, tmpdir):
 
     # monkeypatch current directory
@@ -396,26 +961,26 @@ def test_init(monkeypatch, tmpdir):
 
     # monkeypatch input ...outputs
     monkeypatch.setattr(
-        "ephemetoot.ephemetoot.compulsory_input", lambda a, b, c: "compulsory"
+        "ephemetoot.commands.compulsory_input", lambda a, b, c: "compulsory"
     )
-    monkeypatch.setattr("ephemetoot.ephemetoot.digit_input", lambda a, b, c: "14")
-    monkeypatch.setattr("ephemetoot.ephemetoot.yes_no_input", lambda a, b: "false")
+    monkeypatch.setattr("ephemetoot.commands.digit_input", lambda a, b, c: "14")
+    monkeypatch.setattr("ephemetoot.commands.yes_no_input", lambda a, b: "false")
     monkeypatch.setattr(
-        "ephemetoot.ephemetoot.optional_input", lambda a, b, c: "optional"
+        "ephemetoot.commands.optional_input", lambda a, b, c: "optional"
     )
 
     # run init
-    ephemetoot.init()
+    commands.init()
     assert os.path.exists(os.path.join(current_dir, "config.yaml"))
 
 
 def test_init_archive_path(tmpdir):
 
     good_path = tmpdir.mkdir("archive_dir")  # temporary directory for testing
-    wrong = ephemetoot.sanitise_input(
+    wrong = commands.sanitise_input(
         os.path.join(good_path, "/bad/path/"), "Archive path", None
     )
-    ok = ephemetoot.sanitise_input(good_path, "Archive path", None)
+    ok = commands.sanitise_input(good_path, "Archive path", None)
 
     assert ok == "ok"
     assert wrong == "That directory does not exist, please try again"
@@ -423,12 +988,10 @@ def test_init_archive_path(tmpdir):
 
 def test_init_sanitise_id_list():
     tags = ("\033[96m", "\033[2m", "\033[0m")
-    wrong = ephemetoot.sanitise_input(
-        "987654321, toot_id_number", "Toots to keep", tags
-    )
-    also_wrong = ephemetoot.sanitise_input("toot_id_number", "Toots to keep", tags)
-    ok = ephemetoot.sanitise_input("1234598745, 999933335555", "Toots to keep", tags)
-    also_ok = ephemetoot.sanitise_input("1234598745", "Toots to keep", tags)
+    wrong = commands.sanitise_input("987654321, toot_id_number", "Toots to keep", tags)
+    also_wrong = commands.sanitise_input("toot_id_number", "Toots to keep", tags)
+    ok = commands.sanitise_input("1234598745, 999933335555", "Toots to keep", tags)
+    also_ok = commands.sanitise_input("1234598745", "Toots to keep", tags)
 
     assert wrong == "Toot IDs must be numeric and separated with commas"
     assert also_wrong == "Toot IDs must be numeric and separated with commas"
@@ -438,11 +1001,11 @@ def test_init_sanitise_id_list():
 
 def test_init_sanitise_tag_list():
     tags = ("\033[96m", "\033[2m", "\033[0m")
-    wrong = ephemetoot.sanitise_input("#tag, another_tag", "Hashtags to keep", tags)
-    also_wrong = ephemetoot.sanitise_input("tag, another tag", "Hashtags to keep", tags)
-    still_wrong = ephemetoot.sanitise_input("tag, 12345", "Hashtags to keep", tags)
-    ok = ephemetoot.sanitise_input("tag123, another_TAG", "Hashtags to keep", tags)
-    also_ok = ephemetoot.sanitise_input("single_tag", "Hashtags to keep", tags)
+    wrong = commands.sanitise_input("#tag, another_tag", "Hashtags to keep", tags)
+    also_wrong = commands.sanitise_input("tag, another tag", "Hashtags to keep", tags)
+    still_wrong = commands.sanitise_input("tag, 12345", "Hashtags to keep", tags)
+    ok = commands.sanitise_input("tag123, another_TAG", "Hashtags to keep", tags)
+    also_ok = commands.sanitise_input("single_tag", "Hashtags to keep", tags)
 
     error = (
         "Hashtags must not include '#' and must match rules at "
@@ -460,8 +1023,8 @@ def test_init_sanitise_tag_list():
 
 def test_init_sanitise_url():
     tags = ("\033[96m", "\033[2m", "\033[0m")
-    wrong = ephemetoot.sanitise_input("http://example.social", "Base URL", tags)
-    ok = ephemetoot.sanitise_input("example.social", "Base URL", tags)
+    wrong = commands.sanitise_input("http://example.social", "Base URL", tags)
+    ok = commands.sanitise_input("example.social", "Base URL", tags)
 
     assert (
         wrong
@@ -472,8 +1035,8 @@ def test_init_sanitise_url():
 
 def test_init_sanitise_username():
     tags = ("\033[96m", "\033[2m", "\033[0m")
-    wrong = ephemetoot.sanitise_input("@alice", "Username", tags)
-    ok = ephemetoot.sanitise_input("alice", "Username", tags)
+    wrong = commands.sanitise_input("@alice", "Username", tags)
+    ok = commands.sanitise_input("alice", "Username", tags)
 
     assert wrong == "Do not include '@' in username, please try again"
     assert ok == "ok"
@@ -481,10 +1044,10 @@ def test_init_sanitise_username():
 
 def test_init_sanitise_visibility_list():
     tags = ("\033[96m", "\033[2m", "\033[0m")
-    wrong = ephemetoot.sanitise_input("nonexistent", "Visibility to keep", tags)
-    also_wrong = ephemetoot.sanitise_input("direct public", "Visibility to keep", tags)
-    ok = ephemetoot.sanitise_input("direct", "Visibility to keep", tags)
-    also_ok = ephemetoot.sanitise_input("direct, public", "Visibility to keep", tags)
+    wrong = commands.sanitise_input("nonexistent", "Visibility to keep", tags)
+    also_wrong = commands.sanitise_input("direct public", "Visibility to keep", tags)
+    ok = commands.sanitise_input("direct", "Visibility to keep", tags)
+    also_ok = commands.sanitise_input("direct, public", "Visibility to keep", tags)
 
     error = (
         "Valid values are one or more of 'public', 'unlisted', 'private' or 'direct'"
@@ -495,11 +1058,65 @@ def test_init_sanitise_visibility_list():
     assert also_wrong == error
 
 
+def test_is_snowflake():
+    assert ephemetoot.is_snowflake(toot)
+    # sequential IDs from older servers
+    assert not ephemetoot.is_snowflake(
+        dict2obj({"id": 5, "created_at": toot.created_at})
+    )
+
+
 def test_jsondefault():
     d = ephemetoot.jsondefault(toot.created_at)
     assert d == "2020-05-09T02:17:18.598000+00:00"
 
 
+def test_log_event(capfd):
+    options = Namespace(datestamp=False)
+    ephemetoot.log_event(options, "delete", toot)
+    ephemetoot.log_event(options, "retry_wait", seconds=60)
+    assert capfd.readouterr().out == (
+        "❌ deleting toot 104136090490756999 tooted 09 May 2020\n"
+        "Waiting 60 seconds before re-trying\n"
+    )
+
+
+def test_log_event_hidden(capfd, monkeypatch):
+    # messages that won't be printed are never formatted
+    def fail(toot):
+        raise AssertionError("formatted a hidden message")
+
+    monkeypatch.setattr("ephemetoot.ephemetoot.tooted_date", fail)
+    ephemetoot.log_event(Namespace(quiet=1), "delete", toot)
+    ephemetoot.log_event(Namespace(hide_skipped=True), "skip_pinned", toot, skip=True)
+    assert capfd.readouterr().out == ""
+
+
+def test_log_event_json(capfd, monkeypatch):
+    monkeypatch.setattr(metrics, "accounts", {})
+    metrics.start(config_file)
+    ephemetoot.log_event(Namespace(log_format="json"), "skip_hashtag", toot, skip=True)
+    record = json.loads(capfd.readouterr().out)
+    assert record["event"] == "skip_hashtag"
+    assert record["account"] == "alice@test.social"
+    assert record["id"] == "104136090490756999"
+    assert record["created_at"] == "2020-05-09T02:17:18.598000+00:00"
+    assert "time" in record
+
+
+def test_print_api_error_json(capfd, monkeypatch):
+    monkeypatch.setattr(metrics, "accounts", {})
+    metrics.start(config_file)
+    e = MastodonAPIError("Mastodon API returned error", 401, "Unauthorized", None)
+    ephemetoot.print_api_error(e, Namespace(log_format="json"))
+    record = json.loads(capfd.readouterr().out)
+    assert record["event"] == "error"
+    assert record["account"] == "alice@test.social"
+    assert record["error"] == (
+        "User and/or access token does not exist or has been deleted (401)"
+    )
+
+
 def test_process_toot(capfd, tmpdir, monkeypatch):
     # config uses config_listed at top of this tests file
     p = tmpdir.mkdir("archive")  # use temporary test directory
@@ -533,6 +1150,59 @@ def test_process_toot_pinned(capfd, tmpdir):
     assert capfd.readouterr().out == "📌 skipping pinned toot - 104136090490756999\n"
 
 
+def test_process_toot_kept(capfd, tmpdir):
+    p = tmpdir.mkdir("archive")  # use temporary test directory
+    config_file["archive"] = str(p)
+    config_file["keep_pinned"] = True
+    options = Namespace(archive_deleted=False)
+    mastodon = Mocktodon()
+    toot_dict["pinned"] = True
+    toot = dict2obj(toot_dict)
+    kept = {}
+    ephemetoot.process_toot(config_file, options, mastodon, toot, 0, kept=kept)
+    assert kept == {"104136090490756999": "pinned"}
+
+
+def test_process_toot_metrics(capfd, tmpdir, monkeypatch):
+    monkeypatch.setattr(metrics, "accounts", {})
+    account = metrics.start(config_file)
+    config_file["archive"] = str(tmpdir.mkdir("archive"))
+    config_file["keep_pinned"] = True
+    config_file["toots_to_keep"] = []
+    options = Namespace(archive_deleted=False)
+    mastodon = Mocktodon()
+    toot_dict["visibility"] = "public"
+    toot_dict["reblog"] = False
+    toot_dict["pinned"] = True
+    ephemetoot.process_toot(config_file, options, mastodon, dict2obj(toot_dict), 0)
+    toot_dict["pinned"] = False
+    ephemetoot.process_toot(config_file, options, mastodon, dict2obj(toot_dict), 0)
+
+    assert account.counters["toots_checked"] == 2
+    assert account.counters["toots_kept"] == 1
+    assert account.counters["toots_deleted"] == 1
+    assert account.timings["evaluating"].count == 2
+    assert account.timings["archiving"].count == 2
+    assert account.timings["deleting"].count == 1
+
+
+def test_process_toot_rate_limited(capfd, tmpdir, monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda secs: None)
+    config_file["archive"] = str(tmpdir.mkdir("archive"))
+    config_file["keep_pinned"] = False
+    config_file["toots_to_keep"] = []
+    options = Namespace(archive_deleted=False)
+    mastodon = RateLimitedMocktodon()
+    toot_dict["pinned"] = False
+    toot_dict["visibility"] = "public"
+    toot_dict["reblog"] = False
+    toot = dict2obj(toot_dict)
+    deleted_count = ephemetoot.process_toot(config_file, options, mastodon, toot, 0)
+    # the toot is deleted once the rate limit resets, and still counted
+    assert mastodon.deleted == [104136090490756999]
+    assert deleted_count == 1
+
+
 def test_process_toot_saved(capfd, tmpdir):
     # config uses config_listed at top of this tests file
     p = tmpdir.mkdir("archive")  # use temporary test directory
@@ -596,7 +1266,7 @@ def test_retry_on_error():
 def test_retry_on_error_max_tries():
     # Namespace object constructed from top of tests (representing options)
     # toot and mastodon come from objects at top of test
-    with pytest.raises(TimeoutError):
+    with pytest.raises(TimeoutError, match="Gave up after 6 attempts"):
         mastodon = Mocktodon()
         toot = dict2obj(toot_dict)
         retry = ephemetoot.retry_on_error(Namespace(retry_mins=True), mastodon, toot, 7)
@@ -625,7 +1295,7 @@ def test_schedule(monkeypatch, tmpdir):
     monkeypatch.setattr(subprocess, "run", suppress_subprocess)
 
     # now we run the function we're testing
-    ephemetoot.schedule(Namespace(schedule=".", time=None))
+    commands.schedule(Namespace(schedule=".", time=None))
 
     # assert the plist file was created
     plist_file = os.path.join(launch, "ephemetoot.scheduler.plist")
@@ -665,7 +1335,7 @@ def test_schedule_with_time(monkeypatch, tmpdir):
     monkeypatch.setattr(subprocess, "run", suppress_subprocess)
 
     # now we run the function we're testing
-    ephemetoot.schedule(Namespace(schedule=".", time=["10", "30"]))
+    commands.schedule(Namespace(schedule=".", time=["10", "30"]))
 
     # assert the plist file was created
     plist_file = os.path.join(launch, "ephemetoot.scheduler.plist")
@@ -688,7 +1358,7 @@ def test_tooted_date():
 
 
 def test_version(mock_github_response, capfd):
-    ephemetoot.version("TEST_VERSION")
+    commands.version("TEST_VERSION")
     output = capfd.readouterr().out
     msg = """
 ephemetoot ==> 🥳 ==> 🧼 ==> 😇
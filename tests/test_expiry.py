@@ -0,0 +1,189 @@
+import datetime
+import os
+
+from mastodon import MastodonAPIError, MastodonNotFoundError
+
+from ephemetoot import ephemetoot
+from ephemetoot import expiry
+from ephemetoot import metrics
+from ephemetoot import state
+from ephemetoot.policy import compile_policy
+
+from test_ephemetoot import AttribDict, Namespace
+
+config = {
+    "access_token": "abcd_1234",
+    "username": "alice",
+    "base_url": "test.social",
+    "days_to_keep": 14,
+    "keep_pinned": True,
+    "hashtags_to_keep": ["keep"],
+}
+
+now = datetime.datetime.now(datetime.timezone.utc)
+
+
+def toot(days_ago, pinned=False, tags=()):
+    created_at = now - datetime.timedelta(days=days_ago)
+    return AttribDict(
+        id=str(int(created_at.timestamp() * 1000) << 16),
+        created_at=created_at,
+        visibility="public",
+        tags=[AttribDict(name=tag) for tag in tags],
+        pinned=pinned,
+        reblog=None,
+    )
+
+
+def test_add():
+    queue = expiry.ExpiryQueue(config)
+    policy = compile_policy(config)
+    new, pinned, tagged = toot(1), toot(3, pinned=True), toot(2, tags=["Keep"])
+    assert queue.add(new, policy)
+    # pinned toots may be unpinned by the time they expire
+    assert queue.add(pinned, policy)
+    assert not queue.add(tagged, policy)
+
+    expires = (pinned.created_at + datetime.timedelta(days=14)).timestamp()
+    assert queue.next_expiry() == expires
+    assert list(queue.pop_due(now + datetime.timedelta(days=12))) == [pinned.id]
+    assert queue.toots == [
+        [(new.created_at + datetime.timedelta(days=14)).timestamp(), new.id]
+    ]
+
+
+def test_load(tmpdir):
+    path = os.path.join(tmpdir, "state.json")
+    assert expiry.load(path, config) is None
+    queue = expiry.ExpiryQueue(config, min_id="5", toots=[[1.5, "4"]])
+    queue.save(path)
+
+    loaded = expiry.load(path, config)
+    assert loaded.min_id == "5"
+    assert loaded.toots == [[1.5, "4"]]
+    assert expiry.next_expiry(path, config) == 1.5
+    # the queue was filled using different rules, so it has to be filled again
+    assert expiry.load(path, dict(config, days_to_keep=30)) is None
+    assert expiry.load(path, dict(config, keep_pinned=False)) is None
+
+
+class QueueMocktodon:
+    def __init__(self, toots):
+        self.toots = {t.id: t for t in toots}
+        self.deleted = []
+        self.min_ids = []
+
+    def account_verify_credentials(self):
+        return AttribDict(id=1)
+
+    def account_statuses(self, user_id, limit=None, min_id=None):
+        self.min_ids.append(min_id)
+        newest = sorted(self.toots.values(), key=lambda t: -int(t.id))
+        if min_id is None:
+            return newest[:limit]
+        # like the API, the page is the toots just after min_id, newest first
+        return [t for t in newest if int(t.id) > int(min_id)][-limit:]
+
+    def status(self, status_id):
+        if status_id not in self.toots:
+            raise MastodonNotFoundError("Not found", 404, "Not Found", "gone")
+        return self.toots[status_id]
+
+    def status_delete(self, toot):
+        self.deleted.append(toot.id)
+        del self.toots[toot.id]
+
+
+def test_check_queue(capfd, tmpdir, monkeypatch):
+    path = os.path.join(tmpdir, "state.json")
+    expired, pinned, gone, later = toot(15), toot(16, pinned=True), toot(17), toot(5)
+    new, tagged = toot(1), toot(0.5, tags=["keep"])
+    mastodon = QueueMocktodon([expired, pinned, later, new, tagged])
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: mastodon)
+
+    queue = expiry.ExpiryQueue(config, min_id=later.id)
+    for queued in (expired, pinned, gone, later):
+        queue.add(queued, compile_policy(config))
+    queue.save(path)
+
+    ephemetoot.check_queue(config, Namespace(expiry_queue=True, state=path))
+    output = capfd.readouterr().out
+
+    # only new toots are fetched, and only expired toots are looked at again
+    assert mastodon.min_ids == [later.id, tagged.id]
+    assert mastodon.deleted == [expired.id]
+    assert "Removed 1 toots for alice@test.social." in output
+
+    queue = expiry.load(path, config)
+    assert queue.min_id == tagged.id
+    queued = sorted(toot_id for expires, toot_id in queue.toots)
+    assert queued == sorted([pinned.id, later.id, new.id])
+    recheck = dict((toot_id, expires) for expires, toot_id in queue.toots)[pinned.id]
+    assert recheck > (now + datetime.timedelta(hours=23)).timestamp()
+
+
+def test_check_queue_first_run(capfd, tmpdir, monkeypatch):
+    path = os.path.join(tmpdir, "state.json")
+    old, recent = toot(20), toot(3)
+    mastodon = QueueMocktodon([old, recent])
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: mastodon)
+    monkeypatch.setattr(metrics, "accounts", {})
+    checked = []
+    monkeypatch.setattr(
+        ephemetoot,
+        "check_toots",
+        lambda config, options, **kwargs: checked.append(config),
+    )
+
+    # the normal check didn't finish, so the queue isn't filled
+    ephemetoot.check_queue(config, Namespace(expiry_queue=True, state=path))
+    assert checked == [config]
+    assert state.get_account(path, config) == {}
+
+    monkeypatch.setattr(
+        ephemetoot, "check_toots", lambda config, options, **kwargs: True
+    )
+    ephemetoot.check_queue(config, Namespace(expiry_queue=True, state=path))
+    # the first check and filling the queue are timed as one, each time
+    assert metrics.current().timings["total"].count == 2
+    # only toots newer than the cutoff are fetched
+    queue = expiry.load(path, config)
+    assert [toot_id for expires, toot_id in queue.toots] == [recent.id]
+    assert queue.min_id == recent.id
+    assert mastodon.deleted == []
+
+
+def test_check_queue_error(capfd, tmpdir, monkeypatch):
+    path = os.path.join(tmpdir, "state.json")
+    mastodon = QueueMocktodon([toot(15)])
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: mastodon)
+    expiry.ExpiryQueue(config, min_id="0").save(path)
+
+    def broken_save(self, path):
+        raise OSError("No space left on device")
+
+    # the error is reported, rather than stopping every other account
+    monkeypatch.setattr(expiry.ExpiryQueue, "save", broken_save)
+    ephemetoot.check_queue(config, Namespace(expiry_queue=True, state=path))
+    assert "ERROR: No space left on device" in capfd.readouterr().out
+
+
+def test_check_queue_refused(capfd, tmpdir, monkeypatch):
+    path = os.path.join(tmpdir, "state.json")
+    refused = toot(15)
+    mastodon = QueueMocktodon([refused])
+
+    def refuse(toot):
+        raise MastodonAPIError("Mastodon API returned error", 422, "", "Nope")
+
+    mastodon.status_delete = refuse
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: mastodon)
+    queue = expiry.ExpiryQueue(config, min_id=refused.id)
+    queue.add(refused, compile_policy(config))
+    queue.save(path)
+
+    ephemetoot.check_queue(config, Namespace(expiry_queue=True, state=path))
+    # the toot stays queued, to be tried again tomorrow
+    queue = expiry.load(path, config)
+    assert [toot_id for expires, toot_id in queue.toots] == [refused.id]
+    assert queue.toots[0][0] > (now + datetime.timedelta(hours=23)).timestamp()
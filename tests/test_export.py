@@ -0,0 +1,217 @@
+import datetime
+import io
+import json
+import zipfile
+
+import pytest
+from mastodon import MastodonNetworkError, MastodonNotFoundError
+
+from ephemetoot import ephemetoot
+from ephemetoot import export
+from ephemetoot import metrics
+
+from test_ephemetoot import Namespace
+
+ACTOR = "https://test.social/users/alice"
+PUBLIC = "https://www.w3.org/ns/activitystreams#Public"
+
+
+def note(status_id, published, to, cc=(), tags=()):
+    return {
+        "id": ACTOR + "/statuses/" + status_id + "/activity",
+        "type": "Create",
+        "actor": ACTOR,
+        "published": published,
+        "to": list(to),
+        "cc": list(cc),
+        "object": {
+            "id": ACTOR + "/statuses/" + status_id,
+            "type": "Note",
+            "published": published,
+            "url": "https://test.social/@alice/" + status_id,
+            "to": list(to),
+            "cc": list(cc),
+            "content": "<p>toot " + status_id + "</p>",
+            "tag": [{"type": "Hashtag", "name": "#" + tag} for tag in tags],
+        },
+    }
+
+
+def boost(status_id, published):
+    return {
+        "id": ACTOR + "/statuses/" + status_id + "/activity",
+        "type": "Announce",
+        "actor": ACTOR,
+        "published": published,
+        "to": [PUBLIC],
+        "cc": [ACTOR + "/followers"],
+        "object": "https://other.social/users/bob/statuses/1",
+    }
+
+
+OUTBOX = {
+    "@context": "https://www.w3.org/ns/activitystreams",
+    "id": "outbox.json",
+    "type": "OrderedCollection",
+    "totalItems": 5,
+    "orderedItems": [
+        note("101", "2019-01-01T00:00:00Z", [PUBLIC], [ACTOR + "/followers"]),
+        note("102", "2019-01-02T00:00:00Z", [ACTOR + "/followers"], [], ["Keep"]),
+        note("103", "2019-01-03T00:00:00Z", [ACTOR + "/followers"], [PUBLIC]),
+        boost("104", "2019-01-04T00:00:00Z"),
+        note("105", "2019-01-05T00:00:00Z", ["https://other.social/users/bob"]),
+    ],
+}
+
+
+def write_export(path, zipped=False):
+    files = {
+        "actor.json": json.dumps({"id": ACTOR, "preferredUsername": "alice"}),
+        "outbox.json": json.dumps(OUTBOX, indent=2),
+    }
+    if zipped:
+        with zipfile.ZipFile(path, "w") as z:
+            for name, content in files.items():
+                z.writestr(name, content)
+    else:
+        path.mkdir()
+        for name, content in files.items():
+            path.join(name).write(content)
+    return str(path)
+
+
+def test_iter_array(monkeypatch):
+    # read a few characters at a time, so items are split across reads
+    monkeypatch.setattr(export, "CHUNK_SIZE", 7)
+    f = io.StringIO(json.dumps(OUTBOX))
+    items = list(export.iter_array(f, "orderedItems"))
+    assert items == OUTBOX["orderedItems"]
+
+
+def test_iter_array_truncated():
+    f = io.StringIO(json.dumps(OUTBOX)[:-100])
+    with pytest.raises(ValueError):
+        list(export.iter_array(f, "orderedItems"))
+
+
+def test_iter_toots(tmpdir):
+    path = write_export(tmpdir.join("export.zip"), zipped=True)
+    toots = list(export.iter_toots(path))
+    assert [toot.id for toot in toots] == ["101", "102", "103", "104", "105"]
+    assert [toot.visibility for toot in toots] == [
+        "public",
+        "private",
+        "unlisted",
+        "public",
+        "direct",
+    ]
+    assert toots[1].tags[0].name == "Keep"
+    assert toots[0].created_at == datetime.datetime(
+        2019, 1, 1, tzinfo=datetime.timezone.utc
+    )
+    assert toots[0].reblog is None
+    assert toots[3].reblog.uri == "https://other.social/users/bob/statuses/1"
+
+
+def test_read_actor(tmpdir):
+    path = write_export(tmpdir.join("export"))
+    actor = export.read_actor(path)
+    assert actor == ("alice", "test.social")
+    assert export.matches(actor, {"username": "alice", "base_url": "test.social"})
+    assert export.matches(actor, {"username": "Alice", "base_url": "test.social"})
+    assert not export.matches(actor, {"username": "alice", "base_url": "other.social"})
+
+
+class ExportMocktodon:
+    def __init__(self):
+        self.deleted = []
+        self.unboosted = []
+
+    def account_verify_credentials(self):
+        return export.ExportToot(id=1)
+
+    def account_statuses(self, user_id, pinned=False):
+        return [export.ExportToot(id=101)]
+
+    def status(self, status_id):
+        return export.ExportToot(
+            id=status_id,
+            created_at=datetime.datetime(2019, 1, 4, tzinfo=datetime.timezone.utc),
+            visibility="public",
+            tags=[],
+            reblog=export.ExportToot(id=55),
+        )
+
+    def status_delete(self, toot):
+        if toot.id == "105":
+            raise MastodonNotFoundError("Not found", 404, "Not Found", "gone")
+        self.deleted.append(toot.id)
+
+    def status_unreblog(self, toot):
+        self.unboosted.append(toot.id)
+
+
+def test_check_export(capfd, tmpdir, monkeypatch):
+    mastodon = ExportMocktodon()
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: mastodon)
+    config = {
+        "access_token": "abcd_1234",
+        "username": "alice",
+        "base_url": "test.social",
+        "days_to_keep": 14,
+        "keep_pinned": True,
+        "hashtags_to_keep": ["keep"],
+        "visibility_to_keep": ["unlisted"],
+    }
+    path = write_export(tmpdir.join("export"))
+    ephemetoot.check_export(config, Namespace(), path)
+    output = capfd.readouterr().out.split("\n")
+
+    # 101 is pinned, 102 has a hashtag to keep and 103 is unlisted
+    assert mastodon.deleted == []
+    # the boost's local ID comes from the server
+    assert mastodon.unboosted == [55]
+    assert output[1] == "📌 skipping pinned toot - 101"
+    assert output[4] == "👎 unboosting toot 104 boosted 04 Jan 2019"
+    assert output[6] == "👻 toot 105 was already deleted"
+    assert output[7] == "Removed 1 toots for alice@test.social."
+
+
+def test_check_export_error(capfd, tmpdir, monkeypatch):
+    mastodon = ExportMocktodon()
+
+    def broken_delete(toot):
+        raise RuntimeError("Something unexpected")
+
+    mastodon.status_delete = broken_delete
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: mastodon)
+    config = {
+        "access_token": "abcd_1234",
+        "username": "alice",
+        "base_url": "test.social",
+    }
+    path = write_export(tmpdir.join("export"))
+    # the error is reported, rather than ending the run with a traceback
+    ephemetoot.check_export(config, Namespace(), path)
+    assert "ERROR: Something unexpected" in capfd.readouterr().out
+
+
+def test_check_export_offline(capfd, tmpdir, monkeypatch):
+    def offline(config, options):
+        raise MastodonNetworkError("Could not complete request: connection refused")
+
+    monkeypatch.setattr(ephemetoot, "connect", offline)
+    monkeypatch.setattr(metrics, "accounts", {})
+    config = {
+        "access_token": "abcd_1234",
+        "username": "alice",
+        "base_url": "test.social",
+    }
+    path = write_export(tmpdir.join("export"))
+    ephemetoot.check_export(config, Namespace(), path)
+    # a network error isn't mistaken for a problem reading the export
+    assert "ephemetoot cannot connect to the server" in capfd.readouterr().out
+    assert metrics.current().counters["errors"] == 1
+    # the run is still timed for --metrics
+    assert metrics.current().timings["total"].count == 1
+    assert metrics.current().finished
@@ -0,0 +1,87 @@
+import json
+import threading
+
+from ephemetoot import metrics
+
+
+def test_histogram():
+    histogram = metrics.Histogram()
+    histogram.observe(0.002)
+    histogram.observe(0.002)
+    histogram.observe(7200)
+    assert histogram.count == 3
+    assert histogram.sum == 7200.004
+    cumulative = dict(histogram.cumulative())
+    assert cumulative[0.001] == 0
+    assert cumulative[0.005] == 2
+    assert cumulative[3600] == 2
+    assert cumulative[float("inf")] == 3
+
+
+def test_start_and_current(monkeypatch):
+    monkeypatch.setattr(metrics, "accounts", {})
+    config = {"username": "alice", "base_url": "test.social"}
+    account = metrics.start(config)
+    assert metrics.current() is account
+    # starting the same account again keeps its metrics
+    assert metrics.start(config) is account
+
+    # other threads have their own current account
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(metrics.current()))
+    thread.start()
+    thread.join()
+    assert seen[0] is not account
+    assert seen[0].account is None
+    assert list(metrics.accounts) == ["alice@test.social"]
+
+
+def test_write_json(monkeypatch, tmpdir):
+    monkeypatch.setattr(metrics, "accounts", {})
+    account = metrics.start({"username": "alice", "base_url": "test.social"})
+    account.count("toots_checked", 3)
+    account.count("toots_deleted")
+    with account.timer("paging"):
+        pass
+    account.observe("rate_limit_wait", 90)
+
+    path = str(tmpdir.join("metrics.json"))
+    metrics.write(path)
+    with open(path) as f:
+        summary = json.load(f)["alice@test.social"]
+
+    assert summary["counters"]["toots_checked"] == 3
+    assert summary["counters"]["toots_deleted"] == 1
+    assert summary["counters"]["retries"] == 0
+    assert summary["timings"]["paging"]["count"] == 1
+    assert summary["seconds"]["rate_limit_wait"] == 90
+    assert summary["timings"]["rate_limit_wait"]["buckets"]["300.0"] == 1
+    assert summary["timings"]["rate_limit_wait"]["buckets"]["60.0"] == 0
+
+
+def test_write_prometheus(monkeypatch, tmpdir):
+    monkeypatch.setattr(metrics, "accounts", {})
+    account = metrics.start({"username": "alice", "base_url": "test.social"})
+    account.count("toots_deleted", 2)
+    account.observe("deleting", 0.2)
+    account.finished = 1600000000.0
+
+    path = str(tmpdir.join("ephemetoot.prom"))
+    metrics.write(path)
+    with open(path) as f:
+        lines = f.read().split("\n")
+
+    assert "# TYPE ephemetoot_toots_deleted_total counter" in lines
+    assert 'ephemetoot_toots_deleted_total{account="alice@test.social"} 2' in lines
+    assert "# TYPE ephemetoot_phase_seconds histogram" in lines
+    labels = 'account="alice@test.social",phase="deleting"'
+    assert "ephemetoot_phase_seconds_bucket{" + labels + ',le="0.1"} 0' in lines
+    assert "ephemetoot_phase_seconds_bucket{" + labels + ',le="0.5"} 1' in lines
+    assert "ephemetoot_phase_seconds_bucket{" + labels + ',le="+Inf"} 1' in lines
+    assert "ephemetoot_phase_seconds_count{" + labels + "} 1" in lines
+    assert (
+        'ephemetoot_last_run_timestamp_seconds{account="alice@test.social"} 1600000000.0'
+        in lines
+    )
+    # nothing is left behind from writing the file
+    assert tmpdir.listdir() == [tmpdir.join("ephemetoot.prom")]
@@ -0,0 +1,147 @@
+import datetime
+import json
+
+from mastodon import MastodonNotFoundError
+
+from ephemetoot import ephemetoot
+from ephemetoot import metrics
+from ephemetoot import plan
+from ephemetoot.policy import DELETE, KEEP, UNBOOST, compile_policy
+
+from test_ephemetoot import AttribDict, Namespace
+
+config = {
+    "access_token": "abcd_1234",
+    "username": "alice",
+    "base_url": "test.social",
+    "days_to_keep": 14,
+}
+
+
+def old_toot(status_id, reblog=None):
+    return AttribDict(
+        id=status_id,
+        created_at=datetime.datetime(2020, 5, 9, tzinfo=datetime.timezone.utc),
+        visibility="public",
+        tags=[],
+        pinned=False,
+        reblog=reblog,
+    )
+
+
+def test_save_and_load(tmpdir):
+    path = str(tmpdir.join("plan.json"))
+    cutoff = compile_policy(config).cutoff
+    entries = [
+        plan.entry(old_toot(1), DELETE, "expired"),
+        plan.entry(old_toot(2, reblog=AttribDict(id=99)), UNBOOST, "expired"),
+    ]
+    plan.save_account(path, config, cutoff, entries)
+    plan.save_account(path, dict(config, username="bob"), cutoff, [])
+
+    with open(path) as f:
+        saved = json.load(f)
+    assert sorted(saved) == ["alice@test.social", "bob@test.social"]
+    assert saved["alice@test.social"]["cutoff"] == cutoff.isoformat()
+
+    toots = list(plan.toots(saved, config))
+    assert [toot.id for toot in toots] == ["1", "2"]
+    assert toots[0].action == DELETE
+    assert toots[0].reblog is None
+    assert toots[1].action == UNBOOST
+    assert toots[1].reblog == "99"
+    assert toots[1].created_at == old_toot(2).created_at
+    assert list(plan.toots(saved, dict(config, username="carol"))) == []
+
+
+def test_plan_policy():
+    now = datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)
+    policy = plan.PlanPolicy(cutoff=now - datetime.timedelta(days=14))
+    planned = plan.PlannedToot(
+        id="1",
+        action=DELETE,
+        reason="expired",
+        created_at=now - datetime.timedelta(days=30),
+    )
+    assert policy.decide(planned) == (DELETE, "expired")
+    # days_to_keep has been increased since the plan was made
+    planned["created_at"] = now - datetime.timedelta(days=7)
+    assert policy.decide(planned) == (KEEP, "recent")
+
+
+def test_process_toot_planned(capfd):
+    planned = []
+    mastodon = PlanMocktodon()
+    options = Namespace(test=True)
+    ephemetoot.process_toot(config, options, mastodon, old_toot(1), planned=planned)
+    toot = old_toot(2)
+    toot["created_at"] = datetime.datetime.now(datetime.timezone.utc)
+    ephemetoot.process_toot(config, options, mastodon, toot, planned=planned)
+
+    # only the old toot is planned, and nothing is deleted yet
+    assert planned == [["1", DELETE, "expired", "2020-05-09T00:00:00+00:00", None]]
+    assert mastodon.deleted == []
+
+
+class PlanMocktodon:
+    def __init__(self):
+        self.deleted = []
+        self.unboosted = []
+
+    def status(self, status_id):
+        return AttribDict(id=status_id, reblog=AttribDict(id=55))
+
+    def status_delete(self, toot):
+        if toot.id == "3":
+            raise MastodonNotFoundError("Not found", 404, "Not Found", "gone")
+        self.deleted.append(toot.id)
+
+    def status_unreblog(self, toot):
+        self.unboosted.append(toot.id if isinstance(toot, dict) else toot)
+
+
+def test_execute_plan(capfd, monkeypatch):
+    mastodon = PlanMocktodon()
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: mastodon)
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    saved = {
+        "alice@test.social": {
+            "toots": [
+                ["1", DELETE, "expired", "2020-05-09T00:00:00+00:00", None],
+                ["2", UNBOOST, "expired", "2020-05-09T00:00:00+00:00", "42"],
+                ["3", DELETE, "expired", "2020-05-09T00:00:00+00:00", None],
+                ["4", DELETE, "expired", now, None],
+                ["5", UNBOOST, "expired", "2020-05-09T00:00:00+00:00", None],
+            ]
+        }
+    }
+    ephemetoot.execute_plan(config, Namespace(), plan.toots(saved, config))
+    output = capfd.readouterr().out.split("\n")
+
+    # 3 is already gone, and 4 is too new to delete now
+    assert mastodon.deleted == ["1"]
+    # the boosted toot for 5 has to be looked up
+    assert mastodon.unboosted == ["42", 55]
+    assert output[3] == "❌ deleting toot 3 tooted 09 May 2020"
+    assert output[4] == "👻 toot 3 was already deleted"
+    assert "Removed 3 toots for alice@test.social." in output
+
+
+def test_execute_plan_error(capfd, monkeypatch):
+    mastodon = PlanMocktodon()
+    monkeypatch.setattr(metrics, "accounts", {})
+
+    def broken_delete(toot):
+        raise RuntimeError("Something unexpected")
+
+    mastodon.status_delete = broken_delete
+    monkeypatch.setattr(ephemetoot, "connect", lambda config, options: mastodon)
+    saved = {
+        "alice@test.social": {
+            "toots": [["1", DELETE, "expired", "2020-05-09T00:00:00+00:00", None]]
+        }
+    }
+    # the error is reported, so the plan can carry on with the next account
+    ephemetoot.execute_plan(config, Namespace(), plan.toots(saved, config))
+    assert "ERROR: Something unexpected" in capfd.readouterr().out
+    assert metrics.current().timings["total"].count == 1
@@ -0,0 +1,82 @@
+import datetime
+from datetime import timezone
+
+from ephemetoot.policy import DELETE, KEEP, UNBOOST, compile_policy
+
+now = datetime.datetime(2020, 6, 1, tzinfo=timezone.utc)
+
+config = {
+    "access_token": "abcd_1234",
+    "username": "alice",
+    "base_url": "test.social",
+    "days_to_keep": 14,
+    "keep_pinned": True,
+    "toots_to_keep": [103996285277439262, "103976473612749097"],
+    "hashtags_to_keep": ["Ephemetoot"],
+    "visibility_to_keep": ["direct"],
+}
+
+
+class Tag:
+    def __init__(self, name):
+        self.name = name
+
+
+class Toot:
+    def __init__(
+        self,
+        id=1,
+        days_old=30,
+        pinned=False,
+        visibility="public",
+        tags=[],
+        reblog=None,
+    ):
+        self.id = id
+        self.created_at = now - datetime.timedelta(days=days_old)
+        self.pinned = pinned
+        self.visibility = visibility
+        self.tags = [Tag(name) for name in tags]
+        self.reblog = reblog
+
+
+def test_compile_policy_cutoff():
+    policy = compile_policy(config, now=now)
+    assert policy.cutoff == datetime.datetime(2020, 5, 18, tzinfo=timezone.utc)
+
+
+def test_compile_policy_defaults():
+    policy = compile_policy({"username": "bob", "base_url": "test.social"}, now=now)
+    assert policy.cutoff == now - datetime.timedelta(days=365)
+    assert policy.toots_to_keep == frozenset()
+    assert not policy.keep_pinned
+
+
+def test_decide():
+    policy = compile_policy(config, now=now)
+    assert policy.decide(Toot()) == (DELETE, "expired")
+    assert policy.decide(Toot(days_old=2)) == (KEEP, "recent")
+    assert policy.decide(Toot(pinned=True)) == (KEEP, "pinned")
+    assert policy.decide(Toot(visibility="direct")) == (KEEP, "visibility")
+    assert policy.decide(Toot(reblog=True)) == (UNBOOST, "expired")
+
+
+def test_decide_boosts_only():
+    policy = compile_policy(dict(config, boosts_only=True), now=now)
+    assert policy.decide(Toot()) == (KEEP, "boosts_only")
+    assert policy.decide(Toot(reblog=True)) == (UNBOOST, "expired")
+
+
+def test_decide_hashtags_ignore_case():
+    policy = compile_policy(config, now=now)
+    assert policy.decide(Toot(tags=["ephemetoot"])) == (KEEP, "hashtag")
+    assert policy.decide(Toot(tags=["EPHEMETOOT"])) == (KEEP, "hashtag")
+    assert policy.decide(Toot(tags=["other"])) == (DELETE, "expired")
+
+
+def test_decide_saved_ids():
+    policy = compile_policy(config, now=now)
+    # IDs match whether the API and the config file use numbers or strings
+    assert policy.decide(Toot(id=103996285277439262)) == (KEEP, "saved")
+    assert policy.decide(Toot(id="103996285277439262")) == (KEEP, "saved")
+    assert policy.decide(Toot(id=103976473612749097)) == (KEEP, "saved")
@@ -0,0 +1,132 @@
+import time
+
+from mastodon import (
+    MastodonAPIError,
+    MastodonNetworkError,
+    MastodonRatelimitError,
+    MastodonServerError,
+)
+import pytest
+
+from ephemetoot import ephemetoot
+from ephemetoot import retry
+
+from test_ephemetoot import Namespace, dict2obj, toot_dict
+
+server_error = MastodonServerError("Mastodon API returned error", 503, "", None)
+toot = dict2obj(dict(toot_dict, reblog=None))
+
+
+@pytest.fixture(autouse=True)
+def clear_servers(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda secs: None)
+    yield
+    retry.breakers.clear()
+    retry.retry_after.clear()
+
+
+class MockResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.url = "https://test.social/api/v1/statuses/1"
+
+
+# mock Mastodon whose server always fails
+class FailingMocktodon:
+    api_base_url = "https://down.social"
+
+    def __init__(self, error=server_error):
+        self.error = error
+        self.attempts = 0
+
+    def status_delete(self, toot):
+        self.attempts += 1
+        raise self.error
+
+
+def test_policy_for():
+    assert retry.policy_for(server_error) == retry.SERVER_ERRORS
+    assert retry.policy_for(MastodonNetworkError("offline")) == retry.NETWORK_ERRORS
+    assert retry.policy_for(MastodonRatelimitError("limit")) == retry.RATE_LIMITS
+    limited = MastodonAPIError("Mastodon API returned error", 429, "", None)
+    assert retry.policy_for(limited) == retry.RATE_LIMITS
+    # trying again won't fix these
+    invalid = MastodonAPIError("Mastodon API returned error", 422, "", None)
+    assert retry.policy_for(invalid) is None
+
+
+def test_backoff():
+    waits = [retry.backoff(retry.NETWORK_ERRORS, n, retry_mins=1) for n in range(1, 6)]
+    # at least half of 1, 2, 4, 8 and 8 minutes, and no more than all of it
+    for wait, longest in zip(waits, [60, 120, 240, 480, 480]):
+        assert longest / 2 <= wait <= longest
+
+
+def test_record_response():
+    retry.record_response(MockResponse(429, {"Retry-After": "30"}))
+    assert 30 <= retry.wait_time(server_error, 1, 1, "test.social") <= 31
+    # each Retry-After is only used once
+    assert retry.wait_time(server_error, 1, 1, "test.social") <= 15
+
+    retry.record_response(
+        MockResponse(503, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})
+    )
+    assert retry.wait_time(server_error, 1, 1, "test.social") == 1
+
+    retry.record_response(MockResponse(200, {"Retry-After": "30"}))
+    assert "test.social" not in retry.retry_after
+
+
+def test_circuit_breaker(monkeypatch):
+    breaker = retry.CircuitBreaker(threshold=2, cooldown=60)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.is_open() and not breaker.allow()
+
+    # after the cooldown one caller can try again, but only one
+    later = time.monotonic() + 61
+    monkeypatch.setattr(time, "monotonic", lambda: later)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success()
+    assert not breaker.is_open() and breaker.allow()
+
+
+def test_record_response_closes_breaker():
+    breaker = retry.breaker("test.social")
+    for attempt in range(retry.FAILURE_THRESHOLD):
+        breaker.failure()
+    retry.record_response(MockResponse(500))
+    assert breaker.is_open()
+    retry.record_response(MockResponse(404))
+    assert not breaker.is_open()
+
+
+def test_retry_on_error_circuit_open():
+    mastodon = FailingMocktodon()
+    breaker = retry.breaker("down.social")
+    for attempt in range(retry.FAILURE_THRESHOLD - 2):
+        breaker.failure()
+    with pytest.raises(retry.CircuitOpenError):
+        ephemetoot.retry_on_error(
+            Namespace(retry_mins=1), mastodon, toot, 1, server_error
+        )
+    assert mastodon.attempts == 2
+    # other accounts on the same server are skipped straight away
+    with pytest.raises(retry.CircuitOpenError):
+        retry.check_server("down.social")
+
+
+def test_retry_on_error_not_retried():
+    invalid = MastodonAPIError("Mastodon API returned error", 422, "", None)
+    mastodon = FailingMocktodon(invalid)
+    ephemetoot.retry_on_error(Namespace(retry_mins=1), mastodon, toot, 1, invalid)
+    assert mastodon.attempts == 0
+
+
+def test_wait_to_retry_quiet(capfd):
+    limited = MastodonRatelimitError("limit")
+    ephemetoot.wait_to_retry(Namespace(quiet=3), FailingMocktodon(), limited, 1)
+    assert capfd.readouterr().out == ""
@@ -0,0 +1,71 @@
+import datetime
+import os
+
+from ephemetoot import state
+
+config = {
+    "access_token": "abcd_1234",
+    "username": "alice",
+    "base_url": "test.social",
+    "days_to_keep": 14,
+    "keep_pinned": True,
+}
+
+
+def test_get_account_missing_file(tmpdir):
+    path = os.path.join(tmpdir, "state.json")
+    assert state.get_account(path, config) == {}
+
+
+def test_policy_hash():
+    changed = dict(config, keep_pinned=False)
+    longer = dict(config, days_to_keep=365)
+    assert state.policy_hash(config) != state.policy_hash(changed)
+    # days_to_keep only moves the cutoff, so it does not invalidate the state
+    assert state.policy_hash(config) == state.policy_hash(longer)
+
+
+def test_update_account(tmpdir):
+    path = os.path.join(tmpdir, "state.json")
+    bob = dict(config, username="bob")
+    state.update_account(path, config, cutoff="2020-06-01T00:00:00+00:00")
+    state.update_account(path, bob, cutoff="2020-06-02T00:00:00+00:00")
+    state.update_account(path, config, kept={"5": "pinned"})
+
+    assert state.get_account(path, config) == {
+        "cutoff": "2020-06-01T00:00:00+00:00",
+        "kept": {"5": "pinned"},
+    }
+    assert state.get_account(path, bob) == {"cutoff": "2020-06-02T00:00:00+00:00"}
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_checkpoint(tmpdir, monkeypatch):
+    path = os.path.join(tmpdir, "state.json")
+    cutoff = datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)
+    checkpoint = state.Checkpoint(path, config, cutoff, every=60)
+
+    clock = [1000.0]
+    monkeypatch.setattr(state.time, "monotonic", lambda: clock[0])
+    checkpoint.saved_at = clock[0]
+
+    # not saved until a minute has passed
+    checkpoint.update(150, 3, {})
+    assert state.get_checkpoint(path, config) is None
+    clock[0] += 61
+    checkpoint.update(140, 4, {"145": "pinned"})
+    assert state.get_checkpoint(path, config) == {
+        "max_id": "140",
+        "deleted": 4,
+        "kept": {"145": "pinned"},
+        "cutoff": "2020-06-01T00:00:00+00:00",
+        "policy": state.policy_hash(config),
+    }
+
+    # saving now writes the latest position, even if a minute hasn't passed
+    checkpoint.update(130, 5, {"145": "pinned"})
+    checkpoint.save()
+    assert state.get_checkpoint(path, config)["max_id"] == "130"
+
+    # a checkpoint is no use if the keep rules have changed
+    assert state.get_checkpoint(path, dict(config, keep_pinned=False)) is None